@@ -2,23 +2,13 @@ import click
 import numpy as np
 
 import pyTSEB.resistances as res
+import cache_utils
 import snappy_utils as su
 
 
-@click.command()
-@click.option('--lai_map', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--landcover_params_map', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--soil_roughness', required=True, type=click.FLOAT)
-@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
-def main(lai_map, landcover_params_map, soil_roughness, output_file):
-    
-    lai, geo_coding = su.read_snappy_product(lai_map, 'lai')
-    lai = lai.astype(np.float32)
-    height = su.read_snappy_product(landcover_params_map, 'veg_height')[0].astype(np.float32)
-    height_width_ratio = su.read_snappy_product(landcover_params_map, 'veg_height_width_ratio')[0].astype(np.float32)
-    fractional_cover = su.read_snappy_product(landcover_params_map, 'veg_fractional_cover')[0].astype(np.float32)
-    classification = su.read_snappy_product(landcover_params_map, 'igbp_classification')[0].astype(np.float32)
-    
+def calc_aerodynamic_roughness(lai, height, height_width_ratio, fractional_cover, classification,
+                               soil_roughness):
+
     z_OM = np.full(lai.shape, np.nan, np.float32)
     d_0 = np.full(lai.shape, np.nan, np.float32)
 
@@ -29,12 +19,38 @@ def main(lai_map, landcover_params_map, soil_roughness, output_file):
     i = lai > 0
     z_OM[i], d_0[i] = res.calc_roughness(lai[i], height[i], height_width_ratio[i],
                                          classification[i], fractional_cover[i])
-    
-    band_data = [
+
+    return [
             {'band_name': 'roughness_length', 'band_data': z_OM},
             {'band_name': 'zero_plane_displacement', 'band_data': d_0}
     ]
 
+
+@click.command()
+@click.option('--lai_map', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--landcover_params_map', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--soil_roughness', required=True, type=click.FLOAT)
+@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@cache_utils.cached_stage(['lai_map', 'landcover_params_map'], ['output_file'])
+def main(lai_map, landcover_params_map, soil_roughness, output_file):
+    
+    lai, geo_coding = su.read_snappy_product(lai_map, 'lai', dtype=np.float32)
+    params = su.read_snappy_bands(landcover_params_map, ['veg_height', 'veg_height_width_ratio',
+                                                         'veg_fractional_cover',
+                                                         'igbp_classification'],
+                                  dtype={'veg_height': np.float32,
+                                         'veg_height_width_ratio': np.float32,
+                                         'veg_fractional_cover': np.float32,
+                                         'igbp_classification': None})[0]
+    height = params['veg_height']
+    height_width_ratio = params['veg_height_width_ratio']
+    fractional_cover = params['veg_fractional_cover']
+    classification = params['igbp_classification']
+    params = None
+
+    band_data = calc_aerodynamic_roughness(lai, height, height_width_ratio, fractional_cover,
+                                           classification, soil_roughness)
+
     su.write_snappy_product(output_file, band_data, 'aerodynamicRoughness', geo_coding)
 
 if __name__ == "__main__":
@@ -0,0 +1,489 @@
+"""
+Benchmark the Sen-ET processing scripts on synthetic scenes.
+
+For each requested scene size a synthetic scene is generated (see synthetic_scene.py) and every
+processing script is run on it in a separate process, in the order of the processing chain. Key
+inner functions are also timed on their own, some of them together with a reference copy of
+the code they replaced, run on the same inputs to report the speedup. Wall time, throughput,
+speedup and peak resident memory are saved to a JSON report, so that results of different
+versions can be compared.
+
+The download and search scripts (ecmwf_data_download, sentinel_data_download and
+find_sentinel_images) need remote services and are not benchmarked.
+"""
+
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from queue import Empty
+
+import click
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import synthetic_scene as ss
+
+LOOKUP_TABLE = os.path.join(REPO_DIR, 'auxdata', 'LUT', 'ESA_CCI_LUT.csv')
+DATE_TIME_UTC = datetime.datetime(2019, 7, 1, 10, 30)
+TIME_ZONE = 1
+
+
+def _stages(files, out):
+    # Processing scripts with their command line arguments, in the order of the chain
+    date_time = DATE_TIME_UTC.strftime('%Y-%m-%d %H:%M')
+    return [
+        ('leaf_spectra', ['--biophysical_file', files['biophysical'],
+                          '--output_file', out['lsp']]),
+        ('frac_green', ['--sza_file', files['sun_zenith'],
+                        '--biophysical_file', files['biophysical'],
+                        '--min_frac_green', '0.01',
+                        '--output_file', out['fgv']]),
+        ('structural_params', ['--landcover_map', files['landcover'],
+                               '--lai_map', files['biophysical'],
+                               '--fgv_map', out['fgv'],
+                               '--landcover_band', ss.LANDCOVER_BAND,
+                               '--lookup_table', LOOKUP_TABLE,
+                               '--produce_vh', 'true', '--produce_fc', 'true',
+                               '--produce_chwr', 'true', '--produce_lw', 'true',
+                               '--produce_lid', 'true', '--produce_igbp', 'true',
+                               '--output_file', out['csp']]),
+        ('aerodynamic_roughness', ['--lai_map', files['biophysical'],
+                                   '--landcover_params_map', out['csp'],
+                                   '--soil_roughness', '0.01',
+                                   '--output_file', out['ar']]),
+        ('surface_parameters', ['--biophysical_file', files['biophysical'],
+                                '--sza_file', files['sun_zenith'],
+                                '--landcover_map', files['landcover'],
+                                '--landcover_band', ss.LANDCOVER_BAND,
+                                '--lookup_table', LOOKUP_TABLE,
+                                '--min_frac_green', '0.01',
+                                '--soil_roughness', '0.01',
+                                '--output_file', out['sp']]),
+        ('ecmwf_data_preparation', ['--elevation_map', files['elevation'],
+                                    '--elevation_band', ss.ELEVATION_BAND,
+                                    '--ecmwf_data_file', files['era5'],
+                                    '--date_time_utc', date_time,
+                                    '--time_zone', str(TIME_ZONE),
+                                    '--prepare_temperature', 'true',
+                                    '--prepare_vapour_pressure', 'true',
+                                    '--prepare_air_pressure', 'true',
+                                    '--prepare_wind_speed', 'true',
+                                    '--prepare_clear_sky_solar_radiation', 'true',
+                                    '--prepare_daily_solar_irradiance', 'true',
+                                    '--output_file', out['mi']]),
+        ('longwave_irradiance', ['--meteo_product', out['mi'],
+                                 '--at_band', 'air_temperature',
+                                 '--vp_band', 'vapour_pressure',
+                                 '--ap_band', 'air_pressure',
+                                 '--at_height', '100',
+                                 '--output_file', out['li']]),
+        ('net_shortwave_radiation', ['--lsp_product', out['lsp'],
+                                     '--lai_product', files['biophysical'],
+                                     '--csp_product', out['csp'],
+                                     '--mi_product', out['mi'],
+                                     '--sza_product', files['lst_geometry'],
+                                     '--soil_ref_vis', '0.15',
+                                     '--soil_ref_nir', '0.25',
+                                     '--output_file', out['nsr']]),
+        ('energy_fluxes', ['--lst', files['lst'],
+                           '--lst_vza', files['lst_geometry'],
+                           '--lai', files['biophysical'],
+                           '--csp', out['csp'],
+                           '--fgv', out['fgv'],
+                           '--ar', out['ar'],
+                           '--mi', out['mi'],
+                           '--nsr', out['nsr'],
+                           '--li', out['li'],
+                           '--mask', files['mask'],
+                           '--soil_roughness', '0.01',
+                           '--alpha_pt', '1.26',
+                           '--atmospheric_measurement_height', '100',
+                           '--green_vegetation_emissivity', '0.98',
+                           '--soil_emissivity', '0.95',
+                           '--save_component_fluxes', 'true',
+                           '--save_component_temperature', 'true',
+                           '--save_aerodynamic_parameters', 'true',
+                           '--output_file', out['ief']]),
+        ('daily_evapotranspiration', ['--ief_file', out['ief'],
+                                      '--mi_file', out['mi'],
+                                      '--output_file', out['et']]),
+        ('warp_to_template', ['--source', files['s3_lst'],
+                              '--template', files['biophysical'],
+                              '--resample_algorithm', 'cubicspline',
+                              '--output', out['warped']]),
+        ('data_mining_sharpener', ['--sentinel_2_reflectance', files['reflectance'],
+                                   '--sentinel_3_lst', files['s3_lst'],
+                                   '--high_res_dem', files['elevation'],
+                                   '--high_res_geom', files['geometry'],
+                                   '--lst_quality_mask', files['s3_lst_mask'],
+                                   '--date_time_utc', date_time,
+                                   '--elevation_band', ss.ELEVATION_BAND,
+                                   '--lst_good_quality_flags', '1',
+                                   '--cv_homogeneity_threshold', '0',
+                                   '--moving_window_size', '3',
+                                   '--parallel_jobs', '1',
+                                   '--output', out['sharpened']]),
+        ('sen_et_pipeline', ['--biophysical_file', files['biophysical'],
+                             '--sun_zenith_file', files['sun_zenith'],
+                             '--landcover_map', files['landcover'],
+                             '--landcover_band', ss.LANDCOVER_BAND,
+                             '--lookup_table', LOOKUP_TABLE,
+                             '--elevation_map', files['elevation'],
+                             '--elevation_band', ss.ELEVATION_BAND,
+                             '--ecmwf_data_file', files['era5'],
+                             '--date_time_utc', date_time,
+                             '--time_zone', str(TIME_ZONE),
+                             '--lst', files['lst'],
+                             '--lst_vza', files['lst_geometry'],
+                             '--lst_sza', files['lst_geometry'],
+                             '--mask', files['mask'],
+                             '--min_frac_green', '0.01',
+                             '--soil_roughness', '0.01',
+                             '--soil_ref_vis', '0.15',
+                             '--soil_ref_nir', '0.25',
+                             '--alpha_pt', '1.26',
+                             '--atmospheric_measurement_height', '100',
+                             '--green_vegetation_emissivity', '0.98',
+                             '--soil_emissivity', '0.95',
+                             '--fluxes_output_file', out['pipeline_ief'],
+                             '--daily_et_output_file', out['pipeline_et']]),
+    ]
+
+
+def _output_files(output_dir):
+    names = ['lsp', 'fgv', 'csp', 'ar', 'sp', 'mi', 'li', 'nsr', 'ief', 'et', 'warped', 'sharpened',
+             'pipeline_ief', 'pipeline_et']
+    return {name: os.path.join(output_dir, name + '.dim') for name in names}
+
+
+def run_script(script, args):
+    """Run a processing script in its own process.
+
+    Returns the wall time (s) and peak resident memory (MB) of the process.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, script + '.py')] + args,
+                            cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    # Read the output before waiting, so that the process cannot block on a full pipe
+    output = proc.stdout.read().decode(errors='replace')
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall_time = time.perf_counter() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    proc.stdout.close()
+    # The scripts report errors on stdout instead of through their exit code
+    if proc.returncode != 0 or 'ERROR:' in output:
+        raise RuntimeError("%s failed:\n%s" % (script, output))
+    # ru_maxrss is in kilobytes on Linux
+    return wall_time, usage.ru_maxrss / 1024.0
+
+
+# Inner functions. Each benchmark prepares its inputs, and returns the function to time together
+# with the number of pixels it processes.
+
+def _bench_calc_energy_fluxes(files, out):
+    import snappy_utils as su
+    import energy_fluxes
+    inputs = {}
+
+    def read(path, names, keys):
+        bands = su.read_dimap_bands(path, names)[0]
+        for name, key in zip(names, keys):
+            inputs[key] = np.array(bands[name], np.float32)
+
+    read(files['lst'], ['sharpened_LST'], ['lst'])
+    read(files['lst_geometry'], ['sat_zenith_tn'], ['vza'])
+    read(files['biophysical'], ['lai'], ['lai'])
+    read(out['csp'], ['veg_inclination_distribution', 'veg_fractional_cover',
+                      'veg_height_width_ratio', 'veg_leaf_width', 'veg_height'],
+         ['lad', 'frac_cover', 'h_w_ratio', 'leaf_width', 'veg_height'])
+    read(out['fgv'], ['frac_green'], ['frac_green'])
+    read(out['ar'], ['roughness_length', 'zero_plane_displacement'], ['z_0M', 'd_0'])
+    read(out['mi'], ['air_temperature', 'wind_speed', 'vapour_pressure', 'air_pressure'],
+         ['ta', 'u', 'ea', 'p'])
+    read(out['nsr'], ['net_shortwave_radiation_canopy', 'net_shortwave_radiation_soil'],
+         ['shortwave_rad_c', 'shortwave_rad_s'])
+    read(out['li'], ['longwave_irradiance'], ['longwave_irrad'])
+    read(files['mask'], ['mask'], ['mask'])
+
+    def run():
+        energy_fluxes.calc_energy_fluxes(inputs, 0.01, 1.26, 100.0, 0.98, 0.95)
+    return run, inputs['lai'].size
+
+
+def _bench_get_ecmwf_temp_interp_data(files, out):
+    import netCDF4
+    import ecmwf_utils as eu
+    with netCDF4.Dataset(files['era5']) as fid:
+        shape = fid.variables['t2m'].shape
+
+    def run():
+        eu._getECMWFTempInterpData(files['era5'], 't2m', 34, 35, 0.5)
+    return run, shape[1] * shape[2]
+
+
+def _bracketing_dates(date_list, target_date):
+    # Copy of ecmwf_utils._bracketing_dates as it was before the time axis was indexed
+    date_list = list(date_list)
+    try:
+        before = max([x for x in date_list if (target_date - x).total_seconds() >= 0])
+        after = min([x for x in date_list if (target_date - x).total_seconds() <= 0])
+    except ValueError:
+        return None, None, np.nan
+    if before == after:
+        frac = 1
+    else:
+        frac = float((after - target_date).total_seconds())/float((after-before).total_seconds())
+    return date_list.index(before), date_list.index(after), frac
+
+
+def _reference_get_ecmwf_integrated_data(ncfile, var_name, date_time, time_window=24):
+    # Copy of ecmwf_utils._getECMWFIntegratedData as it was before the windowed, sliced reads,
+    # which decodes the time axis and reads and unpacks the time steps one GDAL band at a time
+    import netCDF4
+    from osgeo import gdal, osr
+
+    fid = netCDF4.Dataset(ncfile, 'r')
+    time = fid.variables['time']
+    dates = netCDF4.num2date(time[:], time.units, time.calendar)
+    del fid
+
+    date_0, _, _ = _bracketing_dates(dates, date_time)
+    date_1, _, _ = _bracketing_dates(dates, date_time + datetime.timedelta(hours=time_window))
+
+    ds = gdal.Open('NETCDF:"'+ncfile+'":'+var_name)
+    if ds is None:
+        raise RuntimeError("Variable %s does not exist in file %s." % (var_name, ncfile))
+    scale = ds.GetRasterBand(date_0+1).GetScale()
+    offset = ds.GetRasterBand(date_0+1).GetOffset()
+    no_data_value = ds.GetRasterBand(date_0+1).GetNoDataValue()
+    gt = ds.GetGeoTransform()
+    sr = osr.SpatialReference()
+    sr.ImportFromEPSG(4326)
+    proj = sr.ExportToWkt()
+
+    data_ref = 0
+    cummulated_value = 0.
+    for date_i in range(date_0+1, date_1+1):
+        data = ds.GetRasterBand(date_i+1).ReadAsArray()
+        data = (data.astype(float) * scale) + offset
+        data[data == no_data_value] = 0
+        cummulated_value += (data - data_ref)
+    ds = None
+
+    cummulated_value = cummulated_value / (time_window * 3600.)
+    return cummulated_value, gt, proj
+
+
+def _continental_era5(files):
+    # A continental extent, as downloaded once and reused for many tiles, with three days of
+    # hourly data
+    era5 = os.path.join(os.path.dirname(files['era5']), 'era5_continental.nc')
+    if not os.path.exists(era5):
+        ss._write_era5(era5, [(-10, 35), (30, 35), (30, 70), (-10, 70)], DATE_TIME_UTC)
+    return era5
+
+
+def _bench_integrated_data(get_integrated_data, files):
+    import netCDF4
+    era5 = _continental_era5(files)
+    with netCDF4.Dataset(era5) as fid:
+        shape = fid.variables['ssrd'].shape
+    days = [DATE_TIME_UTC - datetime.timedelta(days=1), DATE_TIME_UTC]
+
+    def run():
+        for day in days:
+            midnight = datetime.datetime.combine(day.date(), datetime.time())
+            get_integrated_data(era5, 'ssrd', midnight, time_window=24)
+    return run, shape[1] * shape[2] * len(days)
+
+
+def _bench_get_ecmwf_integrated_data(files, out):
+    import ecmwf_utils as eu
+    return _bench_integrated_data(eu._getECMWFIntegratedData, files)
+
+
+def _bench_get_ecmwf_integrated_data_reference(files, out):
+    return _bench_integrated_data(_reference_get_ecmwf_integrated_data, files)
+
+
+def _bench_incidence_angle_tilted(files, out):
+    import snappy_utils as su
+    import data_mining_sharpener as dms
+    geometry = su.read_dimap_bands(files['geometry'], ['latitude_tx', 'longitude_tx'])[0]
+    lat = np.array(geometry['latitude_tx'], np.float32)
+    lon = np.array(geometry['longitude_tx'], np.float32)
+    slope = ss._smooth_field(lat.shape[0], 10, 0.0, 20.0)
+    aspect = ss._smooth_field(lat.shape[0], 11, 0.0, 360.0)
+    doy = DATE_TIME_UTC.timetuple().tm_yday
+    ftime = DATE_TIME_UTC.hour + DATE_TIME_UTC.minute / 60.0
+
+    def run():
+        dms.incidence_angle_tilted(lat, lon, doy, ftime, stdlon=0, A_ZS=aspect, slope=slope)
+    return run, lat.size
+
+
+def _bench_calc_structural_params(files, out):
+    import snappy_utils as su
+    import structural_params as sp
+    landcover = su.read_dimap_bands(files['landcover'], [ss.LANDCOVER_BAND])[0]
+    landcover = np.array(landcover[ss.LANDCOVER_BAND], np.float32)
+    lai = np.array(su.read_dimap_bands(files['biophysical'], ['lai'])[0]['lai'], np.float32)
+    fg = np.ones(lai.shape, np.float32)
+    lut = sp.read_lookup_table(LOOKUP_TABLE)
+
+    def run():
+        sp.calc_structural_params(landcover, lai, fg, lut, True, True, True, True, True, True)
+    return run, landcover.size
+
+
+INNER_BENCHMARKS = [
+    ('energy_fluxes.calc_energy_fluxes', _bench_calc_energy_fluxes),
+    ('ecmwf_utils._getECMWFTempInterpData', _bench_get_ecmwf_temp_interp_data),
+    ('ecmwf_utils._getECMWFIntegratedData', _bench_get_ecmwf_integrated_data),
+    ('reference._getECMWFIntegratedData', _bench_get_ecmwf_integrated_data_reference),
+    ('data_mining_sharpener.incidence_angle_tilted', _bench_incidence_angle_tilted),
+    ('structural_params.calc_structural_params', _bench_calc_structural_params),
+]
+
+
+# Inner benchmarks and the reference copies of the code they replaced, which are run on the
+# same inputs so that the speedup is reported
+SPEEDUP_REFERENCES = {'ecmwf_utils._getECMWFIntegratedData': 'reference._getECMWFIntegratedData'}
+
+
+def _run_inner_benchmark(benchmark, files, out, queue):
+    try:
+        run, pixels = benchmark(files, out)
+        start = time.perf_counter()
+        run()
+        wall_time = time.perf_counter() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        queue.put((wall_time, pixels, peak_rss, None))
+    except Exception as e:
+        queue.put((None, None, None, repr(e)))
+
+
+def run_inner_benchmark(benchmark, files, out):
+    """Time an inner function in a fresh process.
+
+    Returns the wall time (s) of the function call, the number of processed pixels and the peak
+    resident memory (MB) of the process, which includes preparing the inputs.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_inner_benchmark, args=(benchmark, files, out, queue))
+    proc.start()
+    # A process killed by the system, e.g. when out of memory, or crashing in native code never
+    # puts its result, so it is waited for only while the process is alive
+    while True:
+        try:
+            wall_time, pixels, peak_rss, error = queue.get(timeout=1)
+            break
+        except Empty:
+            if not proc.is_alive():
+                proc.join()
+                try:
+                    wall_time, pixels, peak_rss, error = queue.get(timeout=1)
+                    break
+                except Empty:
+                    raise RuntimeError('Benchmark process exited with code %s without a result'
+                                       % proc.exitcode)
+    proc.join()
+    if error is not None:
+        raise RuntimeError(error)
+    return wall_time, pixels, peak_rss
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def _result(name, kind, size, pixels, wall_time, peak_rss, error=None):
+    result = {'name': name, 'kind': kind, 'scene_size': size, 'pixels': pixels,
+              'wall_time_s': wall_time, 'pixels_per_s': None, 'peak_rss_mb': peak_rss,
+              'speedup': None, 'error': error}
+    if wall_time:
+        result['pixels_per_s'] = pixels / wall_time
+    return result
+
+
+@click.command()
+@click.option('--sizes', default='1000', help='Comma separated scene sizes, in pixels per side.')
+@click.option('--work_dir', required=True, type=click.Path(file_okay=False),
+              help='Directory where the synthetic scenes and the outputs are saved.')
+@click.option('--report_file', required=True, type=click.Path(dir_okay=False),
+              help='JSON file the results are saved to.')
+@click.option('--stages', default=None,
+              help='Comma separated names of the scripts to run. All are run by default.')
+@click.option('--skip_inner', is_flag=True, help='Do not benchmark the inner functions.')
+def main(sizes, work_dir, report_file, stages, skip_inner):
+    if stages is not None:
+        stages = stages.split(',')
+    report = {'created': datetime.datetime.utcnow().isoformat(),
+              'git_revision': _git_revision(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'results': []}
+
+    for size in [int(s) for s in sizes.split(',')]:
+        scene_dir = os.path.join(work_dir, 'scene_%d' % size)
+        print('INFO: Generating %d x %d pixel scene...' % (size, size))
+        files = ss.generate_scene(scene_dir, size, DATE_TIME_UTC)
+        out = _output_files(os.path.join(scene_dir, 'outputs'))
+        pixels = size * size
+
+        for script, args in _stages(files, out):
+            if stages is not None and script not in stages:
+                continue
+            try:
+                wall_time, peak_rss = run_script(script, args)
+                result = _result(script, 'script', size, pixels, wall_time, peak_rss)
+            except RuntimeError as e:
+                result = _result(script, 'script', size, pixels, None, None, str(e))
+            report['results'].append(result)
+            print('%-45s %6d %10s s %10s MB' % (script, size, result['wall_time_s'],
+                                                  result['peak_rss_mb']))
+
+        if skip_inner:
+            continue
+        for name, benchmark in INNER_BENCHMARKS:
+            try:
+                wall_time, bench_pixels, peak_rss = run_inner_benchmark(benchmark, files, out)
+                result = _result(name, 'function', size, bench_pixels, wall_time, peak_rss)
+            except RuntimeError as e:
+                result = _result(name, 'function', size, None, None, None, str(e))
+            report['results'].append(result)
+            print('%-45s %6d %10s s %10s MB' % (name, size, result['wall_time_s'],
+                                                  result['peak_rss_mb']))
+
+        results = {r['name']: r for r in report['results']
+                   if r['kind'] == 'function' and r['scene_size'] == size}
+        for name, reference in SPEEDUP_REFERENCES.items():
+            if name in results and reference in results and \
+                    results[name]['wall_time_s'] and results[reference]['wall_time_s']:
+                speedup = results[reference]['wall_time_s'] / results[name]['wall_time_s']
+                results[name]['speedup'] = speedup
+                print('%-45s %6d %10.2f x faster than %s' % (name, size, speedup, reference))
+
+    with open(report_file, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Measure the start-up time of the command line entry points.
+
+Each entry point module is imported in a fresh Python interpreter, which is the time it takes
+for a script to start before it does any work. SNAP/snappy is only started when the first
+product is opened, so none of the entry points should pay for the JVM start-up here.
+"""
+
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def entry_points():
+    # Every script with a shell wrapper is an entry point
+    return sorted(os.path.splitext(os.path.basename(f))[0]
+                  for f in glob.glob(os.path.join(REPO_DIR, "*.sh")))
+
+
+def time_import(module, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", "import " + module], cwd=REPO_DIR,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError("Importing %s failed:\n%s" % (module, result.stderr.decode()))
+    return times
+
+
+@click.command()
+@click.option('--repeats', default=5, type=click.IntRange(1),
+              help='Number of times each entry point is started.')
+@click.option('--max_seconds', default=None, type=click.FLOAT,
+              help='Fail if the median start-up time of any entry point exceeds this.')
+@click.option('--output_file', default=None, type=click.Path(dir_okay=False),
+              help='Save the results to this JSON file.')
+def main(repeats, max_seconds, output_file):
+    results = {}
+    for module in entry_points():
+        times = sorted(time_import(module, repeats))
+        results[module] = {'median_s': times[len(times) // 2], 'min_s': times[0],
+                           'max_s': times[-1], 'repeats': repeats}
+        print("%-30s %8.3f s" % (module, results[module]['median_s']))
+
+    if output_file:
+        with open(output_file, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if max_seconds is not None:
+        slow = [m for m, r in results.items() if r['median_s'] > max_seconds]
+        if slow:
+            raise click.ClickException("Start-up slower than %.2f s: %s" %
+                                       (max_seconds, ", ".join(slow)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Generate a synthetic, but physically plausible, Sen-ET scene.
+
+All high-resolution products are on a 10 m UTM grid of the requested size and are written as
+BEAM-DIMAP, together with a low-resolution Sentinel-3 like LST product and an ERA5 like NetCDF
+file covering the scene. The products have the band names expected by the processing scripts, so
+the whole chain can be run on them.
+"""
+
+import datetime
+import os
+import sys
+
+import click
+import numpy as np
+import netCDF4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# gdal_utils sets up the GDAL environment, so it has to be imported before osr
+import gdal_utils
+from osgeo import osr
+import snappy_utils as su
+
+# WGS 84 / UTM zone 32N and the upper-left corner of the scene
+EPSG = 32632
+UL_X = 500000.0
+UL_Y = 5000040.0
+PIXEL_SIZE = 10.0
+LST_PIXEL_SIZE = 1000.0
+
+# Land cover classes present in the ESA CCI look-up table
+CCI_CLASSES = [10, 11, 12, 20, 30, 40, 50, 60, 61, 62, 70, 80, 90, 100, 110, 120, 130, 150,
+               180, 190, 200, 210]
+
+LANDCOVER_BAND = 'land_cover_CCILandCover-2015'
+ELEVATION_BAND = 'elevation'
+
+# ERA5 fields with (minimum, maximum) of the generated values
+ERA5_FIELDS = {'t2m': (285.0, 300.0),
+               'd2m': (275.0, 285.0),
+               'sp': (95000.0, 102000.0),
+               'z': (0.0, 5000.0),
+               'u100': (-8.0, 8.0),
+               'v100': (-8.0, 8.0),
+               'ssrdc': (0.0, 3.2e6),
+               'ssrd': (0.0, 3.0e6)}
+
+
+def _crs_wkt():
+    sr = osr.SpatialReference()
+    sr.ImportFromEPSG(EPSG)
+    return sr.ExportToWkt()
+
+
+def _geo_coding(size, pixel_size=PIXEL_SIZE):
+    return su.DimapGeoCoding(_crs_wkt(), (UL_X, pixel_size, 0.0, UL_Y, 0.0, -pixel_size),
+                             size, size)
+
+
+def _smooth_field(size, seed, low=0.0, high=1.0):
+    # Sum of a few low-frequency waves, scaled to [low, high]
+    rng = np.random.RandomState(seed)
+    coords = np.linspace(0, 2 * np.pi, size, dtype=np.float32)
+    field = np.zeros((size, size), np.float32)
+    for _ in range(3):
+        fx, fy = rng.uniform(0.5, 4, 2)
+        px, py = rng.uniform(0, 2 * np.pi, 2)
+        field += np.sin(fx * coords + px)[np.newaxis, :] * np.cos(fy * coords + py)[:, np.newaxis]
+    field -= field.min()
+    field /= max(field.max(), 1e-6)
+    return low + field * (high - low)
+
+
+def _write_product(file_path, product_name, band_generators, geo_coding):
+    # Bands are generated and written one by one to keep the memory use at one band
+    bands = [{'band_name': name} for name in band_generators]
+    product = su.create_snappy_product(file_path, bands, product_name, geo_coding,
+                                       geo_coding.width, geo_coding.height)
+    rect = su.Rect(0, 0, geo_coding.width, geo_coding.height)
+    for name, generator in band_generators.items():
+        su.write_snappy_tile(product, name, rect, generator())
+    product.closeIO()
+    return os.path.splitext(file_path)[0] + '.dim'
+
+
+def _scene_lat_lon_bounds(size):
+    sr_utm = osr.SpatialReference()
+    sr_utm.ImportFromEPSG(EPSG)
+    sr_geo = osr.SpatialReference()
+    sr_geo.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        sr_geo.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(sr_utm, sr_geo)
+    extent = size * PIXEL_SIZE
+    corners = [transform.TransformPoint(UL_X + dx, UL_Y - dy)[:2]
+               for dx in (0, extent) for dy in (0, extent)]
+    # Corners are ordered UL, LL, UR, LR as (lon, lat)
+    return corners
+
+
+def _lat_lon(size, corners):
+    # Bilinear interpolation between the corners is accurate enough for a synthetic scene
+    t = np.linspace(0, 1, size, dtype=np.float32)
+    tx, ty = t[np.newaxis, :], t[:, np.newaxis]
+    (ul, ll, ur, lr) = [np.array(c, np.float32) for c in corners]
+
+    def interp(i):
+        return ((1 - tx) * (1 - ty) * ul[i] + (1 - tx) * ty * ll[i] + tx * (1 - ty) * ur[i]
+                + tx * ty * lr[i])
+    return interp(1), interp(0)
+
+
+def _write_era5(file_path, corners, date_time_utc):
+    lons = [c[0] for c in corners]
+    lats = [c[1] for c in corners]
+    lon = np.arange(np.floor(min(lons)) - 1, np.ceil(max(lons)) + 1.01, 0.25)
+    lat = np.arange(np.ceil(max(lats)) + 1, np.floor(min(lats)) - 1.01, -0.25)
+    start = datetime.datetime.combine(date_time_utc.date(), datetime.time()) - \
+        datetime.timedelta(days=1)
+    times = [start + datetime.timedelta(hours=h) for h in range(72)]
+
+    fid = netCDF4.Dataset(file_path, 'w', format='NETCDF3_64BIT_OFFSET')
+    fid.createDimension('longitude', len(lon))
+    fid.createDimension('latitude', len(lat))
+    fid.createDimension('time', None)
+    var = fid.createVariable('longitude', 'f4', ('longitude',))
+    var.units = 'degrees_east'
+    var[:] = lon
+    var = fid.createVariable('latitude', 'f4', ('latitude',))
+    var.units = 'degrees_north'
+    var[:] = lat
+    var = fid.createVariable('time', 'i4', ('time',))
+    var.units = 'hours since 1900-01-01 00:00:00.0'
+    var.calendar = 'gregorian'
+    var[:] = netCDF4.date2num(times, var.units, var.calendar)
+
+    hours = np.array([t.hour for t in times], np.float32)
+    # Accumulated radiation follows the sun, other fields have a weak diurnal cycle
+    daylight = np.clip(np.sin((hours - 6) / 12 * np.pi), 0, None)
+    for seed, (name, (low, high)) in enumerate(sorted(ERA5_FIELDS.items())):
+        var = fid.createVariable(name, 'i2', ('time', 'latitude', 'longitude'),
+                                 fill_value=-32767)
+        # Pack the data as in ERA5 files downloaded from the CDS
+        var.scale_factor = (high - low) / 60000.0
+        var.add_offset = (high + low) / 2.0
+        var.missing_value = -32767
+        spatial = _smooth_field(max(len(lat), len(lon)), seed)[:len(lat), :len(lon)]
+        for i in range(len(times)):
+            if name in ('ssrd', 'ssrdc'):
+                weight = daylight[i]
+            else:
+                weight = 0.8 + 0.2 * daylight[i]
+            var[i, :, :] = low + (high - low) * weight * spatial
+    fid.close()
+    return file_path
+
+
+def generate_scene(output_dir, size, date_time_utc):
+    """Write all input products of the Sen-ET chain for a size x size pixel scene.
+
+    Returns a dictionary with the paths of the generated products.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    geo_coding = _geo_coding(size)
+    files = {}
+
+    lai = _smooth_field(size, 1, -0.5, 6.0)
+    lai = np.maximum(lai, 0)
+
+    files['biophysical'] = _write_product(
+        os.path.join(output_dir, 'biophysical.dim'), 'biophysical',
+        {'lai': lambda: lai,
+         'fapar': lambda: 0.95 * (1 - np.exp(-0.5 * lai)),
+         'lai_cab': lambda: lai * 40.0,
+         'lai_cw': lambda: lai * 0.015},
+        geo_coding)
+    files['sun_zenith'] = _write_product(
+        os.path.join(output_dir, 'sun_zenith.dim'), 'sunZenith',
+        {'sun_zenith': lambda: _smooth_field(size, 2, 29.0, 31.0)}, geo_coding)
+
+    def landcover():
+        classes = np.array(CCI_CLASSES, np.float32)
+        index = (_smooth_field(size, 3) * (len(classes) - 1)).round().astype(np.int32)
+        return classes[index]
+    files['landcover'] = _write_product(
+        os.path.join(output_dir, 'landcover.dim'), 'landcover',
+        {LANDCOVER_BAND: landcover}, geo_coding)
+    files['elevation'] = _write_product(
+        os.path.join(output_dir, 'elevation.dim'), 'elevation',
+        {ELEVATION_BAND: lambda: _smooth_field(size, 4, 0.0, 500.0)}, geo_coding)
+    files['lst'] = _write_product(
+        os.path.join(output_dir, 'sharpened_lst.dim'), 'sharpenedLST',
+        {'sharpened_LST': lambda: 315.0 - 3.0 * lai + _smooth_field(size, 5, -2.0, 2.0)},
+        geo_coding)
+    files['lst_geometry'] = _write_product(
+        os.path.join(output_dir, 'lst_geometry.dim'), 'geometry',
+        {'sat_zenith_tn': lambda: _smooth_field(size, 6, 0.0, 50.0),
+         'solar_zenith_tn': lambda: _smooth_field(size, 7, 29.0, 31.0)},
+        geo_coding)
+    files['mask'] = _write_product(
+        os.path.join(output_dir, 'mask.dim'), 'mask',
+        {'mask': lambda: (_smooth_field(size, 8) < 0.8).astype(np.float32)}, geo_coding)
+    files['reflectance'] = _write_product(
+        os.path.join(output_dir, 'reflectance.dim'), 'reflectance',
+        {'B2': lambda: 0.05 + 0.02 * np.exp(-lai),
+         'B3': lambda: 0.08 + 0.02 * np.exp(-lai),
+         'B4': lambda: 0.04 + 0.10 * np.exp(-lai),
+         'B8': lambda: 0.20 + 0.25 * (1 - np.exp(-0.5 * lai))},
+        geo_coding)
+
+    corners = _scene_lat_lon_bounds(size)
+    files['geometry'] = _write_product(
+        os.path.join(output_dir, 'high_res_geometry.dim'), 'geometry',
+        {'latitude_tx': lambda: _lat_lon(size, corners)[0],
+         'longitude_tx': lambda: _lat_lon(size, corners)[1]},
+        geo_coding)
+
+    # Low resolution Sentinel-3 like LST and its quality mask
+    lst_size = max(int(np.ceil(size * PIXEL_SIZE / LST_PIXEL_SIZE)), 2)
+    lst_geo_coding = _geo_coding(lst_size, LST_PIXEL_SIZE)
+    files['s3_lst'] = _write_product(
+        os.path.join(output_dir, 's3_lst.dim'), 'S3LST',
+        {'LST': lambda: _smooth_field(lst_size, 9, 300.0, 312.0)}, lst_geo_coding)
+    files['s3_lst_mask'] = _write_product(
+        os.path.join(output_dir, 's3_lst_mask.dim'), 'S3LSTMask',
+        {'mask': lambda: np.ones((lst_size, lst_size), np.float32)}, lst_geo_coding)
+
+    files['era5'] = _write_era5(os.path.join(output_dir, 'era5.nc'), corners, date_time_utc)
+
+    return files
+
+
+@click.command()
+@click.option('--output_dir', required=True, type=click.Path(file_okay=False))
+@click.option('--size', required=True, type=click.IntRange(10),
+              help='Width and height of the scene in 10 m pixels.')
+@click.option('--date_time_utc', default='2019-07-01 10:30',
+              type=click.DateTime(formats=['%Y-%m-%d %H:%M']))
+def main(output_dir, size, date_time_utc):
+    files = generate_scene(output_dir, size, date_time_utc)
+    for name, path in sorted(files.items()):
+        print("%-15s %s" % (name, path))
+
+
+if __name__ == "__main__":
+    main()
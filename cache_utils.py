@@ -0,0 +1,239 @@
+"""
+Content-addressed cache of the outputs of the processing stages.
+
+The cache is enabled by setting the SEN_ET_CACHE_DIR environment variable to a directory, and
+its size is limited to SEN_ET_CACHE_SIZE_GB gigabytes (50 by default), evicting the least
+recently used results first. A stage is identified by a key computed from the fingerprints of
+its input files, the values of its other parameters and the source code of the scripts. When
+a stage is run with a key which is already in the cache, its outputs are copied from the
+cache instead of being recomputed. Outputs are copied rather than hard-linked, so that a stage
+or a user writing into an output file in place never modifies the cached entry.
+"""
+
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+
+
+CACHE_DIR_VARIABLE = 'SEN_ET_CACHE_DIR'
+CACHE_SIZE_VARIABLE = 'SEN_ET_CACHE_SIZE_GB'
+DEFAULT_CACHE_SIZE_GB = 50.0
+
+# Files up to this size are fingerprinted by their whole contents, larger ones by their size,
+# modification time and the contents of their first FINGERPRINT_HEAD_SIZE bytes
+FULL_HASH_MAX_SIZE = 16 * 1024 * 1024
+FINGERPRINT_HEAD_SIZE = 1024 * 1024
+
+MANIFEST_FILE = 'manifest.json'
+
+_code_version = None
+
+
+def _hash_file(sha, file_path, size=None):
+    with open(file_path, 'rb') as fp:
+        if size is None:
+            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                sha.update(block)
+        else:
+            sha.update(fp.read(size))
+
+
+def _file_fingerprint(sha, file_path):
+    stat = os.stat(file_path)
+    if stat.st_size <= FULL_HASH_MAX_SIZE:
+        _hash_file(sha, file_path)
+    else:
+        sha.update(('%d:%d:' % (stat.st_size, stat.st_mtime_ns)).encode())
+        _hash_file(sha, file_path, FINGERPRINT_HEAD_SIZE)
+
+
+def _product_files(file_path):
+    # A BEAM-DIMAP product is the .dim header together with the files in its .data directory.
+    # The files are named relative to the product, so that the fingerprint does not depend on
+    # its name.
+    files = [('', file_path)]
+    base, ext = os.path.splitext(file_path)
+    if ext.lower() == '.dim' and os.path.isdir(base + '.data'):
+        for root, _, names in os.walk(base + '.data'):
+            files.extend((os.path.relpath(os.path.join(root, name), base + '.data'),
+                          os.path.join(root, name)) for name in names)
+    return sorted(files)
+
+
+def fingerprint(file_path):
+    sha = hashlib.sha256()
+    for name, path in _product_files(file_path):
+        sha.update(name.encode())
+        _file_fingerprint(sha, path)
+    return sha.hexdigest()
+
+
+def _get_code_version():
+    # Results also depend on the code of the scripts, so it is part of every key
+    global _code_version
+    if _code_version is None:
+        sha = hashlib.sha256()
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                  '*.py'))):
+            _hash_file(sha, path)
+        _code_version = sha.hexdigest()
+    return _code_version
+
+
+def stage_key(stage_name, kwargs, input_files, output_files, ignored=()):
+    sha = hashlib.sha256()
+    sha.update(stage_name.encode())
+    sha.update(_get_code_version().encode())
+    for name in sorted(kwargs):
+        if name in output_files or name in ignored:
+            continue
+        if name in input_files and kwargs[name] is not None:
+            value = fingerprint(kwargs[name])
+        else:
+            value = repr(kwargs[name])
+        sha.update(('%s=%s;' % (name, value)).encode())
+    return sha.hexdigest()
+
+
+def _output_paths(file_path):
+    # Outputs written in BEAM-DIMAP format get the .dim extension whatever the given one
+    base = os.path.splitext(file_path)[0]
+    paths = [base + '.dim', base + '.data']
+    if file_path not in paths:
+        paths.insert(0, file_path)
+    return paths
+
+
+def _copy_tree(src, dst):
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _tree_mtime(path):
+    # The modification time of a directory does not change when the files in it are overwritten,
+    # so that of a .data directory is the newest of its files
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    return max([os.path.getmtime(os.path.join(root, name))
+                for root, _, names in os.walk(path) for name in names] or
+               [os.path.getmtime(path)])
+
+
+def _tree_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+class StageCache(object):
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def restore(self, key, kwargs):
+        entry = os.path.join(self.cache_dir, key)
+        manifest_path = os.path.join(entry, MANIFEST_FILE)
+        if not os.path.isfile(manifest_path):
+            return False
+        with open(manifest_path, 'r') as fp:
+            manifest = json.load(fp)
+        for name, files in manifest['outputs'].items():
+            output_dir = os.path.dirname(os.path.abspath(kwargs[name]))
+            output_base = os.path.splitext(os.path.basename(kwargs[name]))[0]
+            for cached_name, ext in files:
+                dst = os.path.join(output_dir, output_base + ext)
+                _remove(dst)
+                _copy_tree(os.path.join(entry, cached_name), dst)
+        # The modification time of an entry is its last use
+        os.utime(entry)
+        return True
+
+    def store(self, key, kwargs, output_files, start_time):
+        temp_entry = os.path.join(self.cache_dir, '%s.tmp-%d' % (key, os.getpid()))
+        _remove(temp_entry)
+        os.makedirs(temp_entry)
+        manifest = {'outputs': {}, 'created': time.time()}
+        for name in output_files:
+            files = []
+            for path in _output_paths(kwargs[name]):
+                # Only the files written by this run are outputs
+                if not os.path.exists(path) or _tree_mtime(path) < start_time:
+                    continue
+                ext = os.path.splitext(path)[1]
+                cached_name = '%s%d%s' % (name, len(files), ext)
+                _copy_tree(path, os.path.join(temp_entry, cached_name))
+                files.append([cached_name, ext])
+            manifest['outputs'][name] = files
+        with open(os.path.join(temp_entry, MANIFEST_FILE), 'w') as fp:
+            json.dump(manifest, fp)
+        entry = os.path.join(self.cache_dir, key)
+        _remove(entry)
+        os.rename(temp_entry, entry)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+                entries.append((os.path.getmtime(path), _tree_size(path), path))
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            _remove(path)
+            total_size -= size
+
+
+def get_cache():
+    cache_dir = os.environ.get(CACHE_DIR_VARIABLE)
+    if not cache_dir:
+        return None
+    max_size = float(os.environ.get(CACHE_SIZE_VARIABLE, DEFAULT_CACHE_SIZE_GB)) * 1024**3
+    return StageCache(cache_dir, max_size)
+
+
+def cached_stage(input_files, output_files, ignored=()):
+    """Cache the outputs of a stage's main function.
+
+    input_files and output_files are the names of the parameters which are paths of input and
+    output files. The parameters in ignored, such as the number of parallel processes, do not
+    change the outputs. All other parameters are part of the key by value.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(**kwargs):
+            cache = get_cache()
+            if cache is None:
+                return func(**kwargs)
+            # Scripts run as __main__, so the stage is named after the script file
+            stage_name = os.path.splitext(os.path.basename(inspect.getfile(func)))[0]
+            key = stage_key(stage_name, kwargs, input_files, output_files, ignored)
+            if cache.restore(key, kwargs):
+                print('INFO: Outputs of %s restored from the cache' % stage_name)
+                return None
+            # File system timestamps can be coarser than the clock
+            start_time = time.time() - 2
+            result = func(**kwargs)
+            cache.store(key, kwargs, output_files, start_time)
+            return result
+        return wrapper
+    return decorator
@@ -1,30 +1,45 @@
 import click
 import numpy as np
 
+import output_writers as ow
+import cache_utils
 import snappy_utils as su
 from pyTSEB import meteo_utils as met
 
 
+def calc_daily_evapotranspiration(le, sdn, sdn_24):
+
+    et_daily = met.flux_2_evaporation(sdn_24 * le / sdn, T_K=20+273.15, time_domain=24)
+
+    return [{'band_name': 'daily_evapotranspiration', 'band_data': et_daily}]
+
+
 @click.command()
 @click.option('--ief_file', required=True, type=click.Path(dir_okay=False, exists=True))
 @click.option('--mi_file', required=True, type=click.Path(dir_okay=False, exists=True))
 @click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
-def main(ief_file, mi_file, output_file):
+@click.option('--output_format', required=False, default=None,
+              type=click.Choice(ow.OUTPUT_FORMATS),
+              help='Format of the output file. By default it is taken from the file extension.')
+@cache_utils.cached_stage(['ief_file', 'mi_file'], ['output_file'])
+def main(ief_file, mi_file, output_file, output_format):
 
     # Read the required data
-    le_band, geo_coding = su.read_snappy_product(ief_file, 'latent_heat_flux')
-    le_band = le_band.astype(np.float32)
-    sdn_band = su.read_snappy_product(mi_file, 'clear_sky_solar_radiation')[0].astype(np.float32)
-    sdn_24_band = su.read_snappy_product(mi_file, 'average_daily_solar_irradiance')[0].astype(np.float32)
+    le_band, geo_coding = su.read_snappy_product(ief_file, 'latent_heat_flux', dtype=np.float32)
+    mi = su.read_snappy_bands(mi_file, ['clear_sky_solar_radiation',
+                                        'average_daily_solar_irradiance'],
+                              dtype=np.float32)[0]
+    sdn_band = mi['clear_sky_solar_radiation']
+    sdn_24_band = mi['average_daily_solar_irradiance']
+    mi = None
 
     le = np.array(le_band)
     sdn = np.array(sdn_band)
     sdn_24 = np.array(sdn_24_band)
 
-    et_daily = met.flux_2_evaporation(sdn_24 * le / sdn, T_K=20+273.15, time_domain=24)
-    
-    su.write_snappy_product(output_file, [{'band_name': 'daily_evapotranspiration', 'band_data': et_daily}],
-                            'dailySpectra', geo_coding)
+    band_data = calc_daily_evapotranspiration(le, sdn, sdn_24)
+
+    ow.write_product(output_file, band_data, 'dailySpectra', geo_coding, output_format)
 
 if __name__ == "__main__":
     try:
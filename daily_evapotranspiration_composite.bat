@@ -0,0 +1 @@
+"%~dp0\..\python.exe" "%~dp0\daily_evapotranspiration_composite.py" %*
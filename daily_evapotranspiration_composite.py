@@ -0,0 +1,149 @@
+import csv
+import os
+
+import click
+import numpy as np
+
+import daily_evapotranspiration as de
+import output_writers as ow
+import snappy_utils as su
+
+
+# Columns of the CSV file listing the inputs of each day. The ief_file column is left empty on
+# days without an overpass.
+DAY_COLUMNS = ['ief_file', 'mi_file']
+
+
+def read_days_file(days_file):
+    with open(days_file, 'r', newline='') as fp:
+        days = list(csv.DictReader(fp))
+    if len(days) == 0:
+        raise RuntimeError(days_file + " does not list any days")
+    for column in DAY_COLUMNS:
+        if column not in days[0]:
+            raise RuntimeError(f'Missing {column} column in {days_file}')
+    if any(not day['mi_file'].strip() for day in days):
+        raise RuntimeError(f'Every day in {days_file} needs a meteorological product')
+    # Relative paths are relative to the location of the CSV file
+    base_dir = os.path.dirname(os.path.abspath(days_file))
+    return [{column: os.path.join(base_dir, day[column].strip()) if day[column].strip() else None
+             for column in DAY_COLUMNS}
+            for day in days]
+
+
+class CompositeAccumulator(object):
+    # Running sum, count, minimum and maximum of the daily evapotranspiration, so that a
+    # composite of any number of days only holds one scene of each in memory.
+
+    def __init__(self, shape):
+        self.sum = np.zeros(shape, np.float64)
+        self.count = np.zeros(shape, np.uint16)
+        self.gap_filled = np.zeros(shape, np.uint16)
+        self.min = np.full(shape, np.inf, np.float32)
+        self.max = np.full(shape, -np.inf, np.float32)
+
+    def add(self, et_daily, gap_filled=False):
+        valid = np.isfinite(et_daily)
+        self.sum[valid] += et_daily[valid]
+        self.count[valid] += 1
+        if gap_filled:
+            self.gap_filled[valid] += 1
+        np.fmin(self.min, et_daily, out=self.min)
+        np.fmax(self.max, et_daily, out=self.max)
+
+    def bands(self):
+        no_days = self.count == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (self.sum / self.count).astype(np.float32)
+        total = self.sum.astype(np.float32)
+        for data in [total, mean, self.min, self.max]:
+            data[no_days] = np.nan
+        return [{'band_name': 'evapotranspiration_sum', 'band_data': total,
+                 'description': 'Total evapotranspiration of the valid days', 'unit': 'mm'},
+                {'band_name': 'evapotranspiration_mean', 'band_data': mean,
+                 'description': 'Mean daily evapotranspiration', 'unit': 'mm/day'},
+                {'band_name': 'evapotranspiration_min', 'band_data': self.min,
+                 'description': 'Minimum daily evapotranspiration', 'unit': 'mm/day'},
+                {'band_name': 'evapotranspiration_max', 'band_data': self.max,
+                 'description': 'Maximum daily evapotranspiration', 'unit': 'mm/day'},
+                {'band_name': 'valid_days', 'band_data': self.count, 'data_type': np.uint16,
+                 'description': 'Number of days with valid evapotranspiration'},
+                {'band_name': 'gap_filled_days', 'band_data': self.gap_filled,
+                 'data_type': np.uint16,
+                 'description': 'Number of valid days without overpass'}]
+
+
+def _read_meteo(mi_file):
+    mi, geo_coding = su.read_snappy_bands(mi_file, ['clear_sky_solar_radiation',
+                                                    'average_daily_solar_irradiance'],
+                                          dtype=np.float32)
+    return mi['clear_sky_solar_radiation'], mi['average_daily_solar_irradiance'], geo_coding
+
+
+def calc_composite(days, gap_fill):
+    # The days are processed in order. On a day without overpass the daily evapotranspiration
+    # is estimated from the ratio of latent heat flux to instantaneous irradiance of the
+    # latest overpass, scaled by that day's average daily solar irradiance.
+    accumulator = None
+    geo_coding = None
+    le_ratio = None
+    for day in days:
+        if day['ief_file'] is None:
+            if not gap_fill or le_ratio is None:
+                continue
+            sdn_24 = _read_meteo(day['mi_file'])[1]
+            et_daily = de.calc_daily_evapotranspiration(le_ratio, 1.0, sdn_24)[0]['band_data']
+            gap_filled = True
+        else:
+            le, geo_coding = su.read_snappy_product(day['ief_file'], 'latent_heat_flux',
+                                                    dtype=np.float32)
+            sdn, sdn_24 = _read_meteo(day['mi_file'])[:2]
+            et_daily = de.calc_daily_evapotranspiration(le, sdn, sdn_24)[0]['band_data']
+            if gap_fill:
+                # Pixels without a valid ratio on this day keep the one of an earlier overpass
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    ratio = le / sdn
+                if le_ratio is not None:
+                    ratio = np.where(np.isfinite(ratio), ratio, le_ratio)
+                le_ratio = ratio
+            gap_filled = False
+        et_daily = np.asarray(et_daily, np.float32)
+
+        if accumulator is None:
+            accumulator = CompositeAccumulator(et_daily.shape)
+        elif et_daily.shape != accumulator.sum.shape:
+            raise RuntimeError(f'The inputs of {day["mi_file"]} do not have the same size as '
+                               'those of the previous days')
+        accumulator.add(et_daily, gap_filled)
+        print('INFO: Added ' + (day['ief_file'] or day['mi_file']))
+
+    if accumulator is None:
+        raise RuntimeError("None of the days has an energy fluxes product")
+    return accumulator.bands(), geo_coding
+
+
+@click.command()
+@click.option('--days_file', required=True, type=click.Path(dir_okay=False, exists=True),
+              help='CSV file with the columns ' + ', '.join(DAY_COLUMNS) + ' and one row per '
+                   'day, in chronological order.')
+@click.option('--gap_fill', required=False, default=False, type=click.BOOL,
+              help='Estimate the evapotranspiration of the days without overpass.')
+@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@click.option('--output_format', required=False, default=None,
+              type=click.Choice(ow.OUTPUT_FORMATS),
+              help='Format of the output file. By default it is taken from the file extension.')
+def main(days_file, gap_fill, output_file, output_format):
+
+    days = read_days_file(days_file)
+
+    band_data, geo_coding = calc_composite(days, gap_fill)
+
+    ow.write_product(output_file, band_data, 'evapotranspirationComposite', geo_coding,
+                     output_format)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print("ERROR:" + str(e))
@@ -0,0 +1 @@
+"${0%/*}"/../bin/python "${0%/*}"/daily_evapotranspiration_composite.py "$@"
@@ -7,6 +7,7 @@ import os.path as pth
 from pyDMS.pyDMS import DecisionTreeSharpener
 
 import gdal_utils as gu
+import cache_utils
 import snappy_utils as su
 
 
@@ -23,6 +24,9 @@ import snappy_utils as su
 @click.option('--moving_window_size', required=True, type=click.IntRange(1))
 @click.option('--parallel_jobs', required=True, type=click.IntRange(1))
 @click.option('--output', required=True, type=click.Path(dir_okay=False, exists=False))
+@cache_utils.cached_stage(['sentinel_2_reflectance', 'sentinel_3_lst', 'high_res_dem',
+                           'high_res_geom', 'lst_quality_mask'],
+                           ['output'], ignored=['parallel_jobs'])
 def main(sentinel_2_reflectance, sentinel_3_lst, high_res_dem, high_res_geom, lst_quality_mask,
          date_time_utc, elevation_band, lst_good_quality_flags, cv_homogeneity_threshold,
          moving_window_size, parallel_jobs, output):
@@ -16,9 +16,11 @@ from ecmwf_utils import download_CDS_data
 @click.option('--download_clear_sky_solar_radiation', required=True, type=click.BOOL)
 @click.option('--download_solar_radiation', required=True, type=click.BOOL)
 @click.option('--overwrite', required=True, type=click.BOOL)
+@click.option('--workers', required=False, default=4, type=click.IntRange(1),
+              help='Number of monthly chunks of single variables downloaded at the same time.')
 def main(area, start_date, end_date, download_path, download_pressure,
          download_temperature, download_dewpoint, download_wind_speed,
-         download_clear_sky_solar_radiation, download_solar_radiation, overwrite):
+         download_clear_sky_solar_radiation, download_solar_radiation, overwrite, workers):
         fields = []
         if download_temperature:
             fields.extend(['2m_temperature', 'z', '2m_dewpoint_temperature', 'surface_pressure'])
@@ -33,7 +35,7 @@ def main(area, start_date, end_date, download_path, download_pressure,
         if download_solar_radiation:
             fields.append('surface_solar_radiation_downwards')
         
-        download_CDS_data(start_date, end_date, fields, download_path, overwrite, area)
+        download_CDS_data(start_date, end_date, fields, download_path, overwrite, area, workers)
 if __name__ == "__main__":
     try:
         main()
@@ -1,11 +1,42 @@
 import click
 import tempfile
 
+import cache_utils
 import ecmwf_utils as eu
 ## snappy_utils should be imported last, as it modifies the system path
 import snappy_utils as su
 
 
+FIELD_DESCRIPTIONS = {
+    'air_temperature': 'Air temperature at 100 m above surface(K)',
+    'vapour_pressure': 'Surface vapour pressure (mb)',
+    'air_pressure': 'Surface air pressure (mb)',
+    'wind_speed': 'Wind speed at 100 m above surface (m/s)',
+    'clear_sky_solar_radiation': 'Instantenous clear sky surface solar irradiance (W/m^2)',
+    'average_daily_solar_irradiance': 'Average daily solar irradiance (W/m^2)'}
+
+
+def prepare_meteo(elevation_file, ecmwf_data_file, date_time_utc, time_zone, prepare_temperature,
+                  prepare_vapour_pressure, prepare_air_pressure, prepare_wind_speed,
+                  prepare_clear_sky_solar_radiation, prepare_daily_solar_irradiance,
+                  multithread=True, warp_memory_limit=None):
+    # elevation_file has to be readable by GDAL since it is used as the template to which
+    # ECMWF data is resampled
+
+    requested = [prepare_temperature, prepare_vapour_pressure, prepare_air_pressure,
+                 prepare_wind_speed, prepare_clear_sky_solar_radiation,
+                 prepare_daily_solar_irradiance]
+    fields = [field for field, prepare in zip(eu.ECMWF_FIELDS, requested) if prepare]
+
+    # Calculate required meteorological parameters, reading the ECMWF file only once
+    data = eu.get_ECMWF_fields(ecmwf_data_file, fields, date_time_utc, elevation_file, time_zone,
+                               multithread, warp_memory_limit)
+    bands = [{'band_data': data[field], 'band_name': field,
+              'description': FIELD_DESCRIPTIONS[field]} for field in fields]
+
+    return bands
+
+
 @click.command()
 @click.option('--elevation_map', required=True, type=click.Path(dir_okay=False, exists=True))
 @click.option('--elevation_band', required=True)
@@ -19,9 +50,16 @@ import snappy_utils as su
 @click.option('--prepare_clear_sky_solar_radiation', required=True, type=click.BOOL)
 @click.option('--prepare_daily_solar_irradiance', required=True, type=click.BOOL)
 @click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@click.option('--multithread', required=False, default=True, type=click.BOOL,
+              help='Warp the ECMWF data onto the elevation map with multiple threads.')
+@click.option('--warp_memory_limit', required=False, default=None, type=click.IntRange(1),
+              help='Size of the working buffer of the warp in MB. By default it is set by GDAL.')
+@cache_utils.cached_stage(['elevation_map', 'ecmwf_data_file'], ['output_file'],
+                          ignored=['multithread', 'warp_memory_limit'])
 def main(elevation_map, elevation_band, ecmwf_data_file, date_time_utc, time_zone,
          prepare_temperature, prepare_vapour_pressure, prepare_air_pressure, prepare_wind_speed,
-         prepare_clear_sky_solar_radiation, prepare_daily_solar_irradiance, output_file):
+         prepare_clear_sky_solar_radiation, prepare_daily_solar_irradiance, output_file,
+         multithread, warp_memory_limit):
 
     # Save elevation to GeoTIFF becasue it will need to be read by GDAL later
     temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
@@ -29,38 +67,10 @@ def main(elevation_map, elevation_band, ecmwf_data_file, date_time_utc, time_zon
     temp_file.close()
     su.copy_bands_to_file(elevation_map, temp_elev_path, [elevation_band])
 
-    # Calculate required meteorological parameters
-    bands = []
-    if prepare_temperature:
-        data = eu.get_ECMWF_data(ecmwf_data_file, 'air_temperature', date_time_utc, temp_elev_path,
-                                 time_zone)
-        bands.append({'band_data': data, 'band_name': 'air_temperature', 'description':
-                      'Air temperature at 100 m above surface(K)'})
-    if prepare_vapour_pressure:
-        data = eu.get_ECMWF_data(ecmwf_data_file, 'vapour_pressure', date_time_utc, temp_elev_path,
-                                 time_zone)
-        bands.append({'band_data': data, 'band_name': 'vapour_pressure', 'description':
-                      'Surface vapour pressure (mb)'})
-    if prepare_air_pressure:
-        data = eu.get_ECMWF_data(ecmwf_data_file, 'air_pressure', date_time_utc, temp_elev_path,
-                                 time_zone)
-        bands.append({'band_data': data, 'band_name': 'air_pressure', 'description':
-                      'Surface air pressure (mb)'})
-    if prepare_wind_speed:
-        data = eu.get_ECMWF_data(ecmwf_data_file, 'wind_speed', date_time_utc, temp_elev_path,
-                                 time_zone)
-        bands.append({'band_data': data, 'band_name': 'wind_speed', 'description':
-                      'Wind speed at 100 m above surface (m/s)'})
-    if prepare_clear_sky_solar_radiation:
-        data = eu.get_ECMWF_data(ecmwf_data_file, 'clear_sky_solar_radiation', date_time_utc,
-                                 temp_elev_path, time_zone)
-        bands.append({'band_data': data, 'band_name': 'clear_sky_solar_radiation', 'description':
-                      'Instantenous clear sky surface solar irradiance (W/m^2)'})
-    if prepare_daily_solar_irradiance:
-        data = eu.get_ECMWF_data(ecmwf_data_file, 'average_daily_solar_irradiance', date_time_utc,
-                                 temp_elev_path, time_zone)
-        bands.append({'band_data': data, 'band_name': 'average_daily_solar_irradiance',
-                      'description': 'Average daily solar irradiance (W/m^2)'})
+    bands = prepare_meteo(temp_elev_path, ecmwf_data_file, date_time_utc, time_zone,
+                          prepare_temperature, prepare_vapour_pressure, prepare_air_pressure,
+                          prepare_wind_speed, prepare_clear_sky_solar_radiation,
+                          prepare_daily_solar_irradiance, multithread, warp_memory_limit)
 
     # Save the output file
     geo_coding = su.read_snappy_product(elevation_map, elevation_band)[1]
@@ -0,0 +1 @@
+"%~dp0\..\python.exe" "%~dp0\ecmwf_data_preparation_batch.py" %*
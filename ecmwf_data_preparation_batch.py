@@ -0,0 +1,149 @@
+import csv
+import datetime
+import multiprocessing
+import os
+import tempfile
+
+import click
+
+import ecmwf_data_preparation as edp
+import ecmwf_utils as eu
+## snappy_utils should be imported last, as it modifies the system path
+import snappy_utils as su
+
+
+# Columns of the CSV file listing the overpasses
+DATE_COLUMNS = ['date_time_utc', 'output_file']
+DATE_TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+# ECMWF file opened with the elevation template and options of a worker process, set by
+# _init_worker
+_worker_state = {}
+
+
+def read_dates_file(dates_file):
+    with open(dates_file, 'r', newline='') as fp:
+        dates = list(csv.DictReader(fp))
+    if len(dates) == 0:
+        raise RuntimeError(dates_file + " does not list any dates")
+    for column in DATE_COLUMNS:
+        if column not in dates[0]:
+            raise RuntimeError(f'Missing {column} column in {dates_file}')
+    # Relative paths are relative to the location of the CSV file
+    base_dir = os.path.dirname(os.path.abspath(dates_file))
+    return [{'date_time_utc': datetime.datetime.strptime(date['date_time_utc'].strip(),
+                                                         DATE_TIME_FORMAT),
+             'output_file': os.path.join(base_dir, date['output_file'].strip())}
+            for date in dates]
+
+
+def _init_worker(ecmwf_data_file, elevation_file, time_zone, prepare_flags, warp_options):
+    # The ECMWF file, its time index and the window covering the elevation template are set up
+    # once per process and reused for all dates
+    _worker_state['era5'] = eu.ECMWFFile(ecmwf_data_file, elevation_file)
+    _worker_state['elevation_file'] = elevation_file
+    _worker_state['time_zone'] = time_zone
+    _worker_state['prepare_flags'] = prepare_flags
+    _worker_state['warp_options'] = warp_options
+
+
+def _prepare_date(date_time_utc):
+    return edp.prepare_meteo(_worker_state['elevation_file'], _worker_state['era5'],
+                             date_time_utc, _worker_state['time_zone'],
+                             *_worker_state['prepare_flags'], *_worker_state['warp_options'])
+
+
+def run_batch(dates, elevation_file, ecmwf_data_file, time_zone, prepare_flags, geo_coding,
+              workers, warp_options=(True, None)):
+    # The meteorological fields are prepared in the worker processes, while the main process
+    # writes the products
+
+    def write(date, bands):
+        if any(b['band_data'] is None for b in bands):
+            raise RuntimeError("ECMWF file does not contain data for " +
+                               date['date_time_utc'].strftime(DATE_TIME_FORMAT))
+        su.write_snappy_product(date['output_file'], bands, 'ecmwfData', geo_coding)
+        print('INFO: Saved ' + date['output_file'])
+
+    init_args = (ecmwf_data_file, elevation_file, time_zone, prepare_flags, warp_options)
+    if workers == 1:
+        _init_worker(*init_args)
+        try:
+            for date in dates:
+                write(date, _prepare_date(date['date_time_utc']))
+        finally:
+            _worker_state['era5'].close()
+        return
+
+    # Spawn fresh worker processes instead of forking the one running the JVM.
+    pool = multiprocessing.get_context('spawn').Pool(workers, _init_worker, init_args)
+    try:
+        # Limit the number of dates in flight so that memory use stays bounded
+        pending = []
+        for date in dates:
+            pending.append((date, pool.apply_async(_prepare_date, (date['date_time_utc'],))))
+            if len(pending) >= 2 * workers:
+                date, result = pending.pop(0)
+                write(date, result.get())
+        for date, result in pending:
+            write(date, result.get())
+    finally:
+        pool.close()
+        pool.join()
+
+
+@click.command()
+@click.option('--elevation_map', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--elevation_band', required=True)
+@click.option('--ecmwf_data_file', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--dates_file', required=True, type=click.Path(dir_okay=False, exists=True),
+              help='CSV file with the columns ' + ', '.join(DATE_COLUMNS) + ' and one row per '
+                   'overpass. Dates are in ' + DATE_TIME_FORMAT.replace('%', '%%') + ' format.')
+@click.option('--time_zone', required=True, type=click.IntRange(-12, 12))
+@click.option('--prepare_temperature', required=True, type=click.BOOL)
+@click.option('--prepare_vapour_pressure', required=True, type=click.BOOL)
+@click.option('--prepare_air_pressure', required=True, type=click.BOOL)
+@click.option('--prepare_wind_speed', required=True, type=click.BOOL)
+@click.option('--prepare_clear_sky_solar_radiation', required=True, type=click.BOOL)
+@click.option('--prepare_daily_solar_irradiance', required=True, type=click.BOOL)
+@click.option('--workers', required=False, default=1, type=click.IntRange(1),
+              help='Number of processes used to prepare the dates.')
+@click.option('--multithread', required=False, default=None, type=click.BOOL,
+              help='Warp the ECMWF data onto the elevation map with multiple threads. By '
+                   'default only when --workers is 1, since each worker process already uses '
+                   'one CPU.')
+@click.option('--warp_memory_limit', required=False, default=None, type=click.IntRange(1),
+              help='Size of the working buffer of the warp in MB. By default it is set by GDAL.')
+def main(elevation_map, elevation_band, ecmwf_data_file, dates_file, time_zone,
+         prepare_temperature, prepare_vapour_pressure, prepare_air_pressure, prepare_wind_speed,
+         prepare_clear_sky_solar_radiation, prepare_daily_solar_irradiance, workers,
+         multithread, warp_memory_limit):
+
+    dates = read_dates_file(dates_file)
+    # Multithreaded warps in several worker processes would oversubscribe the CPUs
+    if multithread is None:
+        multithread = workers == 1
+    prepare_flags = (prepare_temperature, prepare_vapour_pressure, prepare_air_pressure,
+                     prepare_wind_speed, prepare_clear_sky_solar_radiation,
+                     prepare_daily_solar_irradiance)
+
+    # Save elevation to GeoTIFF becasue it will need to be read by GDAL later. It is done once
+    # for all dates.
+    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
+    temp_elev_path = temp_file.name
+    temp_file.close()
+    su.copy_bands_to_file(elevation_map, temp_elev_path, [elevation_band])
+    geo_coding = su.read_snappy_product(elevation_map, elevation_band)[1]
+
+    try:
+        run_batch(dates, temp_elev_path, ecmwf_data_file, time_zone, prepare_flags, geo_coding,
+                  workers, (multithread, warp_memory_limit))
+    finally:
+        os.remove(temp_elev_path)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print("ERROR:" + str(e))
@@ -0,0 +1 @@
+"${0%/*}"/../bin/python "${0%/*}"/ecmwf_data_preparation_batch.py "$@"
@@ -5,8 +5,12 @@ Created on Tue Jul 17 14:47:50 2018
 @author: rmgu
 """
 
+import concurrent.futures
 import os
 import datetime
+import json
+import shutil
+import threading
 import numpy as np
 cur_path =  os.path.dirname(os.path.abspath(__file__))
 if os.name == 'nt':
@@ -26,104 +30,402 @@ import gdal_utils as gu
 GRAVITY = 9.80665
 # Blending height of 100 m
 Z_BH = 100.0
+# Margin, in ECMWF pixels, of the window read around the template. The cubic spline kernel
+# extends two pixels around each resampled point.
+WINDOW_MARGIN = 3
+
+
+# Name of the ERA5 dataset in the Climate Data Store
+CDS_DATASET = "reanalysis-era5-single-levels"
+
+
+def download_CDS_data(date_start, date_end, variables, target, overwrite=False, area=None,
+                      workers=4, client=None):
+    # The request is split into one chunk per month and variable, which are retrieved
+    # concurrently by up to workers threads and then merged into the target file. The chunks
+    # are saved next to the target together with a manifest of the completed ones, so that an
+    # interrupted download is resumed by running it again. client is the CDS API client, by
+    # default one cdsapi.Client is created per chunk.
+    if os.path.exists(target) and not overwrite:
+        print("Downloaded")
+        return
+
+    request = {"variable": sorted(variables), "date": date_start+"/"+date_end, "area": area}
+    chunks = _download_chunks(date_start, date_end, variables)
+    parts_dir = os.path.splitext(target)[0] + "_parts"
+    manifest_path = os.path.join(parts_dir, "manifest.json")
+
+    manifest = None
+    if os.path.exists(manifest_path) and not overwrite:
+        with open(manifest_path, "r") as fp:
+            manifest = json.load(fp)
+        # Chunks of a different request cannot be reused
+        if manifest["request"] != request:
+            manifest = None
+    if manifest is None:
+        if os.path.isdir(parts_dir):
+            shutil.rmtree(parts_dir)
+        os.makedirs(parts_dir)
+        manifest = {"request": request, "completed": []}
+        _save_manifest(manifest, manifest_path)
+
+    lock = threading.Lock()
+
+    def retrieve(chunk):
+        name, variable, dates = chunk
+        s = {}
+        s["variable"] = [variable]
+        s["product_type"] = "reanalysis"
+        s["date"] = dates
+        s["time"] = [str(t).zfill(2)+":00" for t in range(0, 24, 1)]
+        if area:
+            s["area"] = area
+        s["format"] = "netcdf"
+
+        # Download to a temporary file, so that incomplete chunks are never used
+        part = os.path.join(parts_dir, name + ".nc")
+        (client or _cds_client()).retrieve(CDS_DATASET, s, part + ".tmp")
+        os.replace(part + ".tmp", part)
+        with lock:
+            manifest["completed"].append(name)
+            _save_manifest(manifest, manifest_path)
+        print("Downloaded " + name)
+
+    pending = [chunk for chunk in chunks if chunk[0] not in manifest["completed"] or
+               not os.path.exists(os.path.join(parts_dir, chunk[0] + ".nc"))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # Raise the first error only after all other chunks are done, so they are kept
+        futures = [executor.submit(retrieve, chunk) for chunk in pending]
+        for future in futures:
+            future.exception()
+    for future in futures:
+        future.result()
+
+    _merge_chunks([os.path.join(parts_dir, chunk[0] + ".nc") for chunk in chunks], target)
+    shutil.rmtree(parts_dir)
+    print("Downloaded")
 
 
-def download_CDS_data(date_start, date_end, variables, target, overwrite=False, area=None):
+def _cds_client():
     if not os.path.isdir(os.path.expanduser('~')) and not os.getenv('CDSAPI_RC', None):
         os.environ['CDSAPI_RC'] = os.path.join(cur_path, '..\\..\\..\\..\\.cdsapirc')
     import cdsapi
-    s = {}
-
-    s["variable"] = variables
-    s["product_type"] = "reanalysis"
-    s["date"] = date_start+"/"+date_end
-    s["time"] = [str(t).zfill(2)+":00" for t in range(0, 24, 1)]
-    if area:
-        s["area"] = area
-    s["format"] = "netcdf"
-
-    # Connect to the server and download the data
-    if not os.path.exists(target) or overwrite:
-        c = cdsapi.Client()
-        c.retrieve("reanalysis-era5-single-levels", s, target)
-    print("Downloaded")
+    return cdsapi.Client()
+
+
+def _download_chunks(date_start, date_end, variables):
+    # Names, variables and date ranges of the chunks of a request, one per month and variable
+    start = datetime.datetime.strptime(date_start, "%Y-%m-%d").date()
+    end = datetime.datetime.strptime(date_end, "%Y-%m-%d").date()
+    if end < start:
+        raise RuntimeError("End date %s is before start date %s" % (date_end, date_start))
+    chunks = []
+    month_start = start
+    while month_start <= end:
+        next_month = (month_start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        month_end = min(end, next_month - datetime.timedelta(days=1))
+        for variable in variables:
+            name = "%s_%s" % (month_start.strftime("%Y%m"), variable)
+            chunks.append((name, variable, month_start.isoformat()+"/"+month_end.isoformat()))
+        month_start = next_month
+    return chunks
+
+
+def _save_manifest(manifest, manifest_path):
+    with open(manifest_path + ".tmp", "w") as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def _merge_chunks(part_files, target):
+    # Merge the chunks into one file with all time steps and variables. Each chunk is packed
+    # with its own scale and offset, so the variables are unpacked to float32.
+    fids = [netCDF4.Dataset(part, "r") for part in part_files]
+    try:
+        time = fids[0].variables["time"]
+        units = time.units
+        calendar = getattr(time, "calendar", "standard")
+        times = {}
+        for fid in fids:
+            time = fid.variables["time"]
+            dates = netCDF4.num2date(time[:], time.units, getattr(time, "calendar", "standard"))
+            times[fid] = netCDF4.date2num(dates, units, calendar)
+        all_times = np.unique(np.concatenate(list(times.values())))
+
+        temp_target = target + ".tmp"
+        with netCDF4.Dataset(temp_target, "w", format="NETCDF4") as out:
+            out.createDimension("time", None)
+            var = out.createVariable("time", fids[0].variables["time"].dtype, ("time",))
+            var.units = units
+            var.calendar = calendar
+            var[:] = all_times
+            for name in ["longitude", "latitude"]:
+                coord = fids[0].variables[name]
+                out.createDimension(name, len(coord))
+                var = out.createVariable(name, coord.dtype, (name,))
+                var.setncatts({k: coord.getncattr(k) for k in coord.ncattrs()})
+                var[:] = coord[:]
+
+            for fid in fids:
+                for name in ["longitude", "latitude"]:
+                    if len(fid.dimensions[name]) != len(out.dimensions[name]):
+                        raise RuntimeError("Downloaded chunks have different grids")
+                for name, src in fid.variables.items():
+                    if src.dimensions != ("time", "latitude", "longitude"):
+                        continue
+                    if name not in out.variables:
+                        var = out.createVariable(name, "f4", src.dimensions, zlib=True,
+                                                 chunksizes=(1, len(out.dimensions["latitude"]),
+                                                             len(out.dimensions["longitude"])))
+                        var.setncatts({k: src.getncattr(k) for k in src.ncattrs()
+                                       if k not in ["scale_factor", "add_offset", "_FillValue",
+                                                    "missing_value"]})
+                    # Copy a day of hourly data at a time to bound the memory use
+                    index = np.searchsorted(all_times, times[fid])
+                    for i in range(0, len(index), 24):
+                        out.variables[name][index[i:i+24], :, :] = \
+                            src[i:i+24].astype(np.float32)
+        os.replace(temp_target, target)
+    finally:
+        for fid in fids:
+            fid.close()
+
+
+ECMWF_FIELDS = ['air_temperature', 'vapour_pressure', 'air_pressure', 'wind_speed',
+                'clear_sky_solar_radiation', 'average_daily_solar_irradiance']
 
 
 def get_ECMWF_data(ecmwf_data_file, field, timedate_UTC, elev, time_zone):
+    return get_ECMWF_fields(ecmwf_data_file, [field], timedate_UTC, elev, time_zone)[field]
+
+
+def get_ECMWF_fields(ecmwf_data_file, fields, timedate_UTC, elev, time_zone, multithread=True,
+                     warp_memory_limit=None):
+    # Prepare several fields at once. The file is opened once, each variable is read and
+    # interpolated once and the intermediate fields shared by several outputs (vapour pressure
+    # and pressure) are computed once. All fields are then resampled in a single warp, with
+    # the multithread and warp_memory_limit options of gdal_utils.resample_with_gdalwarp.
+    # Returns a dictionary with the fields resampled to the elev template, or with None values
+    # if the file does not cover timedate_UTC. ecmwf_data_file can also be an ECMWFFile opened
+    # with elev as template, which is left open so that it can be reused for other dates.
+    for field in fields:
+        if field not in ECMWF_FIELDS:
+            raise RuntimeError("Unknown field: %s!" % field)
+
+    if isinstance(ecmwf_data_file, ECMWFFile):
+        era5 = ecmwf_data_file
+    else:
+        era5 = ECMWFFile(ecmwf_data_file, elev)
+    try:
+        beforeI, afterI, frac = era5.time_index.bracket(timedate_UTC)
+        if beforeI is None:
+            return {field: None for field in fields}
+        coarse = _calc_coarse_fields(era5, fields, timedate_UTC, time_zone, beforeI, afterI,
+                                     frac)
+    finally:
+        if era5 is not ecmwf_data_file:
+            era5.close()
+
+    # Resample datasets to the elevation template
+    resampled = _ECMWFRespampleFields(coarse, era5.gt, era5.proj, elev, multithread,
+                                      warp_memory_limit)
+
+    data = {}
+    for field in fields:
+        if field == "air_temperature":
+            # Calculate actual blending height temperature based on input elevation data
+            elev_data = era5.read_template()
+            data[field] = calc_air_temperature_blending_height(resampled["T_datum"],
+                                                               resampled["ea"], resampled["p"],
+                                                               elev_data+Z_BH, z_ta=0)
+        elif field == "vapour_pressure":
+            data[field] = resampled["ea"]
+        elif field == "air_pressure":
+            data[field] = resampled["p"]
+        else:
+            data[field] = resampled[field]
+    return data
+
+
+def _calc_coarse_fields(era5, fields, timedate_UTC, time_zone, beforeI, afterI, frac):
+    # Fields at the resolution of the ECMWF data, before resampling
 
-    ncfile = netCDF4.Dataset(ecmwf_data_file, 'r')
-    # Find the location of bracketing dates
-    time = ncfile.variables['time']
-    dates = netCDF4.num2date(time[:], time.units, time.calendar)
-    beforeI, afterI, frac = _bracketing_dates(dates, timedate_UTC)
-    if beforeI is None:
-        ncfile.close()
-        return None
-    time = None
-    ncfile.close()
-
-    if field == "air_temperature":
-        print("air_temperature")
-        t2m, gt, proj = _getECMWFTempInterpData(ecmwf_data_file, "t2m", beforeI, afterI, frac)
+    variables = {}
+
+    def interp(var_name):
+        if var_name not in variables:
+            variables[var_name] = era5.read_interpolated(var_name, beforeI, afterI, frac)
+        return variables[var_name]
+
+    coarse = {}
+    if "air_temperature" in fields or "vapour_pressure" in fields:
+        coarse["ea"] = calc_vapour_pressure(interp("d2m"))
+    if "air_temperature" in fields or "air_pressure" in fields:
+        # Convert pressure from pascals to mb
+        coarse["p"] = calc_pressure_mb(interp("sp"))
+    if "air_temperature" in fields:
         # Get geopotential height at which Ta is calculated
-        z, gt, proj = _getECMWFTempInterpData(ecmwf_data_file, "z", beforeI, afterI, frac)
-        z /= GRAVITY
-        d2m, gt, proj = _getECMWFTempInterpData(ecmwf_data_file, "d2m", beforeI, afterI, frac)
-        ea = calc_vapour_pressure(d2m)
-        sp, gt, proj = _getECMWFTempInterpData(ecmwf_data_file, "sp", beforeI, afterI, frac)
-        p = calc_pressure_mb(sp)
+        z = interp("z") / GRAVITY
         # Calcultate temperature at 0m datum height
-        T_datum = calc_air_temperature_blending_height(t2m, ea, p, 0, z_ta=z+2.0)
-        # Resample dataset and calculate actual blendingh height temperature based on input
-        # elevation data
-        ea = _ECMWFRespampleData(ea, gt, proj, elev)
-        p = _ECMWFRespampleData(p, gt, proj, elev)
-        T_datum = _ECMWFRespampleData(T_datum, gt, proj, elev)
-        elev_data = gu.raster_data(elev)
-        data = calc_air_temperature_blending_height(T_datum, ea, p, elev_data+Z_BH, z_ta=0)
-
-    elif field == "vapour_pressure":
-        print("vp")
-        d2m, gt, proj = _getECMWFTempInterpData(ecmwf_data_file, "d2m", beforeI, afterI, frac)
-        data = calc_vapour_pressure(d2m)
-        data = _ECMWFRespampleData(data, gt, proj, elev)
-
-    elif field == "wind_speed":
-        print("ws")
-        u100, gt, proj = _getECMWFTempInterpData(ecmwf_data_file, "u100", beforeI, afterI, frac)
-        v100, gt, proj = _getECMWFTempInterpData(ecmwf_data_file, "v100", beforeI, afterI, frac)
+        coarse["T_datum"] = calc_air_temperature_blending_height(interp("t2m"), coarse["ea"],
+                                                                 coarse["p"], 0, z_ta=z+2.0)
+    if "wind_speed" in fields:
         # Combine the two components of wind speed and calculate speed at blending height
-        ws100 = calc_wind_speed(u100, v100)
-        data = _ECMWFRespampleData(ws100, gt, proj, elev)
-
-    elif field == "air_pressure":
-        print("ap")
-        sp, gt, proj = _getECMWFTempInterpData(ecmwf_data_file, "sp", beforeI, afterI, frac)
-        # Convert pressure from pascals to mb
-        data = calc_pressure_mb(sp)
-        data = _ECMWFRespampleData(data, gt, proj, elev)
-
-    elif field == "clear_sky_solar_radiation":
-        print("cssr")
-        ssrdc, gt, proj = _getECMWFTempInterpData(ecmwf_data_file, "ssrdc", beforeI, afterI, frac)
+        coarse["wind_speed"] = calc_wind_speed(interp("u100"), interp("v100"))
+    if "clear_sky_solar_radiation" in fields:
         # Convert from Jules to Watts
-        data = ssrdc / 3600.0
-        data = _ECMWFRespampleData(data, gt, proj, elev)
-
-    elif field == "average_daily_solar_irradiance":
-        print("adsi")
+        coarse["clear_sky_solar_radiation"] = interp("ssrdc") / 3600.0
+    if "average_daily_solar_irradiance" in fields:
         # Find midnight in local time and convert to UTC time
         date_local = (timedate_UTC + datetime.timedelta(hours=time_zone)).date()
         midnight_local = datetime.datetime.combine(date_local, datetime.time())
         midnight_UTC = midnight_local - datetime.timedelta(hours=time_zone)
         # Interpolate solar irradiance over 24 hour period starting at midnight local time
-        data, gt, proj = _getECMWFIntegratedData(ecmwf_data_file, "ssrd", midnight_UTC,
-                                                 time_window=24)
-        data = _ECMWFRespampleData(data, gt, proj, elev)
+        coarse["average_daily_solar_irradiance"] = era5.read_integrated("ssrd", midnight_UTC,
+                                                                        time_window=24)
+    return coarse
+
+
+class ECMWFFile(object):
+    # An ERA5 NetCDF file opened with netCDF4. The time index and the grid are decoded once when
+    # it is opened and are shared by all variables read from it. If a template file is given,
+    # only the window of the grid covering it is read and gt is the geotransform of the window.
+
+    def __init__(self, ecmwf_data_file, template_file=None):
+        self.file_path = ecmwf_data_file
+        self.template_file = template_file
+        self._template_data = None
+        self._fid = netCDF4.Dataset(ecmwf_data_file, 'r')
+        self.time_index = get_time_index(ecmwf_data_file, self._fid)
+        gt, self._flip_rows, self._shape = _ECMWFGeoTransform(self._fid)
+        if template_file is None:
+            self._window = (0, self._shape[0], 0, self._shape[1])
+        else:
+            self._window = _template_window(template_file, gt, self._shape)
+        row_0, _, col_0, _ = self._window
+        self.gt = (gt[0] + col_0 * gt[1], gt[1], 0.0, gt[3] + row_0 * gt[5], 0.0, gt[5])
+        self.proj = _wgs84_wkt()
+
+    def close(self):
+        self._fid.close()
+
+    def read_template(self):
+        if self._template_data is None:
+            self._template_data = gu.raster_data(self.template_file)
+        return self._template_data
+
+    def read_layer(self, var_name, index):
+        if index >= len(self.time_index):
+            raise RuntimeError("ECMWF file does not contain data for the requested date.")
+        return self._read(var_name, index)
+
+    def _read(self, var_name, time_steps):
+        # Read the window of one time step, or of a slice of time steps stacked along the first
+        # axis
+        if var_name not in self._fid.variables:
+            raise RuntimeError("Variable %s does not exist in file %s." %
+                               (var_name, self.file_path))
+        # Rows are returned north up, as GDAL does
+        row_0, row_1, col_0, col_1 = self._window
+        if self._flip_rows:
+            row_0, row_1 = self._shape[0] - row_1, self._shape[0] - row_0
+        # netCDF4 applies the scale and offset of packed variables and masks missing values
+        data = self._fid.variables[var_name][time_steps, row_0:row_1, col_0:col_1]
+        data = np.ma.filled(data.astype(float), np.nan)
+        if self._flip_rows:
+            data = data[..., ::-1, :]
+        return data
+
+    def read_interpolated(self, var_name, before_I, after_I, frac):
+        data_before = self.read_layer(var_name, before_I)
+        data_after = self.read_layer(var_name, after_I)
+        # Perform temporal interpolation
+        return data_before*frac + data_after*(1.0-frac)
+
+    def read_integrated(self, var_name, date_time, time_window=24):
+        # Get the time right before date_time, to use it as integrated baseline
+        date_0, _, _ = self.time_index.bracket(date_time)
+        # Get the time right before the temporal witndow set
+        date_1, _, _ = self.time_index.bracket(date_time + datetime.timedelta(hours=time_window))
+        if date_0 is None or date_1 is None:
+            raise RuntimeError("ECMWF file does not contain data for the requested date")
+
+        # Forecasts of ERA5 the accumulations are since the previous post processing
+        # (archiving), so the value of each time step is the accumulation since the previous
+        # one. All time steps of the window are read at once and summed.
+        data = self._read(var_name, slice(date_0+1, date_1+1))
+        data[np.isnan(data)] = 0
+        cummulated_value = data.sum(axis=0)
+
+        # Convert to average W m^-2
+        return cummulated_value / (time_window * 3600.)
+
+
+def _ECMWFGeoTransform(fid):
+    # Geotransform of the regular latitude/longitude grid of the file, whether the rows have to
+    # be flipped to be north up and the shape of the grid
+    for lat_name, lon_name in [('latitude', 'longitude'), ('lat', 'lon')]:
+        if lat_name in fid.variables and lon_name in fid.variables:
+            break
     else:
-        raise RuntimeError("Unknown field: %s!" % field)
-
-    return data
+        raise RuntimeError("ECMWF file does not have latitude and longitude variables")
+    lat = np.asarray(fid.variables[lat_name][:], np.float64)
+    lon = np.asarray(fid.variables[lon_name][:], np.float64)
+    # ERA5 data is on a 0.25 degree grid
+    res_lat = abs(lat[-1] - lat[0]) / (len(lat) - 1) if len(lat) > 1 else 0.25
+    res_lon = (lon[-1] - lon[0]) / (len(lon) - 1) if len(lon) > 1 else 0.25
+    flip_rows = len(lat) > 1 and lat[-1] > lat[0]
+    gt = (float(lon[0] - res_lon / 2.0), float(res_lon), 0.0, float(lat.max() + res_lat / 2.0),
+          0.0, float(-res_lat))
+    return gt, flip_rows, (len(lat), len(lon))
+
+
+def _template_window(template_file, gt, shape):
+    # Rows and columns of the ECMWF grid covering the extent of the template, plus a margin for
+    # the cubic spline resampling
+    proj, _, _, _, extent, _ = gu.raster_info(template_file)
+    src = osr.SpatialReference()
+    src.ImportFromWkt(proj)
+    dst = osr.SpatialReference()
+    dst.ImportFromWkt(_wgs84_wkt())
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(src, dst)
+
+    # The edges of the template are densified since they are curved in geographic coordinates
+    t = np.linspace(0, 1, 21)
+    x = np.concatenate([extent[0] + t * (extent[2] - extent[0]), np.full(21, extent[2]),
+                        extent[0] + t * (extent[2] - extent[0]), np.full(21, extent[0])])
+    y = np.concatenate([np.full(21, extent[1]), extent[1] + t * (extent[3] - extent[1]),
+                        np.full(21, extent[3]), extent[1] + t * (extent[3] - extent[1])])
+    points = np.array(transform.TransformPoints(list(zip(x.tolist(), y.tolist()))))
+    lon, lat = points[:, 0], points[:, 1]
+    # Grids of global downloads have longitudes from 0 to 360
+    if gt[0] + gt[1] * shape[1] > 180:
+        lon = np.where(lon < gt[0], lon + 360, lon)
+
+    col_0 = int(np.floor((lon.min() - gt[0]) / gt[1])) - WINDOW_MARGIN
+    col_1 = int(np.ceil((lon.max() - gt[0]) / gt[1])) + WINDOW_MARGIN
+    row_0 = int(np.floor((lat.max() - gt[3]) / gt[5])) - WINDOW_MARGIN
+    row_1 = int(np.ceil((lat.min() - gt[3]) / gt[5])) + WINDOW_MARGIN
+    col_0, col_1 = max(col_0, 0), min(col_1, shape[1])
+    row_0, row_1 = max(row_0, 0), min(row_1, shape[0])
+    # Read the whole grid if the template is outside of it, as before
+    if col_0 >= col_1 or row_0 >= row_1:
+        return 0, shape[0], 0, shape[1]
+    return row_0, row_1, col_0, col_1
+
+
+_wgs84 = []
+
+
+def _wgs84_wkt():
+    if not _wgs84:
+        sr = osr.SpatialReference()
+        sr.ImportFromEPSG(4326)
+        _wgs84.append(sr.ExportToWkt())
+    return _wgs84[0]
 
 
 def calc_air_temperature_blending_height(ta, ea, p, z_bh, z_ta=2.0):
@@ -166,109 +468,104 @@ def calc_tcwv_cm(tcwv):
     return tcwv/10.0
 
 
-def _getECMWFTempInterpData(ncfile, var_name, before_I, after_I, frac):
-    ds = gdal.Open('NETCDF:"'+ncfile+'":'+var_name)
-    if ds is None:
-        raise RuntimeError("Variable %s does not exist in file %s." % (var_name, ncfile))
-
-    # Get some metadata
-    scale = ds.GetRasterBand(before_I+1).GetScale()
-    offset = ds.GetRasterBand(before_I+1).GetOffset()
-    no_data_value = ds.GetRasterBand(before_I+1).GetNoDataValue()
-    gt = ds.GetGeoTransform()
-    sr = osr.SpatialReference()
-    sr.ImportFromEPSG(4326)
-    proj = sr.ExportToWkt()
-
-    # Read the right time layers
+def _getECMWFTempInterpData(ncfile, var_name, before_I, after_I, frac, template_file=None):
+    era5 = ECMWFFile(ncfile, template_file)
     try:
-        data_before = ds.GetRasterBand(before_I+1).ReadAsArray()
-        data_before = (data_before.astype(float) * scale) + offset
-        data_before[data_before == no_data_value] = np.nan
-        data_after = ds.GetRasterBand(after_I+1).ReadAsArray()
-        data_after = (data_after.astype(float) * scale) + offset
-        data_after[data_after == no_data_value] = np.nan
-    except AttributeError:
-        ds = None
-        raise RuntimeError("ECMWF file does not contain data for the requested date.")
-
-    # Perform temporal interpolation
-    data = data_before*frac + data_after*(1.0-frac)
-
-    return data, gt, proj
+        data = era5.read_interpolated(var_name, before_I, after_I, frac)
+    finally:
+        era5.close()
+    return data, era5.gt, era5.proj
 
 
 def _ECMWFRespampleData(data, gt, proj, template_file):
-    # Subset and reproject to the template file extent and projection
-    ds_out = gu.save_image(data, gt, proj, "MEM")
-    ds_out_proj = gu.resample_with_gdalwarp(ds_out, template_file, resample_alg="cubicspline")
-    data = ds_out_proj.GetRasterBand(1).ReadAsArray()
+    return _ECMWFRespampleFields({"data": data}, gt, proj, template_file)["data"]
+
+
+def _ECMWFRespampleFields(fields, gt, proj, template_file, multithread=False,
+                          warp_memory_limit=None):
+    # Subset and reproject to the template file extent and projection. The fields are stacked
+    # in one multi-band dataset, so that the coordinate transformation to the template grid is
+    # computed once for all of them. The NaN no-data value is applied to each band on its own,
+    # so that a pixel missing in one field is not masked in the others, as with one warp per
+    # field.
+    names = list(fields.keys())
+    if len(names) == 0:
+        return {}
+    rows, cols = fields[names[0]].shape
+    ds_out = gdal.GetDriverByName("MEM").Create("", cols, rows, len(names), gdal.GDT_Float32)
+    ds_out.SetGeoTransform(gt)
+    ds_out.SetProjection(proj)
+    for i, name in enumerate(names):
+        band = ds_out.GetRasterBand(i+1)
+        band.SetNoDataValue(np.nan)
+        band.WriteArray(fields[name])
+    ds_out_proj = gu.resample_with_gdalwarp(ds_out, template_file, resample_alg="cubicspline",
+                                            multithread=multithread,
+                                            warp_memory_limit=warp_memory_limit,
+                                            warp_options=["UNIFIED_SRC_NODATA=NO"])
+    data = {name: ds_out_proj.GetRasterBand(i+1).ReadAsArray() for i, name in enumerate(names)}
     ds_out_proj = None
 
     return data
 
 
-def _getECMWFIntegratedData(ncfile, var_name, date_time, time_window=24,):
-
-    # Open the netcdf time dataset
-    fid = netCDF4.Dataset(ncfile, 'r')
-    time = fid.variables['time']
-    dates = netCDF4.num2date(time[:], time.units, time.calendar)
-    del fid
-
-    # Get the time right before date_time, to use it as integrated baseline
-    date_0, _, _ = _bracketing_dates(dates, date_time)
-    # Get the time right before the temporal witndow set
-    date_1, _, _ = _bracketing_dates(dates, date_time + datetime.timedelta(hours=time_window))
-
-    ds = gdal.Open('NETCDF:"'+ncfile+'":'+var_name)
-    if ds is None:
-        raise RuntimeError("Variable %s does not exist in file %s." % (var_name, ncfile))
-    # Get some metadata
-    scale = ds.GetRasterBand(date_0+1).GetScale()
-    offset = ds.GetRasterBand(date_0+1).GetOffset()
-    no_data_value = ds.GetRasterBand(date_0+1).GetNoDataValue()
-    # Report geolocation of the top-left pixel of rectangle
-    gt = ds.GetGeoTransform()
-    sr = osr.SpatialReference()
-    sr.ImportFromEPSG(4326)
-    proj = sr.ExportToWkt()
-
-    # Forecasts of ERA5 the accumulations are since the previous post processing
-    # (archiving)
-    data_ref = 0
-
-    # Initialize output variable
-    cummulated_value = 0.
-
-    try:
-        for date_i in range(date_0+1, date_1+1):
-            # Read the right time layers
-            data = ds.GetRasterBand(date_i+1).ReadAsArray()
-            data = (data.astype(float) * scale) + offset
-            data[data == no_data_value] = 0
-            # The time step value is the difference between  the actual timestep value and the
-            # previous value
-            cummulated_value += (data - data_ref)
-    except AttributeError:
-        ds = None
-        raise RuntimeError("ECMWF file does not contain data for the requested date")
-
-    # Convert to average W m^-2
-    cummulated_value = cummulated_value / (time_window * 3600.)
-
-    return cummulated_value, gt, proj
-
-
-def _bracketing_dates(date_list, target_date):
-    date_list = list(date_list)
+def _getECMWFIntegratedData(ncfile, var_name, date_time, time_window=24, template_file=None):
+    era5 = ECMWFFile(ncfile, template_file)
     try:
-        before = max([x for x in date_list if (target_date - x).total_seconds() >= 0])
-        after = min([x for x in date_list if (target_date - x).total_seconds() <= 0])
-    except ValueError:
-        return None, None, np.nan
-    if before == after:
-        frac = 1
-    else:
-        frac = float((after - target_date).total_seconds())/float((after-before).total_seconds())
-    return date_list.index(before), date_list.index(after), frac
+        data = era5.read_integrated(var_name, date_time, time_window)
+    finally:
+        era5.close()
+    return data, era5.gt, era5.proj
+
+
+class TimeIndex(object):
+    # Time axis of an ECMWF file, kept as numbers in the units of the file so that the time
+    # steps bracketing a date are found by binary search.
+
+    def __init__(self, times, units, calendar):
+        times = np.asarray(times, np.float64)
+        self.units = units
+        self.calendar = calendar
+        # The file's time steps should be in order, but the search does not rely on it
+        self._order = np.argsort(times, kind='mergesort')
+        self._times = times[self._order]
+
+    def __len__(self):
+        return len(self._times)
+
+    def bracket(self, target_date):
+        # Indices of the time steps right before and after target_date and the weight of the
+        # one before, or Nones if target_date is outside the time axis
+        target = netCDF4.date2num(target_date, self.units, self.calendar)
+        before = np.searchsorted(self._times, target, side='right') - 1
+        after = np.searchsorted(self._times, target, side='left')
+        if before < 0 or after >= len(self._times):
+            return None, None, np.nan
+        # The first of equal time steps is used, as list.index does
+        before = np.searchsorted(self._times, self._times[before], side='left')
+        if self._times[before] == self._times[after]:
+            frac = 1
+        else:
+            frac = float((self._times[after] - target) / (self._times[after] - self._times[before]))
+        return int(self._order[before]), int(self._order[after]), frac
+
+
+# Time indices of the ECMWF files read so far, keyed by their path and modification time
+_time_indices = {}
+
+
+def get_time_index(ecmwf_data_file, fid=None):
+    # The time axis is decoded again only if the file has been modified
+    key = (os.path.abspath(ecmwf_data_file), os.stat(ecmwf_data_file).st_mtime_ns)
+    if key not in _time_indices:
+        close = fid is None
+        if close:
+            fid = netCDF4.Dataset(ecmwf_data_file, 'r')
+        try:
+            time = fid.variables['time']
+            _time_indices[key] = TimeIndex(time[:], time.units,
+                                           getattr(time, 'calendar', 'standard'))
+        finally:
+            if close:
+                fid.close()
+    return _time_indices[key]
@@ -1,58 +1,146 @@
+import multiprocessing
+
 import click
 import numpy as np
 
 from pyTSEB import TSEB
 
+import output_writers as ow
+import cache_utils
 import snappy_utils as su
 
 
-@click.command()
-@click.option('--lst', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--lst_vza', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--lai', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--csp', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--fgv', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--ar', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--mi', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--nsr', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--li', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--mask', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--soil_roughness', required=True, type=click.FLOAT)
-@click.option('--alpha_pt', required=True, type=click.FLOAT)
-@click.option('--atmospheric_measurement_height', required=True, type=click.FLOAT)
-@click.option('--green_vegetation_emissivity', required=True, type=click.FLOAT)
-@click.option('--soil_emissivity', required=True, type=click.FLOAT)
-@click.option('--save_component_fluxes', required=True, type=click.BOOL)
-@click.option('--save_component_temperature', required=True, type=click.BOOL)
-@click.option('--save_aerodynamic_parameters', required=True, type=click.BOOL)
-@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
-def main(lst, lst_vza, lai, csp, fgv, ar, mi, nsr, li, mask, soil_roughness,alpha_pt,
-        atmospheric_measurement_height, green_vegetation_emissivity, soil_emissivity,
-        save_component_fluxes, save_component_temperature, save_aerodynamic_parameters, 
-        output_file):
+# Tile size used when several workers are requested without an explicit tile size
+DEFAULT_TILE_SIZE = 1024
+
+# Value of quality_flag for pixels which are not processed
+FLAG_NO_DATA = 255
+
+
+def read_static_inputs(lai, csp, fgv, ar, mask, rect=None):
+    # Inputs which only depend on the Sentinel-2 tile and not on the Sentinel-3 overpass
+    inputs = {}
+    inputs['lai'], geo_coding = su.read_snappy_product(lai, 'lai', rect, np.float32)
+    csp_bands = su.read_snappy_bands(csp, ['veg_inclination_distribution',
+                                           'veg_fractional_cover',
+                                           'veg_height_width_ratio',
+                                           'veg_leaf_width',
+                                           'veg_height',
+                                           'igbp_classification'], rect,
+                                 {'veg_inclination_distribution': np.float32,
+                                  'veg_fractional_cover': np.float32,
+                                  'veg_height_width_ratio': np.float32,
+                                  'veg_leaf_width': np.float32,
+                                  'veg_height': np.float32,
+                                  'igbp_classification': None})[0]
+    inputs['lad'] = csp_bands['veg_inclination_distribution']
+    inputs['frac_cover'] = csp_bands['veg_fractional_cover']
+    inputs['h_w_ratio'] = csp_bands['veg_height_width_ratio']
+    inputs['leaf_width'] = csp_bands['veg_leaf_width']
+    inputs['veg_height'] = csp_bands['veg_height']
+    inputs['landcover_band'] = csp_bands['igbp_classification']
+    csp_bands = None
+    inputs['frac_green'] = su.read_snappy_product(fgv, 'frac_green', rect, np.float32)[0]
+    ar_bands = su.read_snappy_bands(ar, ['roughness_length', 'zero_plane_displacement'], rect,
+                                    np.float32)[0]
+    inputs['z_0M'] = ar_bands['roughness_length']
+    inputs['d_0'] = ar_bands['zero_plane_displacement']
+    ar_bands = None
+    inputs['mask'] = su.read_snappy_product(mask, 'mask', rect, np.uint8)[0]
+
+    return inputs, geo_coding
+
+
+def read_date_inputs(lst, lst_vza, mi, nsr, li, rect=None):
+    # Inputs which change with each Sentinel-3 overpass
+    inputs = {}
+    inputs['lst'] = su.read_snappy_product(lst, 'sharpened_LST', rect, np.float32)[0]
+    inputs['vza'] = su.read_snappy_product(lst_vza, 'sat_zenith_tn', rect, np.float32)[0]
+    mi_bands = su.read_snappy_bands(mi, ['air_temperature', 'wind_speed', 'vapour_pressure',
+                                         'air_pressure'], rect, np.float32)[0]
+    inputs['ta'] = mi_bands['air_temperature']
+    inputs['u'] = mi_bands['wind_speed']
+    inputs['ea'] = mi_bands['vapour_pressure']
+    inputs['p'] = mi_bands['air_pressure']
+    mi_bands = None
+    nsr_bands = su.read_snappy_bands(nsr, ['net_shortwave_radiation_canopy',
+                                           'net_shortwave_radiation_soil'], rect, np.float32)[0]
+    inputs['shortwave_rad_c'] = nsr_bands['net_shortwave_radiation_canopy']
+    inputs['shortwave_rad_s'] = nsr_bands['net_shortwave_radiation_soil']
+    nsr_bands = None
+    inputs['longwave_irrad'] = \
+        su.read_snappy_product(li, 'longwave_irradiance', rect, np.float32)[0]
+
+    return inputs
+
+
+def read_inputs(lst, lst_vza, lai, csp, fgv, ar, mi, nsr, li, mask, rect=None):
+    # The inputs are file paths, or products opened with snappy_utils.open_snappy_product
 
     # Read the required data
-    lst = su.read_snappy_product(lst, 'sharpened_LST')[0].astype(np.float32)
-    vza = su.read_snappy_product(lst_vza, 'sat_zenith_tn')[0].astype(np.float32)
-    lai, geo_coding = su.read_snappy_product(lai, 'lai')
-    lai = lai.astype(np.float32)
-    lad = su.read_snappy_product(csp, 'veg_inclination_distribution')[0].astype(np.float32)
-    frac_cover = su.read_snappy_product(csp, 'veg_fractional_cover')[0].astype(np.float32)
-    h_w_ratio = su.read_snappy_product(csp, 'veg_height_width_ratio')[0].astype(np.float32)
-    leaf_width = su.read_snappy_product(csp, 'veg_leaf_width')[0].astype(np.float32)
-    veg_height = su.read_snappy_product(csp, 'veg_height')[0].astype(np.float32)
-    landcover_band = su.read_snappy_product(csp, 'igbp_classification')[0].astype(np.float32)
-    frac_green = su.read_snappy_product(fgv, 'frac_green')[0].astype(np.float32)
-    z_0M = su.read_snappy_product(ar, 'roughness_length')[0].astype(np.float32)
-    d_0 = su.read_snappy_product(ar, 'zero_plane_displacement')[0].astype(np.float32)
-    ta = su.read_snappy_product(mi, 'air_temperature')[0].astype(np.float32)
-    u = su.read_snappy_product(mi, 'wind_speed')[0].astype(np.float32)
-    ea = su.read_snappy_product(mi, 'vapour_pressure')[0].astype(np.float32)
-    p = su.read_snappy_product(mi, 'air_pressure')[0].astype(np.float32)
-    shortwave_rad_c = su.read_snappy_product(nsr, 'net_shortwave_radiation_canopy')[0].astype(np.float32)
-    shortwave_rad_s = su.read_snappy_product(nsr, 'net_shortwave_radiation_soil')[0].astype(np.float32)
-    longwave_irrad = su.read_snappy_product(li, 'longwave_irradiance')[0].astype(np.float32)
-    mask = su.read_snappy_product(mask, 'mask')[0].astype(np.float32)
+    inputs, geo_coding = read_static_inputs(lai, csp, fgv, ar, mask, rect)
+    inputs.update(read_date_inputs(lst, lst_vza, mi, nsr, li, rect))
+
+    return inputs, geo_coding
+
+
+# Model inputs which are gathered into packed arrays of valid pixels
+PACKED_INPUTS = ['lst', 'vza', 'lai', 'lad', 'frac_cover', 'h_w_ratio', 'leaf_width', 'veg_height',
+                 'frac_green', 'z_0M', 'd_0', 'ta', 'u', 'ea', 'p', 'shortwave_rad_c',
+                 'shortwave_rad_s', 'longwave_irrad']
+
+
+def valid_pixels(lai, mask):
+    # Flat indices of the pixels which are processed by the models, bare soil pixels first and
+    # then vegetated pixels, and the number of bare soil pixels
+    valid = mask == 1
+    soil = np.flatnonzero(np.logical_and(lai <= 0, valid))
+    veg = np.flatnonzero(np.logical_and(lai > 0, valid))
+    return np.concatenate((soil, veg)), soil.size
+
+
+def pack_inputs(inputs, index=None, n_soil=None):
+    # Gather the pixels which are processed by the models into 1-D arrays, so that each model
+    # runs on a contiguous slice. Only the inputs present in the dictionary are packed, using the
+    # given valid pixels or the ones found from its lai and mask.
+    if index is None:
+        index, n_soil = valid_pixels(inputs['lai'], inputs['mask'])
+    packed = {name: inputs[name].ravel()[index] for name in PACKED_INPUTS if name in inputs}
+    return packed, index, n_soil
+
+
+def unpack_output(band_name, data, index, shape):
+    # Scatter packed model outputs back into a full scene array
+    if band_name == 'quality_flag':
+        output = np.full(shape, FLAG_NO_DATA, data.dtype)
+    else:
+        output = np.full(shape, np.nan, np.float32)
+    output.ravel()[index] = data
+    return output
+
+
+def calc_packed_energy_fluxes(packed, n_soil, soil_roughness, alpha_pt,
+                              atmospheric_measurement_height, green_vegetation_emissivity,
+                              soil_emissivity):
+
+    lst = packed['lst']
+    vza = packed['vza']
+    lai = packed['lai']
+    lad = packed['lad']
+    frac_cover = packed['frac_cover']
+    h_w_ratio = packed['h_w_ratio']
+    leaf_width = packed['leaf_width']
+    veg_height = packed['veg_height']
+    frac_green = packed['frac_green']
+    z_0M = packed['z_0M']
+    d_0 = packed['d_0']
+    ta = packed['ta']
+    u = packed['u']
+    ea = packed['ea']
+    p = packed['p']
+    shortwave_rad_c = packed['shortwave_rad_c']
+    shortwave_rad_s = packed['shortwave_rad_s']
+    longwave_irrad = packed['longwave_irrad']
 
     # Model outputs
     t_s = np.full(lai.shape, np.nan, np.float32)
@@ -71,11 +159,11 @@ def main(lst, lst_vza, lai, csp, fgv, ar, mi, nsr, li, mask, soil_roughness,alph
     u_friction = np.full(lai.shape, np.nan, np.float32)
     mol = np.full(lai.shape, np.nan, np.float32)
     n_iterations = np.full(lai.shape, np.nan, np.float32)
-    flag = np.full(lai.shape, 255)
+    flag = np.full(lai.shape, FLAG_NO_DATA, np.uint8)
 
     # ======================================
     # First process bare soil cases
-    i = np.logical_and(lai <= 0, mask == 1)
+    i = slice(0, n_soil)
     t_s[i] = lst[i]
 
     # Calculate soil fluxes
@@ -101,7 +189,7 @@ def main(lst, lst_vza, lai, csp, fgv, ar, mi, nsr, li, mask, soil_roughness,alph
 
     # ======================================
     # Then process vegetated cases
-    i = np.logical_and(lai > 0, mask == 1)
+    i = slice(n_soil, None)
     # Emissivity of canopy containing green and non-green elements.
     emissivity_veg = green_vegetation_emissivity * frac_green[i] + 0.91 * (1 - frac_green[i])
 
@@ -142,45 +230,212 @@ def main(lst, lst_vza, lai, csp, fgv, ar, mi, nsr, li, mask, soil_roughness,alph
     r_nl = ln_c + ln_s
     r_n = r_ns + r_nl
 
-    band_data = [
-            {'band_name': 'sensible_heat_flux', 'band_data': h},
-            {'band_name': 'latent_heat_flux', 'band_data': le},
-            {'band_name': 'ground_heat_flux', 'band_data': g},
-            {'band_name': 'net_radiation', 'band_data': r_n},
-            {'band_name': 'quality_flag', 'band_data': flag}
-            ]
+    return {'sensible_heat_flux': h,
+            'latent_heat_flux': le,
+            'ground_heat_flux': g,
+            'net_radiation': r_n,
+            'quality_flag': flag,
+            'sensible_heat_flux_canopy': h_c,
+            'sensible_heat_flux_soil': h_s,
+            'latent_heat_flux_canopy': le_c,
+            'latent_heat_flux_soil': le_s,
+            'net_longwave_radiation_canopy': ln_c,
+            'net_longwave_radiation_soil': ln_s,
+            'temperature_canopy': t_c,
+            'temperature_soil': t_s,
+            'temperature_canopy_air': t_ac,
+            'resistance_surface': r_a,
+            'resistance_canopy': r_x,
+            'resistance_soil': r_s,
+            'friction_velocity': u_friction,
+            'monin_obukhov_length': mol}
+
 
+def calc_energy_fluxes(inputs, soil_roughness, alpha_pt, atmospheric_measurement_height,
+                       green_vegetation_emissivity, soil_emissivity, band_names=None):
+    # Only the requested bands (all by default) are scattered back to full scene arrays
+    shape = inputs['lai'].shape
+    packed, index, n_soil = pack_inputs(inputs)
+    outputs = calc_packed_energy_fluxes(packed, n_soil, soil_roughness, alpha_pt,
+                                        atmospheric_measurement_height,
+                                        green_vegetation_emissivity, soil_emissivity)
+    packed = None
+    if band_names is None:
+        band_names = list(outputs)
+    return {band_name: unpack_output(band_name, outputs[band_name], index, shape)
+            for band_name in band_names}
+
+
+def output_band_names(save_component_fluxes, save_component_temperature,
+                      save_aerodynamic_parameters):
+
+    band_names = ['sensible_heat_flux', 'latent_heat_flux', 'ground_heat_flux', 'net_radiation',
+                  'quality_flag']
     if save_component_fluxes:
-        band_data.extend(
-                [
-                    {'band_name': 'sensible_heat_flux_canopy', 'band_data': h_c},
-                    {'band_name': 'sensible_heat_flux_soil', 'band_data': h_s},
-                    {'band_name': 'latent_heat_flux_canopy', 'band_data': le_c},
-                    {'band_name': 'latent_heat_flux_soil', 'band_data': le_s},
-                    {'band_name': 'net_longwave_radiation_canopy', 'band_data': ln_c},
-                    {'band_name': 'net_longwave_radiation_soil', 'band_data': ln_s}
-                ]
-        )
+        band_names.extend(['sensible_heat_flux_canopy', 'sensible_heat_flux_soil',
+                           'latent_heat_flux_canopy', 'latent_heat_flux_soil',
+                           'net_longwave_radiation_canopy', 'net_longwave_radiation_soil'])
     if save_component_temperature:
-        band_data.extend(
-                [
-                    {'band_name': 'temperature_canopy', 'band_data': t_c}, 
-                    {'band_name': 'temperature_soil', 'band_data': t_s},
-                    {'band_name': 'temperature_canopy_air', 'band_data': t_ac}
-                ]
-        )
+        band_names.extend(['temperature_canopy', 'temperature_soil', 'temperature_canopy_air'])
     if save_aerodynamic_parameters:
-        band_data.extend(
-                [ 
-                    {'band_name': 'resistance_surface', 'band_data': r_a}, 
-                    {'band_name': 'resistance_canopy', 'band_data': r_x},
-                    {'band_name': 'resistance_soil', 'band_data': r_s},
-                    {'band_name': 'friction_velocity', 'band_data': u_friction},
-                    {'band_name': 'monin_obukhov_length', 'band_data': mol}
-                ]
-        )
-    
-    su.write_snappy_product(output_file, band_data, 'turbulentFluxes', geo_coding)
+        band_names.extend(['resistance_surface', 'resistance_canopy', 'resistance_soil',
+                           'friction_velocity', 'monin_obukhov_length'])
+    return band_names
+
+
+def output_bands(band_names):
+    # Band dictionaries, without data, of the output bands. Quality flags are stored as uint8
+    # and all the fluxes and parameters as float32.
+    bands = []
+    for band_name in band_names:
+        if band_name == 'quality_flag':
+            bands.append({'band_name': band_name, 'data_type': np.uint8,
+                          'no_data_value': FLAG_NO_DATA})
+        else:
+            bands.append({'band_name': band_name, 'data_type': np.float32})
+    return bands
+
+
+def write_packed_outputs(output_file, outputs, band_names, index, shape, geo_coding,
+                         output_format=None):
+    # Scatter the outputs back to the full scene one band at a time, as they are written
+    writer = ow.create_writer(output_file, output_bands(band_names), 'turbulentFluxes',
+                              geo_coding, shape[1], shape[0], output_format)
+    rect = su.Rect(0, 0, shape[1], shape[0])
+    try:
+        for band_name in band_names:
+            writer.write_tile(band_name, rect,
+                              unpack_output(band_name, outputs[band_name], index, shape))
+    except BaseException:
+        writer.discard()
+        raise
+    writer.close()
+
+
+def _calc_energy_fluxes_tile(inputs, model_params, band_names):
+    return calc_energy_fluxes(inputs, *model_params, band_names=band_names)
+
+
+def _write_tile(writer, rect, outputs):
+    for band_name, data in outputs.items():
+        writer.write_tile(band_name, rect, data)
+
+
+def run_tiled(input_files, model_params, band_names, output_file, tile_size, workers,
+              output_format=None):
+    # Since the model is evaluated independently for each pixel, processing the scene tile by
+    # tile gives the same results as processing it whole. Tiles are read and written by the
+    # main process, so only the numerical models run in the worker processes. The input
+    # products are opened once and each tile is read from the open products.
+    products = {}
+    try:
+        for name, file_path in input_files.items():
+            products[name] = su.open_snappy_product(file_path)
+        geo_coding = products['lai'].getSceneGeoCoding()
+        width = products['lai'].getSceneRasterWidth()
+        height = products['lai'].getSceneRasterHeight()
+        writer = ow.create_writer(output_file, output_bands(band_names), 'turbulentFluxes',
+                                  geo_coding, width, height, output_format)
+        try:
+            _run_tiles(products, model_params, band_names, writer, width, height, tile_size,
+                       workers)
+        except BaseException:
+            # Do not leave an incomplete output behind
+            writer.discard()
+            raise
+        writer.close()
+    finally:
+        for prod in products.values():
+            prod.closeIO()
+
+
+def _run_tiles(products, model_params, band_names, writer, width, height, tile_size, workers):
+    tiles = su.get_tiles(width, height, tile_size)
+
+    if workers == 1:
+        for rect in tiles:
+            inputs = read_inputs(rect=rect, **products)[0]
+            _write_tile(writer, rect, _calc_energy_fluxes_tile(inputs, model_params, band_names))
+        return
+
+    # Spawn fresh worker processes instead of forking the one running the JVM.
+    pool = multiprocessing.get_context('spawn').Pool(workers)
+    try:
+        # Limit the number of tiles in flight so that memory use stays bounded
+        pending = []
+        for rect in tiles:
+            inputs = read_inputs(rect=rect, **products)[0]
+            pending.append((rect, pool.apply_async(_calc_energy_fluxes_tile,
+                                                   (inputs, model_params, band_names))))
+            inputs = None
+            if len(pending) >= 2 * workers:
+                rect, result = pending.pop(0)
+                _write_tile(writer, rect, result.get())
+        for rect, result in pending:
+            _write_tile(writer, rect, result.get())
+    finally:
+        pool.close()
+        pool.join()
+
+
+@click.command()
+@click.option('--lst', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--lst_vza', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--lai', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--csp', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--fgv', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--ar', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--mi', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--nsr', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--li', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--mask', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--soil_roughness', required=True, type=click.FLOAT)
+@click.option('--alpha_pt', required=True, type=click.FLOAT)
+@click.option('--atmospheric_measurement_height', required=True, type=click.FLOAT)
+@click.option('--green_vegetation_emissivity', required=True, type=click.FLOAT)
+@click.option('--soil_emissivity', required=True, type=click.FLOAT)
+@click.option('--save_component_fluxes', required=True, type=click.BOOL)
+@click.option('--save_component_temperature', required=True, type=click.BOOL)
+@click.option('--save_aerodynamic_parameters', required=True, type=click.BOOL)
+@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@click.option('--tile_size', required=False, default=None, type=click.IntRange(1),
+              help='Process the scene in tiles of this size (pixels) instead of all at once.')
+@click.option('--workers', required=False, default=1, type=click.IntRange(1),
+              help='Number of processes used to run the models on the tiles.')
+@click.option('--output_format', required=False, default=None,
+              type=click.Choice(ow.OUTPUT_FORMATS),
+              help='Format of the output file. By default it is taken from the file extension.')
+@cache_utils.cached_stage(['lst', 'lst_vza', 'lai', 'csp', 'fgv', 'ar', 'mi', 'nsr', 'li',
+                           'mask'],
+                           ['output_file'], ignored=['tile_size', 'workers'])
+def main(lst, lst_vza, lai, csp, fgv, ar, mi, nsr, li, mask, soil_roughness,alpha_pt,
+        atmospheric_measurement_height, green_vegetation_emissivity, soil_emissivity,
+        save_component_fluxes, save_component_temperature, save_aerodynamic_parameters,
+        output_file, tile_size, workers, output_format):
+
+    input_files = {'lst': lst, 'lst_vza': lst_vza, 'lai': lai, 'csp': csp, 'fgv': fgv, 'ar': ar,
+                   'mi': mi, 'nsr': nsr, 'li': li, 'mask': mask}
+    model_params = (soil_roughness, alpha_pt, atmospheric_measurement_height,
+                    green_vegetation_emissivity, soil_emissivity)
+    band_names = output_band_names(save_component_fluxes, save_component_temperature,
+                                   save_aerodynamic_parameters)
+
+    if tile_size is None and workers > 1:
+        tile_size = DEFAULT_TILE_SIZE
+    if tile_size is not None:
+        run_tiled(input_files, model_params, band_names, output_file, tile_size, workers,
+                  output_format)
+        return
+
+    inputs, geo_coding = read_inputs(**input_files)
+    shape = inputs['lai'].shape
+    packed, index, n_soil = pack_inputs(inputs)
+    inputs = None
+    outputs = calc_packed_energy_fluxes(packed, n_soil, *model_params)
+    packed = None
+
+    write_packed_outputs(output_file, outputs, band_names, index, shape, geo_coding,
+                         output_format)
 
 
 if __name__ == "__main__":
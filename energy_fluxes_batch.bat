@@ -0,0 +1 @@
+"%~dp0\..\python.exe" "%~dp0\energy_fluxes_batch.py" %*
@@ -0,0 +1,133 @@
+import csv
+import multiprocessing
+import os
+
+import click
+
+import energy_fluxes as ef
+import output_writers as ow
+
+
+# Columns of the CSV file listing the inputs and output of each date
+DATE_COLUMNS = ['lst', 'lst_vza', 'mi', 'nsr', 'li', 'output_file']
+
+# Packed static inputs and model parameters of a worker process, set by _init_worker
+_worker_state = {}
+
+
+def read_dates_file(dates_file):
+    with open(dates_file, 'r', newline='') as fp:
+        dates = list(csv.DictReader(fp))
+    if len(dates) == 0:
+        raise RuntimeError(dates_file + " does not list any dates")
+    for column in DATE_COLUMNS:
+        if column not in dates[0]:
+            raise RuntimeError(f'Missing {column} column in {dates_file}')
+    # Relative paths are relative to the location of the CSV file
+    base_dir = os.path.dirname(os.path.abspath(dates_file))
+    return [{column: os.path.join(base_dir, date[column].strip()) for column in DATE_COLUMNS}
+            for date in dates]
+
+
+def _init_worker(static, n_soil, model_params, band_names):
+    _worker_state['static'] = static
+    _worker_state['n_soil'] = n_soil
+    _worker_state['model_params'] = model_params
+    _worker_state['band_names'] = band_names
+
+
+def _calc_date(packed):
+    packed.update(_worker_state['static'])
+    outputs = ef.calc_packed_energy_fluxes(packed, _worker_state['n_soil'],
+                                           *_worker_state['model_params'])
+    return {band_name: outputs[band_name] for band_name in _worker_state['band_names']}
+
+
+def _read_date(date, index, n_soil):
+    inputs = ef.read_date_inputs(date['lst'], date['lst_vza'], date['mi'], date['nsr'],
+                                 date['li'])
+    return ef.pack_inputs(inputs, index, n_soil)[0]
+
+
+def run_batch(dates, static_files, model_params, band_names, workers, output_format=None):
+    # The static inputs are read and packed only once. For each date the main process reads
+    # and packs the remaining inputs and writes the outputs, while the models run in the
+    # worker processes, which hold their own copy of the packed static inputs.
+    inputs, geo_coding = ef.read_static_inputs(**static_files)
+    shape = inputs['lai'].shape
+    static, index, n_soil = ef.pack_inputs(inputs)
+    inputs = None
+
+    def write(date, outputs):
+        ef.write_packed_outputs(date['output_file'], outputs, band_names, index, shape,
+                                geo_coding, output_format)
+        print('INFO: Saved ' + date['output_file'])
+
+    if workers == 1:
+        _init_worker(static, n_soil, model_params, band_names)
+        for date in dates:
+            write(date, _calc_date(_read_date(date, index, n_soil)))
+        return
+
+    # Spawn fresh worker processes instead of forking the one running the JVM.
+    pool = multiprocessing.get_context('spawn').Pool(
+        workers, _init_worker, (static, n_soil, model_params, band_names))
+    try:
+        # Limit the number of dates in flight so that memory use stays bounded
+        pending = []
+        for date in dates:
+            packed = _read_date(date, index, n_soil)
+            pending.append((date, pool.apply_async(_calc_date, (packed,))))
+            packed = None
+            if len(pending) >= 2 * workers:
+                date, result = pending.pop(0)
+                write(date, result.get())
+        for date, result in pending:
+            write(date, result.get())
+    finally:
+        pool.close()
+        pool.join()
+
+
+@click.command()
+@click.option('--dates_file', required=True, type=click.Path(dir_okay=False, exists=True),
+              help='CSV file with the columns ' + ', '.join(DATE_COLUMNS) + ' and one row per '
+                   'date.')
+@click.option('--lai', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--csp', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--fgv', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--ar', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--mask', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--soil_roughness', required=True, type=click.FLOAT)
+@click.option('--alpha_pt', required=True, type=click.FLOAT)
+@click.option('--atmospheric_measurement_height', required=True, type=click.FLOAT)
+@click.option('--green_vegetation_emissivity', required=True, type=click.FLOAT)
+@click.option('--soil_emissivity', required=True, type=click.FLOAT)
+@click.option('--save_component_fluxes', required=True, type=click.BOOL)
+@click.option('--save_component_temperature', required=True, type=click.BOOL)
+@click.option('--save_aerodynamic_parameters', required=True, type=click.BOOL)
+@click.option('--workers', required=False, default=1, type=click.IntRange(1),
+              help='Number of processes used to run the models on the dates.')
+@click.option('--output_format', required=False, default=None,
+              type=click.Choice(ow.OUTPUT_FORMATS),
+              help='Format of the output files. By default it is taken from the file extension.')
+def main(dates_file, lai, csp, fgv, ar, mask, soil_roughness, alpha_pt,
+         atmospheric_measurement_height, green_vegetation_emissivity, soil_emissivity,
+         save_component_fluxes, save_component_temperature, save_aerodynamic_parameters,
+         workers, output_format):
+
+    dates = read_dates_file(dates_file)
+    static_files = {'lai': lai, 'csp': csp, 'fgv': fgv, 'ar': ar, 'mask': mask}
+    model_params = (soil_roughness, alpha_pt, atmospheric_measurement_height,
+                    green_vegetation_emissivity, soil_emissivity)
+    band_names = ef.output_band_names(save_component_fluxes, save_component_temperature,
+                                      save_aerodynamic_parameters)
+
+    run_batch(dates, static_files, model_params, band_names, workers, output_format)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print("ERROR:" + str(e))
@@ -0,0 +1 @@
+"${0%/*}"/../bin/python "${0%/*}"/energy_fluxes_batch.py "$@"
@@ -3,39 +3,75 @@ import numpy as np
 
 from pyTSEB import TSEB
 
+import cache_utils
 import snappy_utils as su
 
 
+# Maximum number of iterations of the f_g fixed-point solver
+MAX_ITERATIONS = 50
+
+
+def calc_frac_green(sza, lai, fapar, min_frac_green):
+
+    # Calculate fraction of vegetation which is green
+    f_g = np.ones(lai.shape, np.float32)
+    # For pixels where LAI or FAPAR are below tolerance threshold of the S2 biophysical
+    # processor, assume that the soil is bare and f_g = 1
+    bare = np.logical_or(lai <= 0.2, fapar <= 0.1)
+
+    # Iterate until f_g converges. Converged pixels do not change any more, so only the
+    # unconverged ones are kept, packed into 1-D arrays which shrink with every iteration.
+    f_g_flat = f_g.ravel()
+    index = np.flatnonzero(~bare)
+    sza_a = sza.ravel()[index]
+    lai_a = lai.ravel()[index]
+    fapar_a = fapar.ravel()[index]
+    f_g_a = f_g_flat[index]
+    histogram = [lai.size - index.size]
+    for _ in range(MAX_ITERATIONS):
+        fipar = TSEB.calc_F_theta_campbell(sza_a, lai_a / f_g_a, w_C=1, Omega0=1, x_LAD=1)
+        f_g_new = np.clip((fapar_a / fipar).astype(np.float32), min_frac_green, 1.)
+        f_g_flat[index] = f_g_new
+        active = ~np.logical_or(np.isnan(f_g_new), np.abs(f_g_new - f_g_a) < 0.02)
+        histogram.append(index.size - np.count_nonzero(active))
+        index = index[active]
+        if index.size == 0:
+            break
+        sza_a = sza_a[active]
+        lai_a = lai_a[active]
+        fapar_a = fapar_a[active]
+        f_g_a = f_g_new[active]
+
+    _print_iteration_histogram(histogram, index.size)
+    return f_g
+
+
+def _print_iteration_histogram(histogram, n_unconverged):
+    print('INFO: Number of pixels by iterations needed for f_g to converge:')
+    for iterations, count in enumerate(histogram):
+        if count > 0:
+            print('INFO:   %d: %d' % (iterations, count))
+    if n_unconverged > 0:
+        print('INFO:   not converged after %d: %d' % (MAX_ITERATIONS, n_unconverged))
+
+
 @click.command()
 @click.option('--sza_file', required=True, type=click.Path(dir_okay=False, exists=True))
 @click.option('--biophysical_file', required=True, type=click.Path(dir_okay=False, exists=True))
 @click.option('--min_frac_green', required=True, type=click.FloatRange(min=0.01, max=1))
 @click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@cache_utils.cached_stage(['sza_file', 'biophysical_file'], ['output_file'])
 def main(sza_file, biophysical_file, min_frac_green, output_file):
 
     # Read the required data
-    fapar, geo_coding = su.read_snappy_product(biophysical_file, 'fapar')
-    fapar = fapar.astype(np.float32)
-    lai = su.read_snappy_product(biophysical_file, 'lai')[0].astype(np.float32)
-    sza = su.read_snappy_product(sza_file, 'sun_zenith')[0].astype(np.float32)
+    biophysical, geo_coding = su.read_snappy_bands(biophysical_file, ['fapar', 'lai'],
+                                                   dtype=np.float32)
+    fapar = biophysical['fapar']
+    lai = biophysical['lai']
+    biophysical = None
+    sza = su.read_snappy_product(sza_file, 'sun_zenith', dtype=np.float32)[0]
 
-    # Calculate fraction of vegetation which is green
-    f_g = np.ones(lai.shape, np.float32)
-    # Iterate until f_g converges
-    converged = np.zeros(lai.shape, dtype=bool)
-    # For pixels where LAI or FAPAR are below tolerance threshold of the S2 biophysical
-    # processor, assume that the soil is bare and f_g = 1
-    converged[np.logical_or(lai <= 0.2, fapar <= 0.1)] = True
-    for c in range(50):
-        f_g_old = f_g.copy()
-        fipar = TSEB.calc_F_theta_campbell(sza[~converged],
-                                           lai[~converged]/f_g[~converged],
-                                           w_C=1, Omega0=1, x_LAD=1)
-        f_g[~converged] = fapar[~converged] / fipar
-        f_g = np.clip(f_g, min_frac_green, 1.)
-        converged = np.logical_or(np.isnan(f_g), np.abs(f_g - f_g_old) < 0.02)
-        if np.all(converged):
-            break
+    f_g = calc_frac_green(sza, lai, fapar, min_frac_green)
 
     su.write_snappy_product(output_file, [{'band_name': 'frac_green', 'band_data': f_g}],
                             'fracGreen', geo_coding)
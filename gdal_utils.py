@@ -39,11 +39,17 @@ def save_image(data, geotransform, projection, filename):
     return saveImg(data, geotransform, projection, filename)
 
 
-def resample_with_gdalwarp(src, template, resample_alg="cubicspline"):
+def resample_with_gdalwarp(src, template, resample_alg="cubicspline", multithread=False,
+                           warp_memory_limit=None, warp_options=()):
     # Get template projection, extent and resolution
     proj, gt, sizeX, sizeY, extent, _ = raster_info(template)
 
-    # Resample with GDAL warp
+    # Resample with GDAL warp. With multithread the computation and the I/O overlap and the
+    # warping itself uses all CPUs. warp_memory_limit is the size of the working buffer in MB.
+    # warp_options are other GDAL warp options, as NAME=VALUE strings.
+    warp_options = list(warp_options)
+    if multithread:
+        warp_options.append("NUM_THREADS=ALL_CPUS")
     out_ds = gdal.Warp("",
                        src,
                        format="MEM",
@@ -51,7 +57,10 @@ def resample_with_gdalwarp(src, template, resample_alg="cubicspline"):
                        xRes=gt[1],
                        yRes=gt[5],
                        outputBounds=extent,
-                       resampleAlg=resample_alg)
+                       resampleAlg=resample_alg,
+                       multithread=multithread,
+                       warpOptions=warp_options,
+                       warpMemoryLimit=warp_memory_limit)
     return out_ds
 
 
@@ -1,6 +1,7 @@
 import click
 import numpy as np
 
+import cache_utils
 import snappy_utils as su
 
 
@@ -37,28 +38,37 @@ def watercloud_model(param, a, b, c):
 
     return result
 
-@click.command()
-@click.option('--biophysical_file', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
-def main(biophysical_file, output_file):
 
-    # Read the required data
-    lai_cab, geo_coding = su.read_snappy_product(biophysical_file, 'lai_cab')
-    lai_cw = su.read_snappy_product(biophysical_file, 'lai_cw')[0]
-    
+def calc_leaf_spectra(lai_cab, lai_cw):
+
     cab = np.clip(np.array(lai_cab), 0.0, 140.0)
     refl_vis, trans_vis = cab_to_vis_spectrum(cab)
 
     cw = np.clip(np.array(lai_cw), 0.0, 0.1)
     refl_nir, trans_nir = cw_to_nir_spectrum(cw)
 
-    su.write_snappy_product(output_file, [
+    return [
         {'band_name': 'refl_vis_c', 'band_data': refl_vis},
         {'band_name': 'refl_nir_c', 'band_data': refl_nir},
         {'band_name': 'trans_vis_c', 'band_data': trans_vis},
         {'band_name': 'trans_nir_c', 'band_data': trans_nir}
-        ],
-        'leafSpectra', geo_coding)
+        ]
+
+
+@click.command()
+@click.option('--biophysical_file', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@cache_utils.cached_stage(['biophysical_file'], ['output_file'])
+def main(biophysical_file, output_file):
+
+    # Read the required data
+    biophysical, geo_coding = su.read_snappy_bands(biophysical_file, ['lai_cab', 'lai_cw'])
+    lai_cab = biophysical['lai_cab']
+    lai_cw = biophysical['lai_cw']
+
+    band_data = calc_leaf_spectra(lai_cab, lai_cw)
+
+    su.write_snappy_product(output_file, band_data, 'leafSpectra', geo_coding)
 
 
 if __name__ == "__main__":
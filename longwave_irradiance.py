@@ -2,9 +2,19 @@ import click
 import numpy as np
 
 import pyTSEB.net_radiation as rad
+import cache_utils
 import snappy_utils as su
 
 
+def calc_longwave_irradiance(at, vp, ap, at_height):
+
+    irrad = rad.calc_longwave_irradiance(vp, at, ap, at_height)
+
+    return [
+            {'band_name': 'longwave_irradiance', 'band_data': irrad}
+    ]
+
+
 @click.command()
 @click.option('--meteo_product', required=True, type=click.Path(dir_okay=False, exists=True))
 @click.option('--at_band', required=True)
@@ -12,19 +22,18 @@ import snappy_utils as su
 @click.option('--ap_band', required=True)
 @click.option('--at_height', required=True, type=click.FLOAT)
 @click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@cache_utils.cached_stage(['meteo_product'], ['output_file'])
 def main(meteo_product, at_band, vp_band, ap_band, at_height, output_file):
     
 
-    at, geo_coding = su.read_snappy_product(meteo_product, at_band)
-    at = at.astype(np.float32)
-    vp = su.read_snappy_product(meteo_product, vp_band)[0].astype(np.float32)
-    ap = su.read_snappy_product(meteo_product, ap_band)[0].astype(np.float32)
+    meteo, geo_coding = su.read_snappy_bands(meteo_product, [at_band, vp_band, ap_band],
+                                             dtype=np.float32)
+    at = meteo[at_band]
+    vp = meteo[vp_band]
+    ap = meteo[ap_band]
+    meteo = None
 
-    irrad = rad.calc_longwave_irradiance(vp, at, ap, at_height)
-    
-    band_data = [
-            {'band_name': 'longwave_irradiance', 'band_data': irrad}
-    ]
+    band_data = calc_longwave_irradiance(at, vp, ap, at_height)
 
     su.write_snappy_product(output_file, band_data, 'longwaveIrradiance', geo_coding)
 
@@ -4,46 +4,119 @@ import numpy as np
 import pyTSEB.net_radiation as rad
 import pyTSEB.clumping_index as ci
 
+import cache_utils
 import snappy_utils as su
 
 
-@click.command()
-@click.option('--lsp_product', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--lai_product', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--csp_product', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--mi_product', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--sza_product', required=True, type=click.Path(dir_okay=False, exists=True))
-@click.option('--soil_ref_vis', required=True, type=click.FLOAT)
-@click.option('--soil_ref_nir', required=True, type=click.FLOAT)
-@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
-def main(lsp_product, lai_product, csp_product, mi_product, sza_product, soil_ref_vis,
-        soil_ref_nir ,output_file):
-    
+# Tabulated Campbell mode. The diffuse canopy transmittance taud is the only term of
+# rad.calc_Sn_Campbell which needs an angular integration per pixel, and it depends only on the
+# leaf angle distribution and the effective LAI. It is tabulated over both and interpolated
+# bilinearly. With an effective LAI step of 0.01, and either the distinct leaf angle
+# distribution values of the scene (at most TABLE_MAX_LAD_VALUES) or a step of TABLE_LAD_STEP,
+# the interpolated taud differs from the integrated one by less than 1e-4.
+TABLE_LAI_EFF_STEP = 0.01
+TABLE_LAD_STEP = 0.02
+TABLE_MAX_LAD_VALUES = 32
+# Pixels with a larger effective LAI are integrated
+TABLE_LAI_EFF_MAX = 20.0
 
-    
-    refl_vis_c, geo_coding = su.read_snappy_product(lsp_product, 'refl_vis_c')
-    refl_vis_c = refl_vis_c.astype(np.float32)
-    refl_nir_c = su.read_snappy_product(lsp_product, 'refl_nir_c')[0].astype(np.float32)
-    trans_vis_c = su.read_snappy_product(lsp_product, 'trans_vis_c')[0].astype(np.float32)
-    trans_nir_c = su.read_snappy_product(lsp_product, 'trans_nir_c')[0].astype(np.float32)
 
-    lai = su.read_snappy_product(lai_product, 'lai')[0].astype(np.float32)
+def _calc_K_be_campbell(theta, x_lad):
+    # Beam extinction coefficient of an ellipsoidal leaf angle distribution, theta in radians
+    return np.sqrt(x_lad**2 + np.tan(theta)**2) / (x_lad + 1.774 * (x_lad + 1.182)**-0.733)
 
 
-    lad = su.read_snappy_product(csp_product, 'veg_inclination_distribution')[0].astype(np.float32)
-    frac_cover = su.read_snappy_product(csp_product, 'veg_fractional_cover')[0].astype(np.float32)
-    hw_ratio = su.read_snappy_product(csp_product, 'veg_height_width_ratio')[0].astype(np.float32)
-    
-    
-    p = su.read_snappy_product(mi_product, 'air_pressure')[0].astype(np.float32)
-    irradiance = su.read_snappy_product(mi_product, 'clear_sky_solar_radiation')[0].astype(np.float32)
-    
-    sza = su.read_snappy_product(sza_product, 'solar_zenith_tn')[0].astype(np.float32)
-   
+def _calc_taud(x_lad, lai_eff):
+    # Diffuse transmittance integrated over the hemisphere in 5 degree steps, as in pyTSEB
+    taud = 0
+    for angle in range(0, 90, 5):
+        angle = np.radians(angle)
+        taud = taud + (np.exp(-_calc_K_be_campbell(angle, x_lad) * lai_eff) * np.cos(angle) *
+                       np.sin(angle) * np.radians(5))
+    return 2.0 * taud
+
+
+def build_taud_table(lad, lai_eff_max):
+    lai_eff_max = min(lai_eff_max, TABLE_LAI_EFF_MAX)
+    lad_axis = np.unique(lad[~np.isnan(lad)])
+    if lad_axis.size == 0:
+        # No vegetated pixel has a leaf angle distribution, so there is nothing to tabulate
+        return lad_axis, None
+    if lad_axis.size > TABLE_MAX_LAD_VALUES:
+        lad_axis = np.arange(lad_axis[0], lad_axis[-1] + TABLE_LAD_STEP, TABLE_LAD_STEP)
+    if lad_axis.size == 1:
+        lad_axis = np.append(lad_axis, lad_axis[0] + TABLE_LAD_STEP)
+    lai_eff_axis = np.arange(int(np.ceil(lai_eff_max / TABLE_LAI_EFF_STEP)) + 2) * \
+        TABLE_LAI_EFF_STEP
+    table = _calc_taud(lad_axis[:, np.newaxis], lai_eff_axis[np.newaxis, :])
+    return lad_axis, table
+
+
+def _interpolate_taud(lad_axis, table, lad, lai_eff):
+    if table is None:
+        return _calc_taud(lad, lai_eff)
+    j = np.clip(np.searchsorted(lad_axis, lad, side='right') - 1, 0, lad_axis.size - 2)
+    w_lad = np.clip((lad - lad_axis[j]) / (lad_axis[j + 1] - lad_axis[j]), 0, 1)
+    u = np.nan_to_num(lai_eff / TABLE_LAI_EFF_STEP)
+    i = np.clip(np.floor(u), 0, table.shape[1] - 2).astype(np.int64)
+    w_lai = u - i
+    taud = ((1 - w_lad) * ((1 - w_lai) * table[j, i] + w_lai * table[j, i + 1]) +
+            w_lad * ((1 - w_lai) * table[j + 1, i] + w_lai * table[j + 1, i + 1]))
+    # Pixels outside of the table, or with missing values, are integrated
+    outside = ~(lai_eff <= (table.shape[1] - 1) * TABLE_LAI_EFF_STEP)
+    outside |= np.isnan(lad) | (lad < lad_axis[0]) | (lad > lad_axis[-1])
+    if np.any(outside):
+        taud[outside] = _calc_taud(lad[outside], lai_eff[outside])
+    return taud
+
+
+def _calc_canopy_terms(k, rcpy, amean_sqrt, lai_eff, rho_soil):
+    # Transmittance and albedo of a canopy over soil, for extinction coefficient k
+    # (Campbell & Norman 1998, Eqs. 15.8 - 15.11)
+    rcpy_k = 2.0 * k * rcpy / (k + 1.0)
+    expfac = amean_sqrt * k * lai_eff
+    neg_exp = np.exp(-expfac)
+    d_neg_exp = np.exp(-2.0 * expfac)
+    tau = ((rcpy_k * rcpy_k - 1.0) * neg_exp /
+           ((rcpy_k * rho_soil - 1.0) + rcpy_k * (rcpy_k - rho_soil) * d_neg_exp))
+    fact = ((rcpy_k - rho_soil) / (rcpy_k * rho_soil - 1.0)) * d_neg_exp
+    albedo = (rcpy_k + fact) / (1.0 + rcpy_k * fact)
+    tau = np.where(np.isnan(tau), 1.0, tau)
+    albedo = np.where(np.isnan(albedo), rho_soil, albedo)
+    return tau, albedo
+
+
+def _calc_Sn_campbell_tabulated(sza, irradiance_dir, irradiance_dif, fvis, fnir, refl_vis_c,
+                                trans_vis_c, refl_nir_c, trans_nir_c, soil_ref_vis, soil_ref_nir,
+                                lad, lai_eff, taud):
+    # Same as rad.calc_Sn_Campbell, with the diffuse transmittance taken from the table.
+    # Soil reflectances are scalars.
+    akd = -np.log(taud) / lai_eff
+    akb = _calc_K_be_campbell(np.radians(sza), lad)
+    net_rad_c = 0
+    net_rad_s = 0
+    for rho_leaf, tau_leaf, rho_soil, f in [(refl_vis_c, trans_vis_c, soil_ref_vis, fvis),
+                                            (refl_nir_c, trans_nir_c, soil_ref_nir, fnir)]:
+        amean_sqrt = np.sqrt(1.0 - rho_leaf - tau_leaf)
+        rcpy = (1.0 - amean_sqrt) / (1.0 + amean_sqrt)
+        taudt, albd = _calc_canopy_terms(akd, rcpy, amean_sqrt, lai_eff, rho_soil)
+        taubt, albb = _calc_canopy_terms(akb, rcpy, amean_sqrt, lai_eff, rho_soil)
+        net_rad_c = net_rad_c + ((1.0 - taubt) * (1.0 - albb) * irradiance_dir * f +
+                                 (1.0 - taudt) * (1.0 - albd) * irradiance_dif * f)
+        net_rad_s = net_rad_s + (taubt * (1.0 - rho_soil) * irradiance_dir * f +
+                                 taudt * (1.0 - rho_soil) * irradiance_dif * f)
+    return net_rad_c, net_rad_s
+
+
+def calc_net_shortwave_radiation(refl_vis_c, refl_nir_c, trans_vis_c, trans_nir_c, lai, lad,
+                                 frac_cover, hw_ratio, p, irradiance, sza, soil_ref_vis,
+                                 soil_ref_nir, tabulated=False):
+
     net_rad_c = np.zeros(lai.shape, np.float32)
     net_rad_s = np.zeros(lai.shape, np.float32)
-    soil_ref_vis = np.full(lai.shape, soil_ref_vis, np.float32)
-    soil_ref_nir = np.full(lai.shape, soil_ref_nir, np.float32)
+    # Soil reflectances are broadcast as scalars, in the type of the other inputs
+    soil_ref_vis = np.float32(soil_ref_vis)
+    soil_ref_nir = np.float32(soil_ref_nir)
 
     #Estimate diffuse and direct irradiance
     difvis, difnir, fvis, fnir = rad.calc_difuse_ratio(irradiance, sza, p)
@@ -53,7 +126,7 @@ def main(lsp_product, lai_product, csp_product, mi_product, sza_product, soil_re
 
     # Net shortwave radition for bare soil
     i = lai <= 0
-    spectra_soil = fvis[i] * soil_ref_vis[i] + fnir[i] * soil_ref_nir[i]
+    spectra_soil = fvis[i] * soil_ref_vis + fnir[i] * soil_ref_nir
     net_rad_s[i] = (1. - spectra_soil) * (irradiance_dir[i] + irradiance_dif[i])
     
     # Net shortwave radiation for vegetated areas
@@ -63,28 +136,101 @@ def main(lsp_product, lai_product, csp_product, mi_product, sza_product, soil_re
     omega0 = ci.calc_omega0_Kustas(lai[i], frac_cover[i], lad[i], isLAIeff=True)
     omega = ci.calc_omega_Kustas(omega0, sza[i], hw_ratio[i])
     lai_eff = F * omega
-    [net_rad_c[i], net_rad_s[i]] = rad.calc_Sn_Campbell(lai[i],
-                                                        sza[i],
-                                                        irradiance_dir[i],
-                                                        irradiance_dif[i],
-                                                        fvis[i],
-                                                        fnir[i],
-                                                        refl_vis_c[i],
-                                                        trans_vis_c[i],
-                                                        refl_nir_c[i],
-                                                        trans_nir_c[i],
-                                                        soil_ref_vis[i],
-                                                        soil_ref_nir[i],
-                                                        lad[i],
-                                                        lai_eff
-                                                        )
-    
+    if tabulated:
+        lad_axis, table = build_taud_table(lad[i], np.nanmax(np.append(lai_eff, 0)))
+        taud = _interpolate_taud(lad_axis, table, lad[i], lai_eff)
+        [net_rad_c[i], net_rad_s[i]] = _calc_Sn_campbell_tabulated(sza[i],
+                                                                   irradiance_dir[i],
+                                                                   irradiance_dif[i],
+                                                                   fvis[i],
+                                                                   fnir[i],
+                                                                   refl_vis_c[i],
+                                                                   trans_vis_c[i],
+                                                                   refl_nir_c[i],
+                                                                   trans_nir_c[i],
+                                                                   soil_ref_vis,
+                                                                   soil_ref_nir,
+                                                                   lad[i],
+                                                                   lai_eff,
+                                                                   taud)
+    else:
+        # pyTSEB indexes the soil reflectances together with the other spectra, so they have
+        # to be arrays, but only of the vegetated pixels
+        n = np.count_nonzero(i)
+        [net_rad_c[i], net_rad_s[i]] = rad.calc_Sn_Campbell(lai[i],
+                                                            sza[i],
+                                                            irradiance_dir[i],
+                                                            irradiance_dif[i],
+                                                            fvis[i],
+                                                            fnir[i],
+                                                            refl_vis_c[i],
+                                                            trans_vis_c[i],
+                                                            refl_nir_c[i],
+                                                            trans_nir_c[i],
+                                                            np.full(n, soil_ref_vis, np.float32),
+                                                            np.full(n, soil_ref_nir, np.float32),
+                                                            lad[i],
+                                                            lai_eff
+                                                            )
 
-    band_data = [
+    return [
             {'band_name': 'net_shortwave_radiation_canopy', 'band_data': net_rad_c},
             {'band_name': 'net_shortwave_radiation_soil', 'band_data': net_rad_s}
     ]
 
+
+@click.command()
+@click.option('--lsp_product', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--lai_product', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--csp_product', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--mi_product', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--sza_product', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--soil_ref_vis', required=True, type=click.FLOAT)
+@click.option('--soil_ref_nir', required=True, type=click.FLOAT)
+@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@click.option('--tabulated', required=False, default=False, type=click.BOOL,
+              help='Interpolate the diffuse canopy transmittance from a table instead of '
+                   'integrating it for each pixel.')
+@cache_utils.cached_stage(['lsp_product', 'lai_product', 'csp_product', 'mi_product',
+                           'sza_product'],
+                           ['output_file'])
+def main(lsp_product, lai_product, csp_product, mi_product, sza_product, soil_ref_vis,
+        soil_ref_nir ,output_file, tabulated):
+    
+
+    
+    lsp, geo_coding = su.read_snappy_bands(lsp_product, ['refl_vis_c', 'refl_nir_c',
+                                                         'trans_vis_c', 'trans_nir_c'],
+                                           dtype=np.float32)
+    refl_vis_c = lsp['refl_vis_c']
+    refl_nir_c = lsp['refl_nir_c']
+    trans_vis_c = lsp['trans_vis_c']
+    trans_nir_c = lsp['trans_nir_c']
+    lsp = None
+
+    lai = su.read_snappy_product(lai_product, 'lai', dtype=np.float32)[0]
+
+    csp = su.read_snappy_bands(csp_product, ['veg_inclination_distribution',
+                                             'veg_fractional_cover',
+                                             'veg_height_width_ratio'],
+                               dtype=np.float32)[0]
+    lad = csp['veg_inclination_distribution']
+    frac_cover = csp['veg_fractional_cover']
+    hw_ratio = csp['veg_height_width_ratio']
+    csp = None
+
+    mi = su.read_snappy_bands(mi_product, ['air_pressure', 'clear_sky_solar_radiation'],
+                              dtype=np.float32)[0]
+    p = mi['air_pressure']
+    irradiance = mi['clear_sky_solar_radiation']
+    mi = None
+
+    sza = su.read_snappy_product(sza_product, 'solar_zenith_tn', dtype=np.float32)[0]
+
+    band_data = calc_net_shortwave_radiation(refl_vis_c, refl_nir_c, trans_vis_c, trans_nir_c,
+                                             lai, lad, frac_cover, hw_ratio, p, irradiance, sza,
+                                             soil_ref_vis, soil_ref_nir, tabulated)
+
     su.write_snappy_product(output_file, band_data, 'netShortwaveRadiation', geo_coding)
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+"""
+Writers of the processing outputs in BEAM-DIMAP, GeoTIFF and NetCDF4 formats.
+
+All writers are created from band dictionaries without data, like
+snappy_utils.create_snappy_product, and are then written band by band, whole or tile by tile,
+with write_tile and finished with close, or with discard to remove an incomplete output.
+"""
+
+import os
+import shutil
+
+import numpy as np
+
+import snappy_utils as su
+
+
+OUTPUT_FORMATS = ['DIMAP', 'GeoTIFF', 'NetCDF4']
+
+# Tile size of GeoTIFF outputs and chunk size of NetCDF4 outputs
+BLOCK_SIZE = 512
+
+# Overviews are added until the smallest one is below this size
+MIN_OVERVIEW_SIZE = 256
+
+
+def output_format_from_path(file_path):
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext in ['.tif', '.tiff']:
+        return 'GeoTIFF'
+    if ext in ['.nc', '.nc4']:
+        return 'NetCDF4'
+    return 'DIMAP'
+
+
+def _to_band_type(data, dtype, no_data_value, band_no_data_value=None):
+    # Where bands of several types share one file, as in GeoTIFF, the no-data value of a band
+    # can differ from that of the file, so its missing values are first set to NaN
+    if band_no_data_value is not None and no_data_value is not None and \
+            band_no_data_value != no_data_value:
+        data = np.where(data == band_no_data_value, np.nan, data)
+    # Integer bands cannot hold NaN, so the missing values become the band's no-data value
+    if np.issubdtype(dtype, np.integer) and data.dtype.kind == 'f' and \
+            no_data_value is not None:
+        data = np.where(np.isnan(data), no_data_value, data)
+    return data.astype(dtype, copy=False)
+
+
+def _remove_outputs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+class DimapWriter(object):
+
+    def __init__(self, file_path, bands, product_name, geo_coding, width, height):
+        self.file_path = os.path.splitext(file_path)[0] + '.dim'
+        self._product = su.create_snappy_product(file_path, bands, product_name, geo_coding,
+                                                 width, height)
+
+    def write_tile(self, band_name, rect, data):
+        su.write_snappy_tile(self._product, band_name, rect, data)
+
+    def close(self):
+        self._product.closeIO()
+
+    def discard(self):
+        self._product.closeIO()
+        _remove_outputs([self.file_path, os.path.splitext(self.file_path)[0] + '.data'])
+
+
+class GeoTiffWriter(object):
+    # Writes an internally tiled and compressed GeoTIFF with overviews. The data is first
+    # written to a temporary GeoTIFF, which is then copied to the output with the overviews
+    # placed before the image data, as required by Cloud-Optimized GeoTIFFs.
+
+    def __init__(self, file_path, bands, product_name, geo_coding, width, height,
+                 compress='DEFLATE'):
+        from gdal_utils import gdal
+        from osgeo import gdal_array
+        self._gdal = gdal
+        self.file_path = file_path
+        self._compress = compress
+        self._temp_path = os.path.splitext(file_path)[0] + '.tmp.tif'
+
+        # All bands of a GeoTIFF have the same data type and no-data value. The no-data values
+        # of the bands are mapped to that of the file when they are written.
+        self._dtype = np.result_type(*[su.band_data_type(b) for b in bands])
+        self._band_no_data_values = {b['band_name']: b.get('no_data_value') for b in bands}
+        if np.issubdtype(self._dtype, np.integer):
+            self._no_data_value = next((b['no_data_value'] for b in bands
+                                        if b.get('no_data_value') is not None), None)
+        else:
+            self._no_data_value = np.nan
+        self._band_index = {b['band_name']: i + 1 for i, b in enumerate(bands)}
+
+        crs_wkt, geotransform = su.get_geotransform(geo_coding)
+        driver = gdal.GetDriverByName('GTiff')
+        self._ds = driver.Create(self._temp_path, width, height, len(bands),
+                                 gdal_array.NumericTypeCodeToGDALTypeCode(self._dtype),
+                                 ['TILED=YES', 'BLOCKXSIZE=%d' % BLOCK_SIZE,
+                                  'BLOCKYSIZE=%d' % BLOCK_SIZE, 'COMPRESS=' + compress,
+                                  'BIGTIFF=IF_SAFER'])
+        self._ds.SetProjection(crs_wkt)
+        self._ds.SetGeoTransform(geotransform)
+        self._ds.SetMetadataItem('product_name', product_name)
+        for b in bands:
+            band = self._ds.GetRasterBand(self._band_index[b['band_name']])
+            band.SetDescription(b['band_name'])
+            if 'unit' in b.keys():
+                band.SetUnitType(b['unit'])
+            if self._no_data_value is not None:
+                band.SetNoDataValue(float(self._no_data_value))
+
+    def write_tile(self, band_name, rect, data):
+        band = self._ds.GetRasterBand(self._band_index[band_name])
+        band.WriteArray(_to_band_type(data, self._dtype, self._no_data_value,
+                                      self._band_no_data_values[band_name]), rect.x, rect.y)
+
+    def close(self):
+        gdal = self._gdal
+        if np.issubdtype(self._dtype, np.integer):
+            resampling = 'NEAREST'
+        else:
+            resampling = 'AVERAGE'
+
+        if gdal.GetDriverByName('COG') is not None:
+            self._ds = None
+            gdal.Translate(self.file_path, self._temp_path, format='COG',
+                           creationOptions=['BLOCKSIZE=%d' % BLOCK_SIZE,
+                                            'COMPRESS=' + self._compress,
+                                            'RESAMPLING=' + resampling, 'BIGTIFF=IF_SAFER'])
+        else:
+            # GDAL before 3.1 has no COG driver, so the layout is made by copying the overviews
+            # of the temporary file
+            levels = []
+            level = 2
+            while min(self._ds.RasterXSize, self._ds.RasterYSize) // level >= MIN_OVERVIEW_SIZE:
+                levels.append(level)
+                level *= 2
+            if levels:
+                self._ds.BuildOverviews(resampling, levels)
+            self._ds = None
+            gdal.Translate(self.file_path, self._temp_path, format='GTiff',
+                           creationOptions=['TILED=YES', 'BLOCKXSIZE=%d' % BLOCK_SIZE,
+                                            'BLOCKYSIZE=%d' % BLOCK_SIZE,
+                                            'COMPRESS=' + self._compress,
+                                            'COPY_SRC_OVERVIEWS=YES', 'BIGTIFF=IF_SAFER'])
+        os.remove(self._temp_path)
+
+    def discard(self):
+        self._ds = None
+        _remove_outputs([self._temp_path, self.file_path])
+
+
+class NetcdfWriter(object):
+    # Writes a CF NetCDF4 file with one chunked and zlib compressed variable per band, which
+    # can also be read by GDAL.
+
+    def __init__(self, file_path, bands, product_name, geo_coding, width, height,
+                 complevel=4):
+        import netCDF4
+        self.file_path = file_path
+        crs_wkt, geotransform = su.get_geotransform(geo_coding)
+
+        self._fid = netCDF4.Dataset(file_path, 'w', format='NETCDF4')
+        self._fid.title = product_name
+        self._fid.Conventions = 'CF-1.6'
+        self._fid.createDimension('y', height)
+        self._fid.createDimension('x', width)
+        if geotransform[2] == 0 and geotransform[4] == 0:
+            var = self._fid.createVariable('x', 'f8', ('x',))
+            var.standard_name = 'projection_x_coordinate'
+            var[:] = geotransform[0] + (np.arange(width) + 0.5) * geotransform[1]
+            var = self._fid.createVariable('y', 'f8', ('y',))
+            var.standard_name = 'projection_y_coordinate'
+            var[:] = geotransform[3] + (np.arange(height) + 0.5) * geotransform[5]
+        var = self._fid.createVariable('crs', 'i4')
+        var.crs_wkt = crs_wkt
+        var.spatial_ref = crs_wkt
+        var.GeoTransform = ' '.join(repr(float(v)) for v in geotransform)
+
+        chunk_sizes = (min(BLOCK_SIZE, height), min(BLOCK_SIZE, width))
+        self._no_data_values = {}
+        for b in bands:
+            dtype = su.band_data_type(b)
+            no_data_value = b.get('no_data_value')
+            if no_data_value is None and not np.issubdtype(dtype, np.integer):
+                no_data_value = np.nan
+            var = self._fid.createVariable(b['band_name'], dtype, ('y', 'x'), zlib=True,
+                                           complevel=complevel, shuffle=True,
+                                           chunksizes=chunk_sizes, fill_value=no_data_value)
+            var.set_auto_maskandscale(False)
+            var.grid_mapping = 'crs'
+            if 'description' in b.keys():
+                var.long_name = b['description']
+            if 'unit' in b.keys():
+                var.units = b['unit']
+            self._no_data_values[b['band_name']] = no_data_value
+
+    def write_tile(self, band_name, rect, data):
+        var = self._fid.variables[band_name]
+        var[rect.y:rect.y + rect.height, rect.x:rect.x + rect.width] = \
+            _to_band_type(data, var.dtype, self._no_data_values[band_name])
+
+    def close(self):
+        self._fid.close()
+
+    def discard(self):
+        self._fid.close()
+        _remove_outputs([self.file_path])
+
+
+_WRITERS = {'DIMAP': DimapWriter, 'GeoTIFF': GeoTiffWriter, 'NetCDF4': NetcdfWriter}
+
+
+def create_writer(file_path, bands, product_name, geo_coding, width, height, output_format=None):
+    # The format is taken from the file extension unless it is given explicitly
+    if output_format is None:
+        output_format = output_format_from_path(file_path)
+    return _WRITERS[output_format](file_path, bands, product_name, geo_coding, width, height)
+
+
+def write_product(file_path, bands, product_name, geo_coding, output_format=None):
+    # Same as snappy_utils.write_snappy_product, but in any of the output formats
+    (height, width) = bands[0]['band_data'].shape
+    writer = create_writer(file_path, bands, product_name, geo_coding, width, height,
+                           output_format)
+    rect = su.Rect(0, 0, width, height)
+    try:
+        for b in bands:
+            writer.write_tile(b['band_name'], rect, b['band_data'])
+    except BaseException:
+        writer.discard()
+        raise
+    writer.close()
+    return writer.file_path
@@ -0,0 +1 @@
+"%~dp0\..\python.exe" "%~dp0\sen_et_pipeline.py" %*
@@ -0,0 +1,199 @@
+import os
+import tempfile
+
+import click
+import numpy as np
+
+import leaf_spectra
+import frac_green
+import structural_params
+import aerodynamic_roughness
+import ecmwf_data_preparation
+import longwave_irradiance
+import net_shortwave_radiation
+import energy_fluxes
+import daily_evapotranspiration
+import output_writers as ow
+## snappy_utils should be imported last, as it modifies the system path
+import snappy_utils as su
+
+
+def _to_arrays(band_data):
+    # The arrays which are passed between the stages in memory have the same type in which the
+    # stage outputs are stored on disk.
+    return {b['band_name']: b['band_data'].astype(su.band_data_type(b), copy=False)
+            for b in band_data}
+
+
+def _save_intermediate(intermediate_dir, file_name, band_data, product_name, geo_coding):
+    if intermediate_dir is None:
+        return
+    su.write_snappy_product(os.path.join(intermediate_dir, file_name), band_data, product_name,
+                            geo_coding)
+
+
+@click.command()
+@click.option('--biophysical_file', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--sun_zenith_file', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--landcover_map', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--landcover_band', required=True)
+@click.option('--lookup_table', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--elevation_map', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--elevation_band', required=True)
+@click.option('--ecmwf_data_file', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--date_time_utc', required=True, type=click.DateTime(formats=['%Y-%m-%d %H:%M']))
+@click.option('--time_zone', required=True, type=click.IntRange(-12, 12))
+@click.option('--lst', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--lst_vza', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--lst_sza', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--mask', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--min_frac_green', required=True, type=click.FloatRange(min=0.01, max=1))
+@click.option('--soil_roughness', required=True, type=click.FLOAT)
+@click.option('--soil_ref_vis', required=True, type=click.FLOAT)
+@click.option('--soil_ref_nir', required=True, type=click.FLOAT)
+@click.option('--alpha_pt', required=True, type=click.FLOAT)
+@click.option('--atmospheric_measurement_height', required=True, type=click.FLOAT)
+@click.option('--green_vegetation_emissivity', required=True, type=click.FLOAT)
+@click.option('--soil_emissivity', required=True, type=click.FLOAT)
+@click.option('--save_component_fluxes', default=False, type=click.BOOL)
+@click.option('--save_component_temperature', default=False, type=click.BOOL)
+@click.option('--save_aerodynamic_parameters', default=False, type=click.BOOL)
+@click.option('--fluxes_output_file', required=True,
+              type=click.Path(dir_okay=False, exists=False))
+@click.option('--daily_et_output_file', required=True,
+              type=click.Path(dir_okay=False, exists=False))
+@click.option('--intermediate_dir', required=False, default=None,
+              type=click.Path(file_okay=False, exists=True),
+              help='If given, the output of every intermediate stage is also saved here.')
+@click.option('--output_format', required=False, default=None,
+              type=click.Choice(ow.OUTPUT_FORMATS),
+              help='Format of the output files. By default it is taken from the file extensions.')
+def main(biophysical_file, sun_zenith_file, landcover_map, landcover_band, lookup_table,
+         elevation_map, elevation_band, ecmwf_data_file, date_time_utc, time_zone, lst, lst_vza,
+         lst_sza, mask, min_frac_green, soil_roughness, soil_ref_vis, soil_ref_nir, alpha_pt,
+         atmospheric_measurement_height, green_vegetation_emissivity, soil_emissivity,
+         save_component_fluxes, save_component_temperature, save_aerodynamic_parameters,
+         fluxes_output_file, daily_et_output_file, intermediate_dir, output_format):
+    # Run the whole Sen-ET processing chain in one process. The stages are the same as in the
+    # stand-alone scripts, but their outputs are passed on in memory instead of through
+    # BEAM-DIMAP files, so all inputs have to be on the same (Sentinel-2) grid.
+
+    biophysical, geo_coding = su.read_snappy_bands(biophysical_file,
+                                                   ['lai', 'fapar', 'lai_cab', 'lai_cw'],
+                                                   dtype=np.float32)
+    lai = biophysical['lai']
+
+    print('INFO: Estimating leaf spectra...')
+    band_data = leaf_spectra.calc_leaf_spectra(biophysical['lai_cab'], biophysical['lai_cw'])
+    _save_intermediate(intermediate_dir, 'leaf_spectra.dim', band_data, 'leafSpectra',
+                       geo_coding)
+    lsp = _to_arrays(band_data)
+
+    print('INFO: Estimating fraction of green vegetation...')
+    sza = su.read_snappy_product(sun_zenith_file, 'sun_zenith', dtype=np.float32)[0]
+    f_g = frac_green.calc_frac_green(sza, lai, biophysical['fapar'], min_frac_green)
+    band_data = [{'band_name': 'frac_green', 'band_data': f_g}]
+    _save_intermediate(intermediate_dir, 'frac_green.dim', band_data, 'fracGreen', geo_coding)
+    fgv = _to_arrays(band_data)
+    biophysical = None
+    sza = None
+
+    print('INFO: Estimating structural parameters...')
+    landcover = su.read_snappy_product(landcover_map, landcover_band, dtype=None)[0]
+    lut = structural_params.read_lookup_table(lookup_table)
+    band_data = structural_params.calc_structural_params(landcover, lai, fgv['frac_green'], lut,
+                                                         True, True, True, True, True, True)
+    _save_intermediate(intermediate_dir, 'structural_params.dim', band_data, 'landcoverParams',
+                       geo_coding)
+    csp = _to_arrays(band_data)
+    landcover = None
+
+    print('INFO: Estimating aerodynamic roughness...')
+    band_data = aerodynamic_roughness.calc_aerodynamic_roughness(
+        lai, csp['veg_height'], csp['veg_height_width_ratio'], csp['veg_fractional_cover'],
+        csp['igbp_classification'], soil_roughness)
+    _save_intermediate(intermediate_dir, 'aerodynamic_roughness.dim', band_data,
+                       'aerodynamicRoughness', geo_coding)
+    ar = _to_arrays(band_data)
+
+    print('INFO: Preparing meteorological data...')
+    # Save elevation to GeoTIFF becasue it will need to be read by GDAL later
+    temp_file = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
+    temp_elev_path = temp_file.name
+    temp_file.close()
+    try:
+        su.copy_bands_to_file(elevation_map, temp_elev_path, [elevation_band])
+        band_data = ecmwf_data_preparation.prepare_meteo(temp_elev_path, ecmwf_data_file,
+                                                         date_time_utc, time_zone,
+                                                         True, True, True, True, True, True)
+    finally:
+        os.remove(temp_elev_path)
+    _save_intermediate(intermediate_dir, 'meteo.dim', band_data, 'ecmwfData', geo_coding)
+    mi = _to_arrays(band_data)
+
+    print('INFO: Estimating longwave irradiance...')
+    band_data = longwave_irradiance.calc_longwave_irradiance(mi['air_temperature'],
+                                                             mi['vapour_pressure'],
+                                                             mi['air_pressure'],
+                                                             atmospheric_measurement_height)
+    _save_intermediate(intermediate_dir, 'longwave_irradiance.dim', band_data,
+                       'longwaveIrradiance', geo_coding)
+    li = _to_arrays(band_data)
+
+    print('INFO: Estimating net shortwave radiation...')
+    lst_sza = su.read_snappy_product(lst_sza, 'solar_zenith_tn', dtype=np.float32)[0]
+    band_data = net_shortwave_radiation.calc_net_shortwave_radiation(
+        lsp['refl_vis_c'], lsp['refl_nir_c'], lsp['trans_vis_c'], lsp['trans_nir_c'], lai,
+        csp['veg_inclination_distribution'], csp['veg_fractional_cover'],
+        csp['veg_height_width_ratio'], mi['air_pressure'], mi['clear_sky_solar_radiation'],
+        lst_sza, soil_ref_vis, soil_ref_nir)
+    _save_intermediate(intermediate_dir, 'net_shortwave_radiation.dim', band_data,
+                       'netShortwaveRadiation', geo_coding)
+    nsr = _to_arrays(band_data)
+    lsp = None
+    lst_sza = None
+
+    print('INFO: Estimating energy fluxes...')
+    inputs = {'lst': su.read_snappy_product(lst, 'sharpened_LST', dtype=np.float32)[0],
+              'vza': su.read_snappy_product(lst_vza, 'sat_zenith_tn', dtype=np.float32)[0],
+              'lai': lai,
+              'lad': csp['veg_inclination_distribution'],
+              'frac_cover': csp['veg_fractional_cover'],
+              'h_w_ratio': csp['veg_height_width_ratio'],
+              'leaf_width': csp['veg_leaf_width'],
+              'veg_height': csp['veg_height'],
+              'frac_green': fgv['frac_green'],
+              'z_0M': ar['roughness_length'],
+              'd_0': ar['zero_plane_displacement'],
+              'ta': mi['air_temperature'],
+              'u': mi['wind_speed'],
+              'ea': mi['vapour_pressure'],
+              'p': mi['air_pressure'],
+              'shortwave_rad_c': nsr['net_shortwave_radiation_canopy'],
+              'shortwave_rad_s': nsr['net_shortwave_radiation_soil'],
+              'longwave_irrad': li['longwave_irradiance'],
+              'mask': su.read_snappy_product(mask, 'mask', dtype=np.uint8)[0]}
+    band_names = energy_fluxes.output_band_names(save_component_fluxes,
+                                                 save_component_temperature,
+                                                 save_aerodynamic_parameters)
+    outputs = energy_fluxes.calc_energy_fluxes(inputs, soil_roughness, alpha_pt,
+                                               atmospheric_measurement_height,
+                                               green_vegetation_emissivity, soil_emissivity,
+                                               band_names)
+    inputs = None
+    band_data = [dict(band, band_data=outputs[band['band_name']])
+                 for band in energy_fluxes.output_bands(band_names)]
+    ow.write_product(fluxes_output_file, band_data, 'turbulentFluxes', geo_coding, output_format)
+
+    print('INFO: Estimating daily evapotranspiration...')
+    band_data = daily_evapotranspiration.calc_daily_evapotranspiration(
+        outputs['latent_heat_flux'], mi['clear_sky_solar_radiation'],
+        mi['average_daily_solar_irradiance'])
+    ow.write_product(daily_et_output_file, band_data, 'dailySpectra', geo_coding, output_format)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print("ERROR:" + str(e))
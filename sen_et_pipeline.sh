@@ -0,0 +1 @@
+"${0%/*}"/../bin/python "${0%/*}"/sen_et_pipeline.py "$@"
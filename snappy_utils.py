@@ -1,7 +1,9 @@
 import numpy as np
 
 import os
+from collections import namedtuple
 import sys
+import xml.etree.ElementTree as ET
 snappy_dir = os.path.join(os.path.expanduser("~"), ".snap", "snap-python")
 if os.path.isdir(snappy_dir):    
     sys.path.append(snappy_dir)
@@ -9,34 +11,268 @@ else:
     dir_path = os.path.dirname(os.path.realpath(__file__))
     snappy_dir = os.path.join(dir_path, "..", "..", "..", "snap-python")
     sys.path.append(snappy_dir)
-from snappy import ProductIO, Product, ProductData, ProductUtils, String
 
+# Importing snappy starts the JVM, which takes several seconds. The import is therefore deferred
+# until a product is actually opened or created, so that scripts and code paths which never
+# touch SNAP start fast.
+_snappy = None
 
-def read_snappy_product(file_path, band_name=None):
-    prod = ProductIO.readProduct(file_path)
-    width = prod.getSceneRasterWidth()
-    height = prod.getSceneRasterHeight()
-    geo_coding = prod.getSceneGeoCoding()
-    data = np.empty((height, width))
-    if band_name is not None:
-        band = prod.getBand(band_name)
+
+def _import_snappy():
+    global _snappy
+    if _snappy is None:
+        import snappy
+        _snappy = snappy
+    return _snappy
+
+
+# Rectangular window of a product raster, in pixel coordinates
+Rect = namedtuple('Rect', ['x', 'y', 'width', 'height'])
+
+# Georeferencing of a BEAM-DIMAP product read without snappy. geotransform follows the GDAL
+# convention and crs_wkt is the OGC WKT of the map CRS.
+DimapGeoCoding = namedtuple('DimapGeoCoding', ['crs_wkt', 'geotransform', 'width', 'height'])
+
+# ENVI data type codes and the corresponding numpy types
+_ENVI_DATA_TYPES = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 12: 'u2', 13: 'u4', 14: 'i8',
+                    15: 'u8'}
+
+
+# Array types which Band.readPixels can fill directly
+_READ_PIXELS_TYPES = [np.dtype(np.int32), np.dtype(np.float32), np.dtype(np.float64)]
+
+# SNAP raster data types of the numpy types which can be stored in a product
+_PRODUCT_DATA_TYPES = {'int8': 'TYPE_INT8', 'int16': 'TYPE_INT16', 'int32': 'TYPE_INT32',
+                       'uint8': 'TYPE_UINT8', 'uint16': 'TYPE_UINT16', 'uint32': 'TYPE_UINT32',
+                       'float32': 'TYPE_FLOAT32', 'float64': 'TYPE_FLOAT64'}
+
+
+def band_data_type(band):
+    # Type in which a band dictionary is stored on disk. Bands are float32 unless they declare
+    # a 'data_type'. BEAM-DIMAP has no half precision floats, so float16 bands (e.g. previews)
+    # are only float16 in memory and are stored as float32.
+    data_type = np.dtype(band.get('data_type', np.float32))
+    if data_type == np.float16:
+        data_type = np.dtype(np.float32)
+    if data_type.name not in _PRODUCT_DATA_TYPES:
+        raise RuntimeError("Unsupported data type %s of band %s" % (data_type.name,
+                                                                    band['band_name']))
+    return data_type
+
+
+def _native_dtype(snappy, band):
+    # Geophysical values of scaled bands are floating point, whatever the raw type is
+    if band.isScalingApplied():
+        return np.dtype(np.float32)
+    for name, type_name in _PRODUCT_DATA_TYPES.items():
+        if band.getDataType() == getattr(snappy.ProductData, type_name):
+            return np.dtype(name)
+    return np.dtype(np.float64)
+
+
+def _full_rect(prod, rect):
+    if rect is None:
+        rect = Rect(0, 0, prod.getSceneRasterWidth(), prod.getSceneRasterHeight())
+    return rect
+
+
+def _read_band_pixels(band, rect, dtype):
+    # dtype None means the type in which the band is stored
+    if dtype is None:
+        dtype = _native_dtype(_import_snappy(), band)
+    dtype = np.dtype(dtype)
+    if dtype in _READ_PIXELS_TYPES:
+        data = np.empty((rect.height, rect.width), dtype)
+        band.readPixels(rect.x, rect.y, rect.width, rect.height, data)
+        return data
+    # Other types are read through the closest supported type and then narrowed
+    if dtype.kind in 'iub':
+        read_type = np.int32
     else:
-        band = prod.getBandAt(0)
+        read_type = np.float32
+    data = np.empty((rect.height, rect.width), read_type)
+    band.readPixels(rect.x, rect.y, rect.width, rect.height, data)
+    # Values which do not fit in the requested type would wrap around, so they are checked
+    # unless the band is stored in a type which fits
+    if dtype.kind in 'iu' and data.size > 0 and \
+            not np.can_cast(_native_dtype(_import_snappy(), band), dtype):
+        info = np.iinfo(dtype)
+        if data.min() < info.min or data.max() > info.max:
+            raise RuntimeError("Values of band %s are outside of the range of %s" %
+                               (band.getName(), dtype.name))
+    return data.astype(dtype)
+
+
+def open_snappy_product(file_path):
+    # A product opened once can be passed to read_snappy_product and read_snappy_bands instead
+    # of its path, to read several windows of it without opening it again. It has to be closed
+    # with closeIO() by the caller.
+    return _import_snappy().ProductIO.readProduct(file_path)
+
+
+def _open_product(file_path):
+    # Products given open are left open, those opened here have to be closed
+    if isinstance(file_path, str):
+        return open_snappy_product(file_path), file_path, True
+    return file_path, str(file_path.getFileLocation()), False
+
+
+def read_snappy_product(file_path, band_name=None, rect=None, dtype=np.float64):
+    prod, file_name, close = _open_product(file_path)
     try:
-        band.readPixels(0, 0, width, height, data)
-    except AttributeError:
-        prod.closeIO()
-        raise RuntimeError(file_path + " does not contain band " + band_name)
-    prod.closeIO()
+        rect = _full_rect(prod, rect)
+        geo_coding = prod.getSceneGeoCoding()
+        if band_name is not None:
+            band = prod.getBand(band_name)
+        else:
+            band = prod.getBandAt(0)
+        try:
+            data = _read_band_pixels(band, rect, dtype)
+        except AttributeError:
+            raise RuntimeError(file_name + " does not contain band " + band_name)
+    finally:
+        if close:
+            prod.closeIO()
     return data, geo_coding
 
 
+def read_snappy_bands(file_path, band_names, rect=None, dtype=np.float64):
+    # Open the product once and read all requested bands from it. dtype is either one type for
+    # all bands or a dictionary with the type of each band.
+    prod, file_name, close = _open_product(file_path)
+    try:
+        rect = _full_rect(prod, rect)
+        geo_coding = prod.getSceneGeoCoding()
+        bands = {}
+        for band_name in band_names:
+            if isinstance(dtype, dict):
+                band_type = dtype.get(band_name, np.float64)
+            else:
+                band_type = dtype
+            band = prod.getBand(band_name)
+            try:
+                bands[band_name] = _read_band_pixels(band, rect, band_type)
+            except AttributeError:
+                raise RuntimeError(file_name + " does not contain band " + band_name)
+    finally:
+        if close:
+            prod.closeIO()
+    return bands, geo_coding
+
+
+def read_dimap_bands(file_path, band_names, rect=None):
+    # Read bands of a BEAM-DIMAP product without snappy. The bands are returned as read-only
+    # memory maps of the ENVI image files in the product's .data directory, so only the pixels
+    # which are actually used get read from disk.
+    file_path = os.path.splitext(file_path)[0] + '.dim'
+    root = ET.parse(file_path).getroot()
+    width = int(root.findtext('Raster_Dimensions/NCOLS'))
+    height = int(root.findtext('Raster_Dimensions/NROWS'))
+    if rect is None:
+        rect = Rect(0, 0, width, height)
+
+    band_infos = {}
+    for band_info in root.iter('Spectral_Band_Info'):
+        band_infos[band_info.findtext('BAND_NAME')] = band_info
+    data_files = {}
+    for data_file in root.iter('Data_File'):
+        data_files[data_file.findtext('BAND_INDEX')] = data_file.find('DATA_FILE_PATH').get('href')
+
+    bands = {}
+    for band_name in band_names:
+        try:
+            band_info = band_infos[band_name]
+            header_path = data_files[band_info.findtext('BAND_INDEX')]
+        except KeyError:
+            raise RuntimeError(file_path + " does not contain band " + band_name)
+        header_path = os.path.join(os.path.dirname(file_path), header_path)
+        data = _memmap_envi_image(header_path)[rect.y:rect.y + rect.height,
+                                               rect.x:rect.x + rect.width]
+        # Apply the scaling to geophysical values, as Band.readPixels would do
+        scale = float(band_info.findtext('SCALING_FACTOR', '1.0'))
+        offset = float(band_info.findtext('SCALING_OFFSET', '0.0'))
+        if scale != 1.0 or offset != 0.0:
+            data = data * scale + offset
+        bands[band_name] = data
+
+    return bands, _read_dimap_geo_coding(root, width, height)
+
+
+def _memmap_envi_image(header_path):
+    header = {}
+    with open(header_path, 'r') as fp:
+        for line in fp:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                header[key.strip().lower()] = value.strip()
+    if header.get('interleave', 'bsq').lower() != 'bsq' or int(header.get('bands', 1)) != 1:
+        raise RuntimeError("Unsupported ENVI image organisation in " + header_path)
+    byte_order = '>' if header.get('byte order', '0') == '1' else '<'
+    dtype = np.dtype(byte_order + _ENVI_DATA_TYPES[int(header['data type'])])
+    return np.memmap(os.path.splitext(header_path)[0] + '.img', dtype=dtype, mode='r',
+                     offset=int(header.get('header offset', 0)),
+                     shape=(int(header['lines']), int(header['samples'])))
+
+
+def _read_dimap_geo_coding(root, width, height):
+    crs_wkt = root.findtext('Coordinate_Reference_System/WKT')
+    transform = root.findtext('Geoposition/IMAGE_TO_MODEL_TRANSFORM')
+    if crs_wkt is None or transform is None:
+        raise RuntimeError("Only map projected BEAM-DIMAP products can be read without snappy.")
+    # The transform is stored as the flat matrix of a Java AffineTransform
+    m00, m10, m01, m11, m02, m12 = [float(x) for x in transform.split(',')]
+    return DimapGeoCoding(crs_wkt.strip(), (m02, m00, m01, m12, m10, m11), width, height)
+
+
+def _to_snappy_geo_coding(geo_coding):
+    snappy = _import_snappy()
+    CRS = snappy.jpy.get_type('org.geotools.referencing.CRS')
+    CrsGeoCoding = snappy.jpy.get_type('org.esa.snap.core.datamodel.CrsGeoCoding')
+    AffineTransform = snappy.jpy.get_type('java.awt.geom.AffineTransform')
+    Rectangle = snappy.jpy.get_type('java.awt.Rectangle')
+    gt = geo_coding.geotransform
+    image_to_map = AffineTransform(gt[1], gt[4], gt[2], gt[5], gt[0], gt[3])
+    return CrsGeoCoding(CRS.parseWKT(geo_coding.crs_wkt),
+                        Rectangle(0, 0, geo_coding.width, geo_coding.height),
+                        image_to_map)
+
+
+def get_geotransform(geo_coding):
+    # CRS WKT and GDAL geotransform of a map projected geo-coding, read either with snappy or
+    # from a BEAM-DIMAP file
+    if isinstance(geo_coding, DimapGeoCoding):
+        return geo_coding.crs_wkt, geo_coding.geotransform
+    try:
+        crs_wkt = geo_coding.getMapCRS().toWKT()
+        image_to_map = geo_coding.getImageToMapTransform()
+    except AttributeError:
+        raise RuntimeError("Only map projected products can be written in this format.")
+    return crs_wkt, (image_to_map.getTranslateX(), image_to_map.getScaleX(),
+                     image_to_map.getShearX(), image_to_map.getTranslateY(),
+                     image_to_map.getShearY(), image_to_map.getScaleY())
+
+
 def write_snappy_product(file_path, bands, product_name, geo_coding):
     try:
         (height, width) = bands[0]['band_data'].shape
     except AttributeError:
         raise RuntimeError(bands[0]['band_name'] + "contains no data.")
-    product = Product(product_name, product_name, width, height)
+    product = create_snappy_product(file_path, bands, product_name, geo_coding, width, height)
+    rect = Rect(0, 0, width, height)
+    for b in bands:
+        write_snappy_tile(product, b['band_name'], rect, b['band_data'])
+    product.closeIO()
+
+
+def create_snappy_product(file_path, bands, product_name, geo_coding, width, height):
+    # Only band_name, description, unit, data_type and no_data_value of the band dictionaries
+    # are used here. Band data is written afterwards, whole or tile by tile, with
+    # write_snappy_tile and the product has to be closed with closeIO() once all the data is
+    # written.
+    snappy = _import_snappy()
+    product = snappy.Product(product_name, product_name, width, height)
+    if isinstance(geo_coding, DimapGeoCoding):
+        geo_coding = _to_snappy_geo_coding(geo_coding)
     product.setSceneGeoCoding(geo_coding)
 
     # Ensure that output is saved in BEAM-DIMAP format, otherwise writeHeader does not work.
@@ -45,22 +281,53 @@ def write_snappy_product(file_path, bands, product_name, geo_coding):
     # Bands have to be created before header is written but header has to be written before band
     # data is written.
     for b in bands:
-        band = product.addBand(b['band_name'], ProductData.TYPE_FLOAT32)
+        data_type = _PRODUCT_DATA_TYPES[band_data_type(b).name]
+        band = product.addBand(b['band_name'], getattr(snappy.ProductData, data_type))
         if 'description' in b.keys():
             band.setDescription(b['description'])
         if 'unit' in b.keys():
             band.setUnit(b['unit'])
-    product.setProductWriter(ProductIO.getProductWriter('BEAM-DIMAP'))
-    product.writeHeader(String(file_path))
-    for b in bands:
-        band = product.getBand(b['band_name'])
-        band.writePixels(0, 0, width, height, b['band_data'].astype(np.float32))
-    product.closeIO()
+        if b.get('no_data_value') is not None:
+            band.setNoDataValue(float(b['no_data_value']))
+            band.setNoDataValueUsed(True)
+    product.setProductWriter(snappy.ProductIO.getProductWriter('BEAM-DIMAP'))
+    product.writeHeader(snappy.String(file_path))
+    return product
+
+
+def write_snappy_tile(product, band_name, rect, data):
+    # Band.writePixels only takes int32, float32 and float64 arrays, which SNAP then converts to
+    # the data type of the band.
+    snappy = _import_snappy()
+    band = product.getBand(band_name)
+    data_type = band.getDataType()
+    if snappy.ProductData.isIntType(data_type):
+        if data.dtype.kind == 'f':
+            data = np.where(np.isnan(data), band.getNoDataValue(), data)
+        data = data.astype(np.int32, copy=False)
+    elif data_type == snappy.ProductData.TYPE_FLOAT64:
+        data = data.astype(np.float64, copy=False)
+    else:
+        data = data.astype(np.float32, copy=False)
+    band.writePixels(rect.x, rect.y, rect.width, rect.height, data)
+
+
+def get_tiles(width, height, tile_size):
+    # Split a raster into tiles of at most tile_size x tile_size pixels, row by row
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            yield Rect(x, y, min(tile_size, width - x), min(tile_size, height - y))
+
+
+def iterate_product_tiles(file_path, tile_size):
+    width, height = get_product_info(file_path)[3:5]
+    return get_tiles(width, height, tile_size)
 
 
 def copy_bands_to_file(src_file_path, dst_file_path, bands=None):
     # Get info from source product
-    src_prod = ProductIO.readProduct(src_file_path)
+    snappy = _import_snappy()
+    src_prod = snappy.ProductIO.readProduct(src_file_path)
     prod_name = src_prod.getName()
     prod_type = src_prod.getProductType()
     width = src_prod.getSceneRasterWidth()
@@ -69,10 +336,10 @@ def copy_bands_to_file(src_file_path, dst_file_path, bands=None):
         bands = src_prod.getBandNames()
 
     # Copy geocoding and selected bands from source to destination product
-    dst_prod = Product(prod_name, prod_type, width, height)
-    ProductUtils.copyGeoCoding(src_prod.getBandAt(0), dst_prod)
+    dst_prod = snappy.Product(prod_name, prod_type, width, height)
+    snappy.ProductUtils.copyGeoCoding(src_prod.getBandAt(0), dst_prod)
     for band in bands:
-        r = ProductUtils.copyBand(band, src_prod, dst_prod, True)
+        r = snappy.ProductUtils.copyBand(band, src_prod, dst_prod, True)
         if r is None:
             src_prod.closeIO()
             raise RuntimeError(src_file_path + " does not contain band " + band)
@@ -87,14 +354,15 @@ def copy_bands_to_file(src_file_path, dst_file_path, bands=None):
         file_type = 'GeoTIFF-BigTIFF'
     else:
         file_type = 'GeoTIFF-BigTIFF'
-    ProductIO.writeProduct(dst_prod, dst_file_path, file_type)
+    snappy.ProductIO.writeProduct(dst_prod, dst_file_path, file_type)
     src_prod.closeIO()
     dst_prod.closeIO()
 
 
 def get_bands_info(src_file_path):
     # Get info from source product
-    src_prod = ProductIO.readProduct(src_file_path)
+    snappy = _import_snappy()
+    src_prod = snappy.ProductIO.readProduct(src_file_path)
     bands = src_prod.getBands()
     bands_info = []
     for band in bands:
@@ -106,7 +374,8 @@ def get_bands_info(src_file_path):
 
 def get_product_info(src_file_path):
     # Get info from source product
-    prod = ProductIO.readProduct(src_file_path)
+    snappy = _import_snappy()
+    prod = snappy.ProductIO.readProduct(src_file_path)
     width = prod.getSceneRasterWidth()
     height = prod.getSceneRasterHeight()
     geo_coding = prod.getSceneGeoCoding()
@@ -3,18 +3,104 @@ import numpy as np
 
 from pyTSEB import TSEB
 
+import cache_utils
 import snappy_utils as su
-import snappy
 
 
-def _estimate_param_value(landcover, lut, band): 
-    param_value = np.ones(landcover.shape) + np.nan
+# Value of IGBP classification pixels with no land cover class
+IGBP_NO_DATA = -1
+
+
+def landcover_lut_rows(landcover, lut):
+    # Map the land cover class of every pixel to its row in the look-up table, with -1 for
+    # pixels without a class, through a dense array indexed by the class codes
+    classes = np.asarray(lut['landcover_class'])
+    codes = classes.astype(np.int64)
+    if np.any(codes != classes) or np.any(codes < 0):
+        raise RuntimeError('Land cover classes in the look-up table are not non-negative '
+                           'integers')
+    code_to_row = np.full(codes.max() + 2, -1, np.int16)
+    # Reversed so that the first row of a class wins, as with list.index
+    code_to_row[codes[::-1]] = np.arange(len(codes) - 1, -1, -1)
+
+    if np.issubdtype(landcover.dtype, np.floating):
+        valid = ~np.isnan(landcover)
+    else:
+        valid = np.ones(landcover.shape, bool)
+    # Classes above the largest one in the table all map to the extra last element of
+    # code_to_row, which is -1
+    landcover_codes = np.where(valid, landcover, 0)
+    landcover_codes = np.clip(landcover_codes, 0, len(code_to_row) - 1).astype(np.int32)
+    rows = code_to_row[landcover_codes]
+    unknown = np.logical_and(valid, np.logical_or(rows < 0, landcover_codes != landcover))
+    if np.any(unknown):
+        raise RuntimeError('Land cover classes %s are not in the look-up table' %
+                           ', '.join(str(c) for c in np.unique(landcover[unknown])))
+    rows[~valid] = -1
+    return rows
+
+
+def _lut_values(rows, lut, band, dtype=np.float32, fill_value=np.nan):
+    # One gather from the look-up table column, with fill_value appended to it for row -1
+    values = np.append(np.asarray(lut[band], dtype), np.array(fill_value, dtype))
+    return values[rows]
+
+
+# Parameters which have to be present in the look-up table
+PARAMS = ['veg_height', 'lai_max', 'is_herbaceous', 'veg_fractional_cover',
+          'veg_height_width_ratio', 'veg_leaf_width', 'veg_inclination_distribution',
+          'igbp_classification'
+          ]
+
+
+def read_lookup_table(lookup_table):
+    with open(lookup_table, 'r') as fp:
+        lines = fp.readlines()
+    headers = lines[0].rstrip().split(';')
+    values = [x.rstrip().split(';') for x in lines[1:]]
+    lut = {key: [float(x[idx]) for x in values if len(x) == len(headers)]
+            for idx, key in enumerate(headers)}
+
+    for param in PARAMS:
+        if param not in lut.keys():
+            raise RuntimeError(f'Missing {param} in the look-up table')
+    return lut
+
+
+def calc_structural_params(landcover, lai, fg, lut, produce_vh, produce_fc, produce_chwr,
+                           produce_lw, produce_lid, produce_igbp):
+
+    band_data = []
+    rows = landcover_lut_rows(landcover, lut)
+
+    if produce_vh:
+        param_value = _lut_values(rows, lut, 'veg_height')
+
+        # Vegetation height in herbaceous vegetation depends on plant area index
+        herbaceous = _lut_values(rows, lut, 'is_herbaceous', fill_value=0) == 1
+        if np.any(herbaceous):
+            # Computed in float32 from the stored height, as the per-class computation was
+            height = param_value[herbaceous]
+            pai = lai[herbaceous] / fg[herbaceous]
+            param_value[herbaceous] = \
+                0.1 * height + 0.9 * height * np.minimum((pai / height)**3.0, 1.0)
+        band_data.append({'band_name': 'veg_height', 'band_data': param_value})
+
+    for produce, band_name in [(produce_fc, 'veg_fractional_cover'),
+                               (produce_chwr, 'veg_height_width_ratio'),
+                               (produce_lw, 'veg_leaf_width'),
+                               (produce_lid, 'veg_inclination_distribution')]:
+        if produce:
+            band_data.append({'band_name': band_name,
+                              'band_data': _lut_values(rows, lut, band_name)})
+
+    if produce_igbp:
+        band_name = 'igbp_classification'
+        param_value = _lut_values(rows, lut, band_name, np.int16, IGBP_NO_DATA)
+        band_data.append({'band_name': band_name, 'band_data': param_value,
+                          'data_type': np.int16, 'no_data_value': IGBP_NO_DATA})
 
-    for lc_class in np.unique(landcover[~np.isnan(landcover)]):
-        lc_pixels = np.where(landcover == lc_class)
-        lc_index = lut['landcover_class'].index(lc_class)
-        param_value[lc_pixels] = lut[band][lc_index]
-    return param_value
+    return band_data
 
 
 @click.command()
@@ -30,74 +116,19 @@ def _estimate_param_value(landcover, lut, band):
 @click.option('--produce_lid',required=True, type=click.BOOL)
 @click.option('--produce_igbp',required=True, type=click.BOOL)
 @click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@cache_utils.cached_stage(['landcover_map', 'lai_map', 'fgv_map', 'lookup_table'], ['output_file'])
 def main(landcover_map, lai_map, fgv_map, landcover_band, lookup_table, produce_vh, produce_fc,
         produce_chwr, produce_lw, produce_lid, produce_igbp, output_file):
 
     # Read the required data
-
-    PARAMS = ['veg_height', 'lai_max', 'is_herbaceous', 'veg_fractional_cover',
-              'veg_height_width_ratio', 'veg_leaf_width', 'veg_inclination_distribution',
-              'igbp_classification'
-              ]
-    
-    landcover, geo_coding = su.read_snappy_product(landcover_map, landcover_band)
-    landcover = landcover.astype(np.float32)
-    lai = su.read_snappy_product(lai_map, 'lai')[0].astype(np.float32)
-    fg = su.read_snappy_product(fgv_map, 'frac_green')[0].astype(np.float32)
-    with open(lookup_table, 'r') as fp:
-        lines = fp.readlines()
-    headers = lines[0].rstrip().split(';')
-    values = [x.rstrip().split(';') for x in lines[1:]]
-    lut = {key: [float(x[idx]) for x in values if len(x) == len(headers)]
-            for idx, key in enumerate(headers)}
-
-    for param in PARAMS:
-        if param not in lut.keys():
-            print(f'Error: Missing {param} in the look-up table')
-            return
-
-    band_data = []
-    param_value = np.ones(landcover.shape, np.float32) + np.nan
-
-    if produce_vh:
-        for lc_class in np.unique(landcover[~np.isnan(landcover)]):
-            lc_pixels = np.where(landcover == lc_class)
-            lc_index = lut["landcover_class"].index(lc_class)
-            param_value[lc_pixels] = lut['veg_height'][lc_index]
-
-            # Vegetation height in herbaceous vegetation depends on plant area index
-            if lut["is_herbaceous"][lc_index] == 1:
-                pai = lai / fg
-                pai = pai[lc_pixels]
-                param_value[lc_pixels] = \
-                    0.1 * param_value[lc_pixels] + 0.9 * param_value[lc_pixels] *\
-                    np.minimum((pai / lut['veg_height'][lc_index])**3.0, 1.0)
-        band_data.append({'band_name': 'veg_height', 'band_data': param_value})
-    
-    if produce_fc:
-        band_name = 'veg_fractional_cover'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
-    
-    if produce_chwr:
-        band_name = 'veg_height_width_ratio'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
-
-    if produce_lw:
-        band_name = 'veg_leaf_width'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
-
-    if produce_lid:
-        band_name = 'veg_inclination_distribution'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
-
-    if produce_igbp:
-        band_name = 'igbp_classification'
-        param_value = _estimate_param_value(landcover, lut, band_name)
-        band_data.append({'band_name': band_name, 'band_data': param_value})
+    # Land cover is kept in the type in which it is stored
+    landcover, geo_coding = su.read_snappy_product(landcover_map, landcover_band, dtype=None)
+    lai = su.read_snappy_product(lai_map, 'lai', dtype=np.float32)[0]
+    fg = su.read_snappy_product(fgv_map, 'frac_green', dtype=np.float32)[0]
+    lut = read_lookup_table(lookup_table)
+
+    band_data = calc_structural_params(landcover, lai, fg, lut, produce_vh, produce_fc,
+                                       produce_chwr, produce_lw, produce_lid, produce_igbp)
 
     su.write_snappy_product(output_file, band_data, 'landcoverParams', geo_coding)
 
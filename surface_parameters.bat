@@ -0,0 +1 @@
+"%~dp0\..\python.exe" "%~dp0\surface_parameters.py" %*
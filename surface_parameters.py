@@ -0,0 +1,71 @@
+import click
+import numpy as np
+
+import leaf_spectra
+import frac_green
+import structural_params
+import aerodynamic_roughness
+import cache_utils
+import snappy_utils as su
+
+
+def calc_surface_parameters(biophysical, sza, landcover, lut, min_frac_green, soil_roughness):
+    # Run the leaf spectra, fraction of green vegetation, structural parameters and aerodynamic
+    # roughness stages one after the other on the same inputs. The returned bands have the same
+    # names as the outputs of the separate stages, so the product can be given to the later
+    # stages in place of any of their outputs.
+    lai = biophysical['lai']
+    band_data = leaf_spectra.calc_leaf_spectra(biophysical['lai_cab'], biophysical['lai_cw'])
+
+    f_g = frac_green.calc_frac_green(sza, lai, biophysical['fapar'], min_frac_green)
+    band_data.append({'band_name': 'frac_green', 'band_data': f_g})
+
+    csp = structural_params.calc_structural_params(landcover, lai, f_g, lut,
+                                                   True, True, True, True, True, True)
+    band_data.extend(csp)
+    csp = {b['band_name']: b['band_data'] for b in csp}
+
+    band_data.extend(aerodynamic_roughness.calc_aerodynamic_roughness(
+        lai, csp['veg_height'], csp['veg_height_width_ratio'], csp['veg_fractional_cover'],
+        csp['igbp_classification'], soil_roughness))
+
+    return band_data
+
+
+@click.command()
+@click.option('--biophysical_file', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--sza_file', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--landcover_map', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--landcover_band', required=True)
+@click.option('--lookup_table', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--min_frac_green', required=True, type=click.FloatRange(min=0.01, max=1))
+@click.option('--soil_roughness', required=True, type=click.FLOAT)
+@click.option('--output_file', required=True, type=click.Path(dir_okay=False, exists=False))
+@cache_utils.cached_stage(['biophysical_file', 'sza_file', 'landcover_map', 'lookup_table'],
+                           ['output_file'])
+def main(biophysical_file, sza_file, landcover_map, landcover_band, lookup_table, min_frac_green,
+         soil_roughness, output_file):
+
+    # Read the required data. The leaf spectra are computed in double precision, as in
+    # leaf_spectra.py.
+    biophysical, geo_coding = su.read_snappy_bands(biophysical_file,
+                                                   ['lai', 'fapar', 'lai_cab', 'lai_cw'],
+                                                   dtype={'lai': np.float32,
+                                                          'fapar': np.float32,
+                                                          'lai_cab': np.float64,
+                                                          'lai_cw': np.float64})
+    sza = su.read_snappy_product(sza_file, 'sun_zenith', dtype=np.float32)[0]
+    landcover = su.read_snappy_product(landcover_map, landcover_band, dtype=None)[0]
+    lut = structural_params.read_lookup_table(lookup_table)
+
+    band_data = calc_surface_parameters(biophysical, sza, landcover, lut, min_frac_green,
+                                        soil_roughness)
+
+    su.write_snappy_product(output_file, band_data, 'surfaceParameters', geo_coding)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print("ERROR:" + str(e))
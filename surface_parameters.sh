@@ -0,0 +1 @@
+"${0%/*}"/../bin/python "${0%/*}"/surface_parameters.py "$@"
@@ -0,0 +1,129 @@
+import datetime
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+
+netCDF4 = pytest.importorskip('netCDF4')
+pytest.importorskip('osgeo')
+pytest.importorskip('pyTSEB')
+import ecmwf_utils as eu
+
+
+VARIABLES = ['2m_temperature', 'surface_solar_radiation_downwards']
+SHORT_NAMES = {'2m_temperature': 't2m', 'surface_solar_radiation_downwards': 'ssrd'}
+TIME_UNITS = 'hours since 1900-01-01 00:00:00.0'
+FIRST_DAY = datetime.datetime(2019, 1, 30)
+FILL_VALUE = -32767
+
+
+def _expected_values(times, variable):
+    hours = np.array([(t - FIRST_DAY).total_seconds() / 3600 for t in times])
+    offset = 0 if variable == '2m_temperature' else 100
+    return 280 + offset + (hours % 50) * 0.5
+
+
+class FakeClient(object):
+    # Writes each requested chunk as CDS does: a netCDF3 file with the variable packed in
+    # int16, with a scale factor which is different for each month. The pixel in the first row
+    # and column is missing.
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def retrieve(self, name, request, target):
+        variable = request['variable'][0]
+        with self.lock:
+            self.requests.append((request['date'], variable))
+        if (request['date'], variable) in self.fail:
+            raise RuntimeError('CDS request failed')
+        start, end = [datetime.datetime.strptime(d, '%Y-%m-%d')
+                      for d in request['date'].split('/')]
+        times = [start + datetime.timedelta(hours=h)
+                 for h in range(((end - start).days + 1) * 24)]
+        with netCDF4.Dataset(target, 'w', format='NETCDF3_64BIT_OFFSET') as fid:
+            fid.createDimension('longitude', 4)
+            fid.createDimension('latitude', 3)
+            fid.createDimension('time', None)
+            fid.createVariable('longitude', 'f4', ('longitude',))[:] = [10, 10.25, 10.5, 10.75]
+            fid.createVariable('latitude', 'f4', ('latitude',))[:] = [45, 44.75, 44.5]
+            time = fid.createVariable('time', 'i4', ('time',))
+            time.units = TIME_UNITS
+            time.calendar = 'gregorian'
+            time[:] = netCDF4.date2num(times, TIME_UNITS, 'gregorian')
+            var = fid.createVariable(SHORT_NAMES[variable], 'i2',
+                                     ('time', 'latitude', 'longitude'), fill_value=FILL_VALUE)
+            var.scale_factor = 0.01 * start.month
+            var.add_offset = 300.0
+            var.units = 'K'
+            data = np.ma.masked_array(_expected_values(times, variable)[:, None, None] *
+                                      np.ones((1, 3, 4)))
+            data[:, 0, 0] = np.ma.masked
+            var[:] = data
+
+
+def test_chunks_are_split_by_month_and_variable():
+    chunks = eu._download_chunks('2019-01-30', '2019-02-02', VARIABLES)
+    assert chunks == [('201901_2m_temperature', '2m_temperature', '2019-01-30/2019-01-31'),
+                      ('201901_surface_solar_radiation_downwards',
+                       'surface_solar_radiation_downwards', '2019-01-30/2019-01-31'),
+                      ('201902_2m_temperature', '2m_temperature', '2019-02-01/2019-02-02'),
+                      ('201902_surface_solar_radiation_downwards',
+                       'surface_solar_radiation_downwards', '2019-02-01/2019-02-02')]
+
+
+def test_end_before_start_is_rejected():
+    with pytest.raises(RuntimeError):
+        eu._download_chunks('2019-02-02', '2019-01-30', VARIABLES)
+
+
+def test_interrupted_download_is_resumed(tmp_path):
+    target = str(tmp_path / 'era5.nc')
+    parts_dir = str(tmp_path / 'era5_parts')
+
+    client = FakeClient(fail=[('2019-02-01/2019-02-02', '2m_temperature')])
+    with pytest.raises(RuntimeError):
+        eu.download_CDS_data('2019-01-30', '2019-02-02', VARIABLES, target, workers=2,
+                             client=client)
+    assert len(client.requests) == 4
+    assert not os.path.exists(target)
+    # Only the chunks which were downloaded are listed in the manifest
+    with open(os.path.join(parts_dir, 'manifest.json'), 'r') as fp:
+        manifest = json.load(fp)
+    assert sorted(manifest['completed']) == ['201901_2m_temperature',
+                                             '201901_surface_solar_radiation_downwards',
+                                             '201902_surface_solar_radiation_downwards']
+    assert not os.path.exists(os.path.join(parts_dir, '201902_2m_temperature.nc'))
+
+    # The second run only downloads the missing chunk
+    client = FakeClient()
+    eu.download_CDS_data('2019-01-30', '2019-02-02', VARIABLES, target, workers=2,
+                         client=client)
+    assert client.requests == [('2019-02-01/2019-02-02', '2m_temperature')]
+    assert not os.path.exists(parts_dir)
+
+    with netCDF4.Dataset(target, 'r') as fid:
+        time = fid.variables['time']
+        times = netCDF4.num2date(time[:], time.units, time.calendar)
+        assert len(times) == 4 * 24
+        assert times[0] == FIRST_DAY
+        assert times[-1] == datetime.datetime(2019, 2, 2, 23)
+        assert np.all(np.diff(time[:]) == 1)
+        for variable in VARIABLES:
+            var = fid.variables[SHORT_NAMES[variable]]
+            assert var.dtype == np.float32
+            data = var[:]
+            assert data.mask[:, 0, 0].all()
+            assert not data.mask[:, 1:, :].any()
+            expected = _expected_values(times, variable)
+            # The February chunks have the coarser packing
+            assert np.abs(data[:, 2, 3] - expected).max() <= 0.01
+
+    # A complete target is not downloaded again
+    client = FakeClient()
+    eu.download_CDS_data('2019-01-30', '2019-02-02', VARIABLES, target, client=client)
+    assert client.requests == []
@@ -3,6 +3,7 @@ import tempfile
 import os
 
 import gdal_utils as gu
+import cache_utils
 import snappy_utils as su
 
 
@@ -11,6 +12,7 @@ import snappy_utils as su
 @click.option('--template', required=True, type=click.Path(dir_okay=False, exists=True))
 @click.option('--resample_algorithm', required=True, default='cubicspline')
 @click.option('--output', required=True, type=click.Path(dir_okay=False, exists=False))
+@cache_utils.cached_stage(['source', 'template'], ['output'])
 def main(source, template, output, resample_algorithm):
 
     # Save source and template to GeoTIFF becasue it will need to be read by GDAL